@@ -1,6 +1,18 @@
 import sys
 from stores import countdown, liquorland, henrys
 import api
+import custom_requests as req
+import metrics
+import profiling
+import progress
+import tracing
+import checkpoint
+from dead_letter import dead_letters
+from benchmarks import suite
+import stub_api
+import site_simulator
+import sharding
+import work_queue
 
 STORE_DICT = {
     "countdown": countdown.Countdown,
@@ -8,11 +20,67 @@ STORE_DICT = {
     "henrys": henrys.Henrys
 }
 
+# Crawl only and write items to the spool, instead of uploading them
+spool_only = False
+
 
 def main():
+    global spool_only
     args = sys.argv[1:]
+    if "--trace" in args:
+        args.remove("--trace")
+        tracing.enabled = True
+    if "--resume" in args:
+        args.remove("--resume")
+        checkpoint.resume = True
+    if "--spool" in args:
+        args.remove("--spool")
+        spool_only = True
+    if "--profile" in args:
+        args.remove("--profile")
+        run_dir = profiling.enable()
+        print(f"Writing profiles to {run_dir}")
+    if "--shard" in args:
+        index = args.index("--shard")
+        sharding.current = sharding.Shard.parse(args[index + 1])
+        del args[index:index + 2]
+    for arg in list(args):
+        if arg.startswith("--progress="):
+            args.remove(arg)
+            progress.reporter.set_mode(arg.split("=", 1)[1])
+        elif arg.startswith("--concurrency="):
+            args.remove(arg)
+            req.concurrency = int(arg.split("=", 1)[1])
+        elif arg.startswith("--shard="):
+            args.remove(arg)
+            sharding.current = sharding.Shard.parse(arg.split("=", 1)[1])
+        elif arg.startswith("--batch-size="):
+            args.remove(arg)
+            checkpoint.BATCH_SIZE = int(arg.split("=", 1)[1])
     if args[0] == 'scrape-all':
         scrape_all()
+    elif args[0] == 'benchmark':
+        sys.exit(suite.main(args[1:]))
+    elif args[0] == 'stub-api':
+        stub_api.main(args[1:])
+    elif args[0] == 'simulate-sites':
+        site_simulator.main(args[1:])
+    elif args[0] == 'upload':
+        upload(args[1:] or list(STORE_DICT))
+    elif args[0] == 'combine-shards':
+        sharding.main(args[1:])
+    elif args[0] == 'retry-failed':
+        retry_failed(args[1:])
+    elif args[0] == 'enqueue':
+        work_queue.enqueue(STORE_DICT, args[1:] or list(STORE_DICT))
+    elif args[0] == 'work':
+        workers = None
+        for arg in args[1:]:
+            if arg.startswith("--workers="):
+                workers = int(arg.split("=", 1)[1])
+        work_queue.run_workers(STORE_DICT, workers)
+    elif args[0] == 'queue-status':
+        work_queue.print_status()
     else:
         store_name = args[1]
         if args[0] == 'scrape':
@@ -24,7 +92,56 @@ def main():
 def scrape(store_name):
     store_class = STORE_DICT[store_name]
     store = store_class()
-    store.update_all_items()
+    try:
+        with tracing.span("scrape", store=store.name):
+            run_store(store)
+        metrics.record_run(store.name, True)
+    except Exception:
+        metrics.record_run(store.name, False)
+        raise
+    finally:
+        print(req.single_flight.summary())
+        metrics.registry.write()
+        write_summary(store_name)
+        write_trace()
+
+
+def run_store(store):
+    if spool_only:
+        store.spool_items()
+    else:
+        store.update_all_items()
+
+
+def upload(store_names):
+    """
+    Uploads the pending spool files of each store
+    :param store_names: List of store names
+    :return: None
+    """
+    try:
+        for store_name in store_names:
+            store = STORE_DICT[store_name]()
+            with tracing.span("upload", store=store.name):
+                count = store.upload_spooled()
+            print(f"Uploaded {count} {store.name} spool files")
+    finally:
+        metrics.registry.write()
+        write_trace()
+
+
+def retry_failed(store_names):
+    """
+    Replays failed uploads of the given stores, or of every store and location upload if none are given
+    :param store_names: List of store names
+    :return: None
+    """
+    if len(store_names) == 0:
+        replayed, succeeded = dead_letters.drain(rounds=3)
+        print(f"Replayed {replayed} failed uploads, {succeeded} succeeded")
+    for store_name in store_names:
+        STORE_DICT[store_name]().retry_failed(rounds=3)
+    print(dead_letters.summary())
 
 
 def find_stores(store_name):
@@ -37,9 +154,28 @@ def scrape_all():
     for store_class in STORE_DICT.values():
         try:
             store_scraper = store_class()
-            store_scraper.update_all_items()
+            with tracing.span("scrape", store=store_class.name):
+                run_store(store_scraper)
+            metrics.record_run(store_class.name, True)
         except Exception as err:
+            metrics.record_run(store_class.name, False)
             print(f"\n\n{err}\n\n")
+    print(req.single_flight.summary())
+    metrics.registry.write()
+    write_summary("all")
+    write_trace()
+
+
+def write_summary(name):
+    if sharding.current.sharded:
+        path = sharding.write_summary(metrics.registry, name)
+        print(f"Shard summary written to {path}")
+
+
+def write_trace():
+    if tracing.enabled:
+        path = tracing.tracer.write()
+        print(f"Trace written to {path}")
 
 
 if __name__ == '__main__':
@@ -10,10 +10,25 @@ url = os.getenv('pisspricer.url')
 email = os.environ.get('pisspricer.email')
 password = os.environ.get('pisspricer.password')
 
-res = requests.post(url + '/users/login', json={"email": email, "password": password})
 
-if not res.ok:
-    raise Exception("Login to API failed")
-res_json = res.json()
-token = res_json["authToken"]
-headers = {"X-Authorization": token}
+def login():
+    """
+    Logs in to the pisspricer api
+    :return: Dict of headers for authorized requests
+    """
+    res = requests.post(url + '/users/login', json={"email": email, "password": password})
+
+    if not res.ok:
+        raise Exception("Login to API failed")
+    res_json = res.json()
+    token = res_json["authToken"]
+    return {"X-Authorization": token}
+
+
+def __getattr__(name):
+    # Log in the first time headers are used, so modules can be imported without the api (eg. for benchmarks)
+    global headers
+    if name == "headers":
+        headers = login()
+        return headers
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
@@ -0,0 +1,168 @@
+"""
+Generates the benchmark fixtures in benchmarks/fixtures. The fixtures are committed, this only needs to be
+re-run if the page formats the scrapers parse change.
+
+    python3 pisspricer-scraper/benchmarks/make_fixtures.py
+"""
+import json
+import os
+import random
+from io import BytesIO
+from PIL import Image, ImageDraw
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+NAMES = ["Speight's Gold Medal Ale", "Jim Beam White Bourbon", "Absolut Vodka", "Gordon's London Dry Gin",
+         "Oyster Bay Sauvignon Blanc", "Villa Maria Private Bin Pinot Noir", "Baileys Irish Cream",
+         "Scrumpy Crisp Apple Cider", "Cody's Bourbon & Cola", "Heineken Lager", "Jameson Irish Whiskey",
+         "Bacardi Carta Blanca Rum", "Lindauer Classic Brut", "Kahlua Coffee Liqueur", "Corona Extra"]
+VOLUMES = ["330ml", "1L", "700ml", "750ml", "1.5Lt", "1.125L", "12 x 330ml", "375ML", "250m", "4.5L", ""]
+STOCK = ["Stock High", "Stock Medium", "Stock Low", "Out of Stock"]
+FILLER_LINKS = 300
+
+
+def barcode(rand):
+    return "94" + "".join(str(rand.randint(0, 9)) for _ in range(11))
+
+
+def liquorland_page(rand, n_items=48, total=312):
+    """ Listing page in the format of shop.liquorland.co.nz category pages """
+    nav = "".join(f'<li><a href="/category{i}.aspx">Category {i}</a></li>' for i in range(FILLER_LINKS))
+    items = []
+    for i in range(n_items):
+        name = f"{rand.choice(NAMES)} {rand.choice(VOLUMES)}".strip()
+        sku = rand.randint(100000, 999999)
+        price = rand.randint(800, 9000) / 100
+        if rand.random() < 0.3:
+            price_html = (f'<span class="msrp">${price + 5:,.2f}</span>'
+                          f'<span class="SpecialPriceFormat2">${price:,.2f}</span>')
+        else:
+            price_html = f'<span class="value">${price:,.2f}</span>'
+        items.append(f'''
+<div class="productItemDisplay">
+  <div class="thumbnail"><a href="Product/{sku}.aspx"><img src="ProductImages/m/{barcode(rand)}.jpg" alt="{name}"/></a></div>
+  <div class="w2mItemName"><a href="Product/{name.replace(' ', '-')}_{sku}.aspx">{name}</a></div>
+  <div class="priceContainer">{price_html}</div>
+  <div class="stockStatus"><span class="status">{rand.choice(STOCK)}</span></div>
+  <div class="addToCart"><input type="button" value="Add to cart" class="btn"/></div>
+</div>''')
+    return f'''<!DOCTYPE html>
+<html><head><title>Liquorland</title><script>var dataLayer = [];</script></head>
+<body><div id="header"><ul class="nav">{nav}</ul></div>
+<div class="searchSortHeader"><span>1 - {n_items} of {total} results</span></div>
+<div class="productList">{"".join(items)}</div>
+<div id="footer"><ul>{nav}</ul></div></body></html>'''
+
+
+def henrys_product(rand, i):
+    name = f"{rand.choice(NAMES)} {rand.choice(VOLUMES)}".strip()
+    on_special = rand.random() < 0.3
+    return {
+        "id": 100000 + i,
+        "title": name,
+        "url": f"https://www.henrys.co.nz/product/{100000 + i}",
+        "productPrice": rand.randint(800, 9000) / 100,
+        "isOnSpecial": on_special,
+        "savings": rand.randint(100, 1000) / 100 if on_special else None,
+        "sites": [str(s) for s in rand.sample(range(1, 41), rand.randint(5, 40))],
+        "subDepartmentKey": rand.choice([24350, 13587, 13651, 23625, 23629, 16639, 99999]),
+        "department": "Beer",
+        "image": f"https://www.henrys.co.nz/images/{100000 + i}.png"
+    }
+
+
+def henrys_product_page(rand):
+    """ Product page in the format of henrys.co.nz, with the barcode in the JSON-LD block """
+    graph = {"@context": "https://schema.org",
+             "@graph": [{"@type": "Product", "name": rand.choice(NAMES), "sku": barcode(rand),
+                         "offers": {"@type": "Offer", "price": "19.99", "priceCurrency": "NZD"}}]}
+    nav = "".join(f'<a href="/c/{i}" class="block p-2">Category {i}</a>' for i in range(FILLER_LINKS))
+    return f'''<!DOCTYPE html>
+<html><head><title>Henrys</title>
+<script>window.config = {{"env": "production"}};</script>
+<script src="/js/app.js"></script>
+<script type="application/ld+json">{json.dumps(graph)}</script>
+</head><body><nav>{nav}</nav>
+<main><div class="product"><img class="w-full" src="https://www.henrys.co.nz/images/product.png" alt="product"/>
+<p>{" ".join(rand.choice(NAMES) for _ in range(100))}</p></div></main>
+<footer>{nav}</footer></body></html>'''
+
+
+def henrys_stores_page(rand, n_stores=40):
+    """ Store locations page in the format of henrys.co.nz/store-locations """
+    stores = [{
+        "title": f"Henrys {i}",
+        "uri": f"store-locations/henrys-{i}",
+        "regions": rand.choice(["Auckland", "Waikato", "Canterbury", "Wellington"]),
+        "locationAddress": f"{rand.randint(1, 300)} Main Road\nSuburb {i}\nCity {rand.randint(1000, 9999)}",
+        "locationCoordinates": [{"latitude": str(-36 - rand.random() * 10), "longitude": str(174 + rand.random())}],
+        "siteID": i
+    } for i in range(1, n_stores + 1)]
+    locations = json.dumps(stores).replace("'", "&#39;")
+    return f'''<!DOCTYPE html><html><body>
+<store-locations :locations='{locations}'></store-locations></body></html>'''
+
+
+def countdown_items(rand, n_stores=5, per_cat=120):
+    """ Countdown products, with the aisle groups each store returns them in (see Countdown._get_cd_items) """
+    cats = ["beer", "cider", "red wine", "white wine", "spirits"]
+    products = []
+    for i in range(per_cat * len(cats)):
+        on_special = rand.random() < 0.3
+        price = rand.randint(800, 9000) / 100
+        products.append({
+            "sku": str(200000 + i),
+            "name": rand.choice(NAMES),
+            "brand": "brand",
+            "barcode": barcode(rand),
+            "price": {"originalPrice": price, "salePrice": price - 2 if on_special else price, "isSpecial": on_special},
+            "size": {"volumeSize": rand.choice(VOLUMES) or None},
+            "images": {"big": f"https://assets.countdown.co.nz/{200000 + i}.jpg"}
+        })
+    groups = [{"aisle": aisle, "skus": [p["sku"] for p in products[c * per_cat:(c + 1) * per_cat]]}
+              for c, aisle in enumerate(cats)]
+    stores = [{"internalId": str(store + 1), "storeId": 100 + store} for store in range(n_stores)]
+    # Every fifth product is new, so creating items is exercised as well as looking up known ones
+    barcodes = {product["barcode"]: i for i, product in enumerate(products) if i % 5 != 0}
+    return {"products": products, "groups": groups, "stores": stores, "barcodes": barcodes}
+
+
+def product_image(rand, size, mode):
+    """ Bottle on a plain background, transparent for RGBA and white for RGB """
+    background = (255, 255, 255, 0) if mode == "RGBA" else (255, 255, 255)
+    image = Image.new(mode, (size, size), background)
+    draw = ImageDraw.Draw(image)
+    w = size // 4
+    colour = tuple(rand.randint(0, 200) for _ in range(3)) + ((255,) if mode == "RGBA" else ())
+    draw.rectangle([size // 2 - w // 2, size // 3, size // 2 + w // 2, size - size // 10], fill=colour)
+    draw.rectangle([size // 2 - w // 6, size // 10, size // 2 + w // 6, size // 3], fill=colour)
+    draw.ellipse([size // 2 - w // 3, size // 2, size // 2 + w // 3, size // 2 + w // 2], fill=background)
+    return image
+
+
+def main():
+    rand = random.Random(1)
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+
+    def write(name, data):
+        mode = "wb" if isinstance(data, bytes) else "w"
+        with open(os.path.join(FIXTURE_DIR, name), mode) as f:
+            f.write(data)
+
+    write("liquorland_page.html", liquorland_page(rand))
+    write("henrys_products.json", json.dumps({"totalPages": 40,
+                                              "products": [henrys_product(rand, i) for i in range(48)]}))
+    write("henrys_product_page.html", henrys_product_page(rand))
+    write("henrys_stores_page.html", henrys_stores_page(rand))
+    write("countdown_items.json", json.dumps(countdown_items(rand)))
+
+    png = BytesIO()
+    product_image(rand, 500, "RGBA").save(png, format="PNG")
+    write("product.png", png.getvalue())
+    jpeg = BytesIO()
+    product_image(rand, 1200, "RGB").save(jpeg, format="JPEG", quality=90)
+    write("product.jpg", jpeg.getvalue())
+
+
+if __name__ == '__main__':
+    main()
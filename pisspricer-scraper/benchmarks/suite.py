@@ -0,0 +1,244 @@
+"""
+Microbenchmarks for the cpu heavy paths of the scrapers, run against the fixtures in benchmarks/fixtures.
+Reports throughput for each benchmark and fails if any is slower than the stored baseline by more than the threshold.
+
+    python3 pisspricer-scraper benchmark [--save-baseline] [--threshold=0.25] [--filter=liquorland]
+
+Baselines are machine dependent, re-save them with --save-baseline when moving to a different host.
+"""
+import json
+import os
+import tempfile
+import time
+from error_log import error_log
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+MIN_BATCH_TIME = 0.2
+REPEATS = 5
+
+
+def _fixture(name, binary=False):
+    with open(os.path.join(FIXTURE_DIR, name), "rb" if binary else "r") as f:
+        return f.read()
+
+
+def liquorland_benchmarks():
+    from bs4 import BeautifulSoup
+    from stores.liquorland.model import LiquorlandModel
+
+    model = LiquorlandModel(printer=None)
+    page = _fixture("liquorland_page.html")
+    soup = BeautifulSoup(page, features="html.parser")
+    item_divs = soup.find_all("div", {"class": "productItemDisplay"})
+    names = [model._get_item_info(div)[0] for div in item_divs]
+    return [
+        ("liquorland._parse_first_page", 1, lambda: model._parse_first_page(page)),
+        ("liquorland._get_item_info", len(item_divs), lambda: [model._get_item_info(div) for div in item_divs]),
+        ("liquorland._get_item_volume", len(names), lambda: [model._get_item_volume(name) for name in names]),
+        ("liquorland._get_page_item_count", 1, lambda: model._get_page_item_count(soup)),
+    ]
+
+
+def henrys_benchmarks():
+    from stores.henrys import item_processor, store_processor
+
+    products = json.loads(_fixture("henrys_products.json"))["products"]
+    names = [product["title"] for product in products]
+    product_page = _fixture("henrys_product_page.html")
+    stores_page = _fixture("henrys_stores_page.html", binary=True)
+    return [
+        ("henrys.process_henry_item", len(products),
+         lambda: [item_processor.process_henry_item(product) for product in products]),
+        ("henrys.get_volume", len(names), lambda: [item_processor.get_volume(name) for name in names]),
+        ("henrys.process_item_page", 1, lambda: item_processor.process_item_page({}, product_page)),
+        ("henrys.process_stores_page", 1, lambda: store_processor.process_stores_page(stores_page)),
+    ]
+
+
+def image_benchmarks():
+    import images
+
+    png = _fixture("product.png", binary=True)
+    jpeg = _fixture("product.jpg", binary=True)
+    return [
+        ("images.process_response_content[png]", 1, lambda: images.process_response_content(png)),
+        ("images.process_response_content[jpeg]", 1, lambda: images.process_response_content(jpeg)),
+        ("images.process_image[jpeg+webp]", 1,
+         lambda: images.process_image(images.open_image(jpeg), formats=["jpeg", "webp"])),
+    ]
+
+
+def countdown_benchmarks():
+    from stores.countdown import Countdown
+    import taxonomy
+
+    data = json.loads(_fixture("countdown_items.json"))
+    unmapped = taxonomy.countdown.missing(group["aisle"] for group in data["groups"])
+    if len(unmapped) > 0:
+        raise ValueError(f"Countdown fixture aisles missing from taxonomy.COUNTDOWN: {unmapped}")
+    products = {product["sku"]: product for product in data["products"]}
+    groups = [{"aisle": group["aisle"], "items": [products[sku] for sku in group["skus"]]} for group in data["groups"]]
+    cd_items = {store["internalId"]: groups for store in data["stores"]}
+    n_items = sum(len(group["items"]) for group in groups) * len(cd_items)
+    barcodes = data["barcodes"]
+    # Barcodes once the new items are posted, which prices are listed against
+    posted_barcodes = {product["barcode"]: i for i, product in enumerate(data["products"])}
+
+    class FixtureCountdown(Countdown):
+        """ Countdown with pisspricer api calls answered from the fixture, so only its own work is measured """
+
+        def _post_items(self, new_items):
+            pass
+
+        @staticmethod
+        def _get_barcodes():
+            return posted_barcodes
+
+    countdown = FixtureCountdown()
+
+    return [
+        ("countdown._create_price_list", n_items,
+         lambda: Countdown._create_price_list(data["stores"], cd_items, posted_barcodes)),
+        ("countdown._get_new_items", n_items,
+         lambda: Countdown._get_new_items(cd_items, barcodes)),
+        ("countdown._create_new_items", n_items,
+         lambda: countdown._create_new_items(cd_items, barcodes)),
+    ]
+
+
+def reference_data_benchmarks():
+    import reference_data
+
+    barcodes = json.dumps({f"94{i:011d}": [i] for i in range(50000)}).encode()
+    all_items = json.dumps([{"sku": i, "name": f"Item {i}", "hasImage": i % 3} for i in range(50000)]).encode()
+
+    def stream(document, add_batch):
+        decoder = reference_data.StreamDecoder()
+        for start in range(0, len(document), reference_data.CHUNK_SIZE):
+            for batch in decoder.feed(document[start:start + reference_data.CHUNK_SIZE]):
+                add_batch(batch)
+        for batch in decoder.close():
+            add_batch(batch)
+
+    return [
+        ("reference_data.stream[barcodes]", 50000, lambda: stream(barcodes, reference_data._sku_index({}))),
+        ("reference_data.stream[allitems]", 50000, lambda: stream(all_items, lambda batch: None)),
+    ]
+
+
+def all_benchmarks():
+    """
+    Sets up every benchmark
+    :return: List of (name, items_per_call, function) tuples
+    """
+    return liquorland_benchmarks() + henrys_benchmarks() + image_benchmarks() + countdown_benchmarks() + \
+        reference_data_benchmarks()
+
+
+def measure(func):
+    """
+    Times a function, calibrating the number of calls per batch so each batch takes at least MIN_BATCH_TIME
+    :param func: Function with no arguments
+    :return: Best seconds per call over REPEATS batches
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_BATCH_TIME:
+            break
+        loops *= 2
+
+    best = elapsed / loops
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE) as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def _measure_quietly(func):
+    """
+    Measures func with errors it logs written to a temporary file instead of the error log
+    :param func: Function to benchmark
+    :return: Seconds per call
+    """
+    log_path = error_log.path
+    with tempfile.TemporaryDirectory() as log_dir:
+        error_log.path = os.path.join(log_dir, "log.jsonl")
+        try:
+            return measure(func)
+        finally:
+            error_log.close()
+            error_log.path = log_path
+
+
+def run(save_baseline=False, threshold=0.25, name_filter=None):
+    """
+    Runs the benchmarks and compares them to the baseline
+    :param save_baseline: True to store the results as the new baseline
+    :param threshold: Allowed fractional drop in throughput before a benchmark counts as a regression
+    :param name_filter: Only run benchmarks with this string in their name
+    :return: List of names of benchmarks that regressed
+    """
+    baseline = load_baseline()
+    results = {}
+    regressions = []
+
+    print(f"{'benchmark':<42}{'items/s':>14}{'ms/call':>12}{'baseline':>14}{'change':>10}")
+    for name, n_items, func in all_benchmarks():
+        if name_filter is not None and name_filter not in name:
+            continue
+        seconds = _measure_quietly(func)
+        throughput = n_items / seconds
+        results[name] = {"items_per_second": throughput, "seconds_per_call": seconds}
+
+        line = f"{name:<42}{throughput:>14,.0f}{seconds * 1000:>12.3f}"
+        if name in baseline:
+            base = baseline[name]["items_per_second"]
+            change = throughput / base - 1
+            line += f"{base:>14,.0f}{100 * change:>+9.1f}%"
+            if change < -threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {BASELINE_FILE}")
+
+    if len(regressions) > 0:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {100 * threshold:.0f}%: {', '.join(regressions)}")
+    return regressions
+
+
+def main(args):
+    """
+    Command line entry point
+    :param args: List of command line args after 'benchmark'
+    :return: Exit code, 1 if any benchmark regressed
+    """
+    save_baseline = "--save-baseline" in args
+    threshold = 0.25
+    name_filter = None
+    for arg in args:
+        if arg.startswith("--threshold="):
+            threshold = float(arg.split("=", 1)[1])
+        elif arg.startswith("--filter="):
+            name_filter = arg.split("=", 1)[1]
+    regressions = run(save_baseline, threshold, name_filter)
+    return 1 if len(regressions) > 0 else 0
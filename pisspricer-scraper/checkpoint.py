@@ -0,0 +1,255 @@
+import gzip
+import json
+import os
+import shutil
+import time
+import sharding
+
+RUN_DIR = os.getenv("pisspricer.run_dir", os.path.join(os.path.dirname(__file__), "runs"))
+BATCH_SIZE = 1000
+
+resume = False
+
+
+class RunCheckpoint:
+    """
+    Persists the output of each phase of a store run to '{run_dir}/{store}', with a manifest of completed phases,
+    so a run that dies partway through can resume from the last completed phase.
+    Phases that upload in batches record each confirmed batch, so they resume from the last confirmed batch.
+    Their items are saved when they start, so a resumed phase has the same batches even if its inputs have changed.
+    Files:
+        manifest.json         - Run start time, completed phases and whether the run finished
+        {phase}.json.gz       - Output of a completed phase
+        {phase}.items.json.gz - Items and batch size of a batched phase
+        {phase}.batches       - Index of each confirmed batch, one per line
+    """
+
+    def __init__(self, store, resume_run=False, run_dir=RUN_DIR):
+        self.store = store
+        self.path = os.path.join(run_dir, store.lower())
+        manifest = self._read_manifest()
+        if resume_run and manifest is not None and not manifest["finished"]:
+            self.manifest = manifest
+            print(f"Resuming {store} run started {manifest['started']}, "
+                  f"completed phases: {', '.join(manifest['phases']) or 'none'}")
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.manifest = {"store": store, "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "phases": {},
+                             "finished": False}
+        os.makedirs(self.path, exist_ok=True)
+        self._write_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, "manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        path = os.path.join(self.path, "manifest.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def _file(self, phase, extension):
+        return os.path.join(self.path, phase.replace(" ", "_") + extension)
+
+    def done(self, phase):
+        """
+        :param phase: Phase name
+        :return: True if the phase completed in this run
+        """
+        return phase in self.manifest["phases"]
+
+    def save(self, phase, data):
+        """
+        Saves the output of a phase and marks it completed
+        :param phase: Phase name
+        :param data: Json serializable output of the phase
+        :return: None
+        """
+        path = self._file(phase, ".json.gz")
+        with gzip.open(path + ".tmp", "wt", compresslevel=3) as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        self.manifest["phases"][phase] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self._write_manifest()
+
+    def load(self, phase):
+        """
+        Loads the output of a completed phase
+        :param phase: Phase name
+        :return: Output saved for the phase
+        """
+        with gzip.open(self._file(phase, ".json.gz"), "rt") as f:
+            return json.load(f)
+
+    def run(self, phase, func, *args, **kwargs):
+        """
+        Runs func and saves its output, or loads the output if the phase already completed
+        :param phase: Phase name
+        :param func: Function producing the phase's json serializable output
+        :return: Output of func
+        """
+        if self.done(phase):
+            print(f"Skipping completed phase '{phase}'")
+            return self.load(phase)
+        data = func(*args, **kwargs)
+        self.save(phase, data)
+        return data
+
+    async def async_run(self, phase, func, *args, **kwargs):
+        """
+        Same as run, for a coroutine function
+        :param phase: Phase name
+        :param func: Coroutine function producing the phase's json serializable output
+        :return: Output of func
+        """
+        if self.done(phase):
+            print(f"Skipping completed phase '{phase}'")
+            return self.load(phase)
+        data = await func(*args, **kwargs)
+        self.save(phase, data)
+        return data
+
+    def confirmed_batches(self, phase):
+        """
+        :param phase: Phase name
+        :return: Set of confirmed batch indexes
+        """
+        try:
+            with open(self._file(phase, ".batches")) as f:
+                return {int(line) for line in f if line.strip()}
+        except OSError:
+            return set()
+
+    def confirm_batch(self, phase, index):
+        """
+        Records a batch as confirmed
+        :param phase: Phase name
+        :param index: Batch index
+        :return: None
+        """
+        with open(self._file(phase, ".batches"), "a") as f:
+            f.write(f"{index}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _batch_items(self, phase, items, batch_size):
+        """
+        Saves the items and batch size of a batched phase, or loads them if the phase was already started
+        :param phase: Phase name
+        :param items: List of items
+        :param batch_size: Number of items in a batch
+        :return: (items, batch_size) 2-tuple the phase was started with
+        """
+        path = self._file(phase, ".items.json.gz")
+        if os.path.exists(path):
+            with gzip.open(path, "rt") as f:
+                started = json.load(f)
+            return started["items"], started["batch_size"]
+        with gzip.open(path + ".tmp", "wt", compresslevel=3) as f:
+            json.dump({"batch_size": batch_size, "items": items}, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        return items, batch_size
+
+    def _pending_batches(self, phase, items, batch_size):
+        """
+        :param phase: Phase name of a started or new batched phase
+        :param items: List of items, ignored when resuming a started phase
+        :param batch_size: Number of items in a batch, defaults to BATCH_SIZE, ignored when resuming a started phase
+        :return: List of (index, batch) 2-tuples of the batches that haven't been confirmed
+        """
+        if batch_size is None:
+            batch_size = BATCH_SIZE
+        items, batch_size = self._batch_items(phase, items, batch_size)
+        confirmed = self.confirmed_batches(phase)
+        if len(confirmed) > 0:
+            print(f"Skipping {len(confirmed)} confirmed batches of '{phase}'")
+        return [(index, items[start:start + batch_size])
+                for index, start in enumerate(range(0, len(items), batch_size)) if index not in confirmed]
+
+    def run_batches(self, phase, items, func, batch_size=None):
+        """
+        Runs func on each batch of items that hasn't been confirmed, confirming each as it completes,
+        then marks the phase completed.
+        Batches are confirmed by position, so a resumed phase uses the items and batch size it was started with,
+        rather than items rebuilt from inputs that may have changed since.
+        :param phase: Phase name
+        :param items: Json serializable list of items, ignored when resuming a started phase
+        :param func: Function taking a list of items, returning a list of results
+        :param batch_size: Number of items in a batch, defaults to BATCH_SIZE, ignored when resuming a started phase
+        :return: List of results of the batches run
+        """
+        if self.done(phase):
+            print(f"Skipping completed phase '{phase}'")
+            return []
+        results = []
+        for index, batch in self._pending_batches(phase, items, batch_size):
+            results += func(batch)
+            self.confirm_batch(phase, index)
+        self.save(phase, None)
+        return results
+
+    async def async_run_batches(self, phase, items, func, batch_size=None):
+        """
+        Same as run_batches, for a coroutine function
+        :param phase: Phase name
+        :param items: Json serializable list of items, ignored when resuming a started phase
+        :param func: Coroutine function taking a list of items, returning a list of results
+        :param batch_size: Number of items in a batch, defaults to BATCH_SIZE, ignored when resuming a started phase
+        :return: List of results of the batches run
+        """
+        if self.done(phase):
+            print(f"Skipping completed phase '{phase}'")
+            return []
+        results = []
+        for index, batch in self._pending_batches(phase, items, batch_size):
+            results += await func(batch)
+            self.confirm_batch(phase, index)
+        self.save(phase, None)
+        return results
+
+    def finish(self):
+        """
+        Marks the run finished, so the next run starts from scratch even when resuming
+        :return: None
+        """
+        self.manifest["finished"] = True
+        self._write_manifest()
+
+    def remove(self):
+        """
+        Deletes the run directory
+        :return: None
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class NoCheckpoint:
+    """ Same interface as RunCheckpoint without persisting anything """
+
+    def run(self, phase, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    async def async_run(self, phase, func, *args, **kwargs):
+        return await func(*args, **kwargs)
+
+    def run_batches(self, phase, items, func, batch_size=None):
+        return func(items)
+
+    async def async_run_batches(self, phase, items, func, batch_size=None):
+        return await func(items)
+
+    def finish(self):
+        pass
+
+
+def for_store(store):
+    """
+    Creates the checkpoint for a store run, or this shard's part of it, resuming the last run if the --resume flag was given
+    :param store: Store name
+    :return: RunCheckpoint
+    """
+    return RunCheckpoint(store + sharding.current.suffix, resume_run=resume)
@@ -45,3 +45,9 @@ class LiquorlandException(AiohttpException):
         self.res = res
         super().__init__(res, task, self.NAME)
 
+
+class ImageTooLargeException(Exception):
+
+    def __init__(self, width, height, max_pixels):
+        message = f"Image of {width}x{height} pixels is larger than the limit of {max_pixels} pixels."
+        super().__init__(message)
@@ -1,66 +1,124 @@
 import aiohttp
 import asyncio
+import hashlib
+import json
+import os
 import time
 import pandas as pd
 import requests
 
 import tools
 import copy
+from custom_exceptions import AiohttpException
+import dead_letter
+import metrics
+import progress
+import tracing
 
+CACHE_DIR = os.getenv("pisspricer.cache_dir", os.path.join(os.path.dirname(__file__), "cache"))
 
-async def async_get(session, url, headers={}, cookies={}):
-    """Execute an http call async
-    Args:
-        session: context for making the http call
-        url: URL to call
-        headers: optional headers
-        cookies: option cookies
-    Return:
-        responses: A dict like object containing http response
-    """
-    url_string = url["url"]
-    carry = url.get("carry", None)
-    async with session.get(url_string, headers=headers, cookies=cookies) as response:
-        resp = await response.json()
-        resp["carry"] = carry
-        return resp
-
-
-async def create_async_get_list(urls, header, cookie):
-    """ Gather many HTTP call made async
-    Args:
-        urls: a list of string
-        header: header to use in all requests
-        cookie: cookie to use in all requests
-    Return:
-        responses: A list of dict like object containing http response
-    """
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for url in urls:
-            tasks.append(
-                async_get(
-                    session,
-                    url,
-                    headers=header,
-                    cookies=cookie
-                )
-            )
-        responses = await asyncio.gather(*tasks, return_exceptions=False)
-        return responses
+# Maximum simultaneous connections of each aiohttp session
+concurrency = 100
+
+# Maximum simultaneous image connections when images are got and put alongside the price puts, in the same session
+image_concurrency = int(os.getenv("pisspricer.image_concurrency", 50))
 
 
-def async_get_list(urls, headers={}, cookies={}):
+# Response hooks for calls made with the requests library
+requests_hooks = {"response": [metrics.record_requests_response, tracing.record_requests_response]}
+
+
+def client_session(limit=None, **kwargs):
+    """
+    Creates an aiohttp session that records metrics, and spans when tracing is enabled, for every request
+    :param limit: Maximum simultaneous connections, defaults to concurrency
+    :param kwargs: Keyword args for aiohttp.ClientSession
+    :return: aiohttp.ClientSession
     """
-    Async get a list of urls
+    trace_configs = [metrics.trace_config()]
+    if tracing.enabled:
+        trace_configs.append(tracing.trace_config())
+    kwargs.setdefault("connector", aiohttp.TCPConnector(limit=limit if limit is not None else concurrency))
+    return aiohttp.ClientSession(trace_configs=trace_configs, **kwargs)
 
-    :param urls: List of dicts {"url": url, "carry}
-    :param headers: Header to be used for each request
-    :param cookies: Cookie to be used for each request
-    :return: List of responses
+
+""" -----------
+SHARED GETS
+---------------"""
+
+
+class SingleFlight:
     """
-    responses = asyncio.run(create_async_get_list(urls, headers, cookies))
-    return responses
+    Shares one in-flight request between identical concurrent requests.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.requests = 0
+        self.coalesced = 0
+
+    async def do(self, key, fetch):
+        """
+        Awaits the in-flight fetch for key, or starts one if there isn't one
+        :param key: Hashable key identifying the request
+        :param fetch: Function returning a coroutine that makes the request
+        :return: Result of the fetch
+        """
+        self.requests += 1
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            metrics.http_coalesced.inc()
+
+        # Shield so one caller being cancelled doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    def summary(self):
+        return f"Coalesced requests: {self.coalesced}/{self.requests}"
+
+
+single_flight = SingleFlight()
+
+
+def _freeze(mapping):
+    """ Converts a dict of request options into a hashable value """
+    return tuple(sorted((str(k), str(v)) for k, v in mapping.items()))
+
+
+async def _fetch(session, url, headers, cookies, params, decode):
+    async with session.get(url, headers=headers, cookies=cookies, params=params) as response:
+        body = await response.read()
+        json_body = None
+        text = None
+        if decode:
+            try:
+                json_body = await response.json()
+            except Exception:
+                json_body = None
+            try:
+                text = await response.text()
+            except Exception:
+                text = None
+        return Response(response, None, None, json_body, text, read=body)
+
+
+async def shared_get(session, url, headers={}, cookies={}, params={}, decode=True):
+    """
+    Http get that shares one fetch and decoded response between identical concurrent requests
+    :param session: Aiohttp session
+    :param url: Url for http request
+    :param headers: Headers for http request
+    :param cookies: Cookies for http request
+    :param params: Params for http request
+    :param decode: True to decode the body as json and text, False for bytes only
+    :return: Custom response object, shared between callers so must not be modified
+    """
+    key = (str(url), _freeze(params), _freeze(headers), _freeze(cookies), decode)
+    return await single_flight.do(key, lambda: _fetch(session, url, headers, cookies, params, decode))
 
 
 """ -----------
@@ -87,12 +145,17 @@ async def async_post(session, url, payload, headers={}, cookies={}, printer=None
                 print_function, total, task = printer
                 iteration[0] += 1
                 print_function(iteration[0], total, task)
+            if response.status == 409:
+                # Already created, eg. by another shard
+                return None
             if response.status != 201:
+                dead_letter.dead_letters.add("POST", url, payload, response.status,
+                                             key=f"{url}#{payload.get('barcode') or payload.get('internalSku')}")
                 raise Exception("Error while posting item: " + str(response))
             resp = await response.json()
             return resp
         except Exception as err:
-            tools.log_error(err)
+            tools.log_error(err, url=url)
             raise err
 
 
@@ -103,7 +166,7 @@ async def create_async_post_list(reqs, printer):
     :param printer: (print_function, total, title) for printing
     :return: List of json response items
     """
-    async with aiohttp.ClientSession() as session:
+    async with client_session() as session:
         tasks = []
         iteration = [0]
         for payload, url, header, cookie in reqs:
@@ -146,13 +209,12 @@ GETTING IMAGES
 
 async def async_get_image(session, sku, url, printer=None, iteration=None):
 
-    async with session.get(url) as response:
-        if printer is not None:
-            print_function, total, task = printer
-            iteration[0] += 1
-            print_function(iteration[0], total, task)
-        image = await response.read()
-        return sku, image
+    response = await shared_get(session, url, decode=False)
+    if printer is not None:
+        print_function, total, task = printer
+        iteration[0] += 1
+        print_function(iteration[0], total, task)
+    return sku, response.read()
 
 
 async def create_async_get_images(reqs, printer):
@@ -162,7 +224,7 @@ async def create_async_get_images(reqs, printer):
     :param printer: (print_function, total, title) for printing
     :return: List of json response items
     """
-    async with aiohttp.ClientSession() as session:
+    async with client_session() as session:
         tasks = []
         iteration = [0]
         for sku, url in reqs:
@@ -217,7 +279,7 @@ async def async_post_image(session, url, image, headers={}, cookies={}, printer=
                 raise Exception("Error while posting image: " + str(response))
             return response
         except Exception as err:
-            tools.log_error(err)
+            tools.log_error(err, url=url)
             raise err
 
 
@@ -228,7 +290,7 @@ async def create_async_post_images(reqs, printer):
     :param printer: (print_function, total, title) for printing
     :return: List of json response items
     """
-    async with aiohttp.ClientSession() as session:
+    async with client_session() as session:
         tasks = []
         iteration = [0]
         for image, url, headers in reqs:
@@ -248,19 +310,18 @@ async def create_async_post_images(reqs, printer):
 
 def post_images(images, base_url, headers={}, printer=None):
     """
-    Posts images to pisspricer api to url '{base_url}/{id}/image'
-    :param images: List of (id, image) tuples
+    Posts images to pisspricer api to url '{base_url}/{path}'
+    :param images: List of (path, content type, image) tuples, see images.uploads
     :param base_url: Base url for posting
     :param headers: Dictionary of headers
     :param printer: (print_function, total, title)
     :return: List of responses
     """
     reqs = []
-    new_headers = copy.deepcopy(headers)
-    new_headers["Content-Type"] = "image/jpeg"
-    for id, image in images:
-        url = f"{base_url}/{id}/image"
-        reqs.append((image, url, new_headers))
+    for path, content_type, image in images:
+        new_headers = copy.deepcopy(headers)
+        new_headers["Content-Type"] = content_type
+        reqs.append((image, f"{base_url}/{path}", new_headers))
     responses = asyncio.run(create_async_post_images(reqs, printer))
     return responses
 
@@ -287,10 +348,15 @@ async def async_put_json(session, url, payload, total=0, headers={}, cookies={},
         async with session.put(url, headers=headers, cookies=cookies, json=payload) as response:
             iteration[0] += 1
             if not stop_print:
-                print(f"{iteration[0]}/{total}", end="\r")
+                progress.reporter.update(iteration[0], total, "put prices")
             code = response.status
+            if 200 <= code <= 299:
+                dead_letter.dead_letters.resolve("PUT", url)
+            else:
+                dead_letter.dead_letters.add("PUT", url, payload, code)
             return str(code)
     except asyncio.TimeoutError:
+        dead_letter.dead_letters.add("PUT", url, payload, "Timeout")
         return "Timeout"
 
 
@@ -304,7 +370,7 @@ async def create_async_tasks(arg_list, kwargs, func, timeout_mins=20):
     :return: List of responses from function
     """
     timeout = aiohttp.ClientTimeout(total=timeout_mins*60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    async with client_session(timeout=timeout) as session:
         tasks = []
         for args in arg_list:
             tasks.append(func(session, *args, **kwargs))
@@ -312,13 +378,14 @@ async def create_async_tasks(arg_list, kwargs, func, timeout_mins=20):
         return responses
 
 
-def put_prices(prices, base_url, headers={}):
+def put_prices(prices, base_url, headers={}, store=""):
     """
     Puts prices using async function
     :param prices: List of (sku, store_id, price_data) tuples
     :param base_url: Base url to be used in req urls, '{base_url}/items/{sku}/stores/{store_id}'
     :param headers: Headers to be used in all requests
-    :return: None
+    :param store: Store name for metrics
+    :return: List of response status strings
     """
     print("Starting upload price data...")
 
@@ -343,7 +410,143 @@ def put_prices(prices, base_url, headers={}):
 
     # Print results
     print(f'Took {time2 - time1:.2f} s')
-    print(pd.Series(responses).value_counts())
+    counts = pd.Series(responses).value_counts()
+    print(counts)
+    for result, count in counts.items():
+        metrics.items_uploaded.inc(int(count), store=store.lower(), kind="price", result=result)
+    dead_letter.dead_letters.flush()
+    return responses
+
+
+""" -----------
+CACHED PAGES
+---------------"""
+
+
+class HttpCache:
+    """
+    Cache of parsed pages, validated with ETag / Last-Modified headers and a hash of the body.
+    Entries are stored in '{CACHE_DIR}/{name}.json' between runs.
+    """
+
+    def __init__(self, name, cache_dir=CACHE_DIR):
+        self.name = name
+        self.path = os.path.join(cache_dir, f"{name}.json")
+        self.entries = {}
+        self.seen = set()
+        self.pages = 0
+        self.unchanged = 0
+
+    def load(self):
+        """
+        Load cache entries saved by a previous run, if any
+        :return: self
+        """
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        return self
+
+    def save(self):
+        """
+        Save entries seen this run, dropping pages that no longer exist
+        :return: None
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        entries = {key: entry for key, entry in self.entries.items() if key in self.seen}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def conditional_headers(self, key, headers):
+        """
+        Adds If-None-Match / If-Modified-Since validators for a cached page
+        :param key: Cache key for the page
+        :param headers: Headers for the request
+        :return: New dict of headers
+        """
+        entry = self.entries.get(key)
+        new_headers = dict(headers)
+        if entry is not None:
+            if entry.get("etag") is not None:
+                new_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified") is not None:
+                new_headers["If-Modified-Since"] = entry["last_modified"]
+        return new_headers
+
+    def hit(self, key):
+        """
+        Records an unchanged page and returns its previously parsed value
+        :param key: Cache key for the page
+        :return: Parsed value from the cache
+        """
+        self.seen.add(key)
+        self.pages += 1
+        self.unchanged += 1
+        return self.entries[key]["parsed"]
+
+    def store(self, key, response_headers, body_hash, parsed):
+        """
+        Records a changed page
+        :param key: Cache key for the page
+        :param response_headers: Headers from the http response
+        :param body_hash: Hex digest of the body
+        :param parsed: Parsed value to reuse when the page hasn't changed
+        :return: None
+        """
+        self.seen.add(key)
+        self.pages += 1
+        self.entries[key] = {
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "hash": body_hash,
+            "parsed": parsed
+        }
+
+    def unchanged_ratio(self):
+        """ Fraction of pages this run that were unchanged since the last run """
+        return self.unchanged / self.pages if self.pages > 0 else 0.0
+
+    def summary(self):
+        return f"{self.name} pages unchanged: {self.unchanged}/{self.pages} ({100 * self.unchanged_ratio():.1f}%)"
+
+
+async def cached_get(session, cache, key, url, parse, headers={}, cookies={}, params={}):
+    """
+    Conditional http get, parsing the body only if it has changed since the last run
+    :param session: Aiohttp session
+    :param cache: HttpCache object
+    :param key: Cache key for the page, must identify everything that changes the content (eg. store cookie)
+    :param url: Url for http request
+    :param parse: Function taking the body text and returning a json serializable value
+    :param headers: Headers for http request
+    :param cookies: Cookies for http request
+    :param params: Params for http request
+    :return: (parsed, unchanged) 2-tuple
+    :raises AiohttpException: If the response isn't 200 or a 304 for a cached page
+    """
+    req_headers = cache.conditional_headers(key, headers)
+    async with session.get(url, headers=req_headers, cookies=cookies, params=params) as res:
+        if res.status == 304 and key in cache.entries:
+            return cache.hit(key), True
+
+        body = await res.read()
+        if res.status != 200:
+            raise AiohttpException(Response(res, body, res.headers, None, None), f"get {url}", res.url.host)
+
+        body_hash = hashlib.blake2b(body, digest_size=16).hexdigest()
+        entry = cache.entries.get(key)
+        if entry is not None and entry["hash"] == body_hash:
+            entry["etag"] = res.headers.get("ETag", entry.get("etag"))
+            entry["last_modified"] = res.headers.get("Last-Modified", entry.get("last_modified"))
+            return cache.hit(key), True
+
+        parsed = parse(body.decode(res.get_encoding(), errors="replace"))
+        cache.store(key, res.headers, body_hash, parsed)
+        return parsed, False
 
 
 def get(url, cookies={}, headers={}, params={}):
@@ -357,7 +560,7 @@ def get(url, cookies={}, headers={}, params={}):
     """
 
     async def async_get(u, c, h, p):
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.get(u, cookies=c, headers=h, params=p) as resp:
                 heads, json, body = await Response.build_params(resp)
                 return resp, heads, json, body
@@ -378,7 +581,7 @@ def post(url, payload, cookies={}, headers={}, params={}):
     """
 
     async def async_post(url2, payload2, cookies2, headers2, params2):
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.post(url2, json=payload2, cookies=cookies2, headers=headers2, params=params2) as resp:
                 heads1, json1, body1 = await Response.build_params(resp)
                 return resp, heads1, json1, body1
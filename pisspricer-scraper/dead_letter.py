@@ -0,0 +1,218 @@
+import aiohttp
+import asyncio
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import api
+import custom_requests as req
+import phases
+import tools
+
+DB_FILE = os.getenv("pisspricer.dead_letter_db", os.path.join(os.path.dirname(__file__), "dead_letters.sqlite"))
+MAX_ATTEMPTS = 8
+MAX_AGE = 3 * 24 * 60 * 60
+BACKOFF = 60
+MAX_BACKOFF = 60 * 60
+
+
+def retryable(status):
+    """
+    :param status: Response status code, or the exception name if there was no response
+    :return: True if the upload failed in a way that could succeed if retried
+    """
+    return not isinstance(status, int) or status >= 500 or status in (408, 429)
+
+
+class DeadLetterStore:
+    """
+    Failed pisspricer api uploads, kept in SQLite to be replayed later.
+    There is one row per method and key (the url, unless several uploads share one, eg. posting items), so a newer
+    failed upload of the same price replaces the older one, and a later successful upload of it deletes the row.
+    Failures and successes are buffered in memory and written in one transaction by flush, so recording them doesn't
+    slow down uploads.
+    Rows are replayed with exponential backoff, and dropped after MAX_ATTEMPTS or once older than MAX_AGE.
+    """
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._conn = None
+        self._failed = {}
+        self._succeeded = set()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    method TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    payload TEXT,
+                    status TEXT,
+                    store TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    next_attempt REAL NOT NULL,
+                    PRIMARY KEY (method, key)
+                )""")
+        return self._conn
+
+    def add(self, method, url, payload, status, key=None):
+        """
+        Records a failed upload, if it is worth retrying
+        :param method: Http method
+        :param url: Request url
+        :param payload: Json payload of the request
+        :param status: Response status code, or the exception name if there was no response
+        :param key: Identifies the upload, defaults to the url
+        :return: None
+        """
+        if not retryable(status):
+            return
+        key = (method, str(key or url))
+        with self._lock:
+            self._succeeded.discard(key)
+            self._failed[key] = (str(url), payload, str(status), phases.current_store.get(), time.time())
+
+    def resolve(self, method, url, key=None):
+        """
+        Records a successful upload, superseding any failed upload with the same method and key
+        :param method: Http method
+        :param url: Request url
+        :param key: Identifies the upload, defaults to the url
+        :return: None
+        """
+        key = (method, str(key or url))
+        with self._lock:
+            self._failed.pop(key, None)
+            self._succeeded.add(key)
+
+    def flush(self):
+        """
+        Writes buffered failures and successes
+        :return: Number of failures written
+        """
+        with self._lock:
+            failed, self._failed = self._failed, {}
+            succeeded, self._succeeded = self._succeeded, set()
+        if len(failed) == 0 and len(succeeded) == 0:
+            return 0
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM dead_letters WHERE method = ? AND key = ?", succeeded)
+            conn.executemany("""
+                INSERT INTO dead_letters (method, key, url, payload, status, store, attempts, created, next_attempt)
+                VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT (method, key) DO UPDATE SET
+                    url = excluded.url, payload = excluded.payload, status = excluded.status, store = excluded.store,
+                    attempts = 0, created = excluded.created, next_attempt = excluded.next_attempt""",
+                             [(method, key, url, json.dumps(payload), status, store, created, created)
+                              for (method, key), (url, payload, status, store, created) in failed.items()])
+        return len(failed)
+
+    def pending(self, store=None, due=False):
+        """
+        :param store: Only rows recorded by this store, optional
+        :param due: Only rows due to be replayed
+        :return: List of (method, key, url, payload, attempts) tuples, oldest first
+        """
+        self.flush()
+        query = "SELECT method, key, url, payload, attempts FROM dead_letters WHERE 1 = 1"
+        params = []
+        if store is not None:
+            query += " AND store = ?"
+            params.append(store.lower())
+        if due:
+            query += " AND next_attempt <= ?"
+            params.append(time.time())
+        rows = self._connect().execute(query + " ORDER BY created", params).fetchall()
+        return [(method, key, url, json.loads(payload), attempts) for method, key, url, payload, attempts in rows]
+
+    def drop_expired(self):
+        """
+        Deletes rows that have used up their attempts or are too old to be worth replaying
+        :return: Number of rows deleted
+        """
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM dead_letters WHERE attempts >= ? OR created < ?",
+                                  (MAX_ATTEMPTS, time.time() - MAX_AGE))
+        return cursor.rowcount
+
+    def drain(self, store=None, rounds=1):
+        """
+        Replays due rows. Successful rows are deleted, failed rows are rescheduled with exponential backoff.
+        :param store: Only replay rows recorded by this store, optional
+        :param rounds: Number of passes, waiting for the next row to be due between them
+        :return: (replayed, succeeded) 2-tuple
+        """
+        self.flush()
+        dropped = self.drop_expired()
+        if dropped > 0:
+            print(f"Dropped {dropped} expired dead letters")
+        replayed, succeeded = 0, 0
+        for i in range(rounds):
+            rows = self.pending(store, due=True)
+            if len(rows) == 0:
+                if i + 1 == rounds:
+                    break
+                next_due = self._next_due(store)
+                if next_due is None:
+                    break
+                time.sleep(max(0, next_due - time.time()))
+                continue
+            print(f"Replaying {len(rows)} failed uploads")
+            results = asyncio.run(req.create_async_tasks(rows, {"headers": api.headers}, self._async_replay))
+            replayed += len(results)
+            succeeded += sum(results)
+            self.drop_expired()
+        return replayed, succeeded
+
+    def _next_due(self, store):
+        query = "SELECT MIN(next_attempt) FROM dead_letters"
+        params = []
+        if store is not None:
+            query += " WHERE store = ?"
+            params.append(store.lower())
+        return self._connect().execute(query, params).fetchone()[0]
+
+    async def _async_replay(self, session, method, key, url, payload, attempts, headers={}):
+        """
+        Replays a failed upload, deleting the row if it succeeds and rescheduling it if it doesn't
+        :return: True if the upload succeeded
+        """
+        try:
+            async with session.request(method, url, headers=headers, json=payload) as response:
+                status = response.status
+        except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+            status = type(err).__name__
+        conn = self._connect()
+        with conn:
+            # 409 means the item was created since, which is as good as success
+            if status in (200, 201, 409):
+                conn.execute("DELETE FROM dead_letters WHERE method = ? AND key = ?", (method, key))
+                return True
+            if not retryable(status):
+                conn.execute("DELETE FROM dead_letters WHERE method = ? AND key = ?", (method, key))
+                tools.log_error(f"Giving up on {method}, status {status}", url=url)
+                return False
+            delay = min(BACKOFF * 2 ** attempts, MAX_BACKOFF)
+            conn.execute("UPDATE dead_letters SET attempts = ?, status = ?, next_attempt = ? "
+                         "WHERE method = ? AND key = ?",
+                         (attempts + 1, str(status), time.time() + delay, method, key))
+        if attempts + 1 >= MAX_ATTEMPTS:
+            tools.log_error(f"Giving up on {method} after {attempts + 1} attempts, last status {status}", url=url)
+        return False
+
+    def summary(self):
+        self.flush()
+        rows = self._connect().execute("SELECT store, COUNT(*) FROM dead_letters GROUP BY store").fetchall()
+        return "Dead letters: " + (", ".join(f"{store} {count}" for store, count in rows) or "none")
+
+
+dead_letters = DeadLetterStore()
@@ -0,0 +1,118 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+import phases
+
+LOG_FILE = os.getenv("pisspricer.log_file", "log.jsonl")
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+
+class ErrorLog:
+    """
+    Buffered error log written as json lines by a background thread.
+    Logging an error only appends to an in memory queue, so it never blocks the caller on file io.
+    Identical errors (same store, phase, type and message) logged within a flush interval are written once with a count.
+    The file is rotated to '{path}.1' ... '{path}.{backup_count}' when it grows past max_bytes.
+    """
+
+    def __init__(self, path=LOG_FILE, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self._queue = deque()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def log(self, error, url=None, **context):
+        """
+        Queues an error to be written
+        :param error: Exception or message
+        :param url: Url being processed when the error occurred
+        :param context: Any other json serializable context
+        :return: None
+        """
+        self._queue.append((time.time(), phases.current_store.get(), phases.current_phase.get(), url, error, context))
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="error_log", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        Stops the writer thread and writes any queued errors
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._stop.clear()
+
+    def flush(self):
+        """
+        Writes all queued errors, combining identical ones
+        :return: None
+        """
+        records = {}
+        while len(self._queue) > 0:
+            timestamp, store, phase, url, error, context = self._queue.popleft()
+            error_type = type(error).__name__ if isinstance(error, BaseException) else None
+            message = str(error)
+            key = (store, phase, error_type, message)
+            if key in records:
+                records[key]["count"] += 1
+                records[key]["last"] = _format_time(timestamp)
+            else:
+                records[key] = {
+                    "time": _format_time(timestamp),
+                    "last": _format_time(timestamp),
+                    "store": store,
+                    "phase": phase,
+                    "url": url,
+                    "type": error_type,
+                    "message": message,
+                    "count": 1,
+                    **context
+                }
+        if len(records) == 0:
+            return
+
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records.values())
+        self._rotate(len(lines))
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+    def _rotate(self, incoming):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size + incoming <= self.max_bytes:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+def _format_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp))
+
+
+error_log = ErrorLog()
@@ -0,0 +1,232 @@
+import os
+import shutil
+import time
+import numpy as np
+from PIL import Image
+import metrics
+
+INDEX_DIR = os.getenv("pisspricer.image_index_dir", os.path.join(os.path.dirname(__file__), "image_index"))
+
+# Side of the grayscale thumbnail hashed. Bottles are similar shapes, so this is larger than the usual 8 to tell
+# labels apart, giving HASH_SIZE * HASH_SIZE bit hashes
+HASH_SIZE = 16
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+
+# Side of the colour thumbnail compared along with the hash, which only sees brightness edges
+COLOUR_SIZE = 4
+COLOUR_BYTES = COLOUR_SIZE * COLOUR_SIZE * 3
+FINGERPRINT_BYTES = HASH_BYTES + COLOUR_BYTES
+
+# Largest number of differing hash bits for two images to count as the same photo, out of 256
+THRESHOLD = int(os.getenv("pisspricer.image_hash_threshold", 2))
+
+# Largest difference of any colour thumbnail channel for two images to count as the same photo
+COLOUR_TOLERANCE = 8
+
+# Side of the colour thumbnail a match is checked against before its derivatives are reused. The hash doesn't see
+# small label differences, so pack size and flavour variants must also be this close to get each other's photo, which
+# only copies of one photo at the same size are
+DETAIL_SIZE = 64
+DETAIL_TOLERANCE = 16
+DETAIL_FILE = "detail.rgb"
+
+# Most images kept in the index, the least recently used are deleted when it is loaded
+MAX_IMAGES = int(os.getenv("pisspricer.image_index_size", 20000))
+
+# Age in seconds of a temporary image directory after which it is taken to be abandoned, eg. by a crashed process
+TMP_SECONDS = 60 * 60
+
+EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+
+# Number of set bits in each byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+dedupe = metrics.registry.counter("pisspricer_image_dedupe_total",
+                                  "Processed images, by whether the derivatives of a matching image were reused")
+
+
+def _on_white(image):
+    """
+    :param image: PIL.Image object
+    :return: RGB PIL.Image with transparent areas made white
+    """
+    if image.mode in ("RGBA", "LA", "P"):
+        rgba = image.convert("RGBA")
+        image = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        image.alpha_composite(rgba)
+    return image.convert("RGB")
+
+
+def fingerprint(image):
+    """
+    Perceptual fingerprint of an image: a difference hash, whether each pixel of a 17x16 grayscale thumbnail is
+    brighter than the one on its left, followed by the pixels of a 4x4 colour thumbnail. Transparent areas are treated
+    as white, so a photo on a transparent background matches the same photo on white.
+    :param image: PIL.Image object
+    :return: Fingerprint bytes, HASH_BYTES of hash then COLOUR_BYTES of colours
+    """
+    image = _on_white(image)
+
+    small = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = small[:, 1:] > small[:, :-1]
+    colours = np.asarray(image.resize((COLOUR_SIZE, COLOUR_SIZE), Image.BOX), dtype=np.uint8)
+    return np.packbits(bits).tobytes() + colours.tobytes()
+
+
+def detail(image):
+    """
+    :param image: PIL.Image object
+    :return: Bytes of the pixels of a DETAIL_SIZE colour thumbnail, with transparent areas white
+    """
+    return _on_white(image).resize((DETAIL_SIZE, DETAIL_SIZE), Image.BOX).tobytes()
+
+
+class ImageIndex:
+    """
+    Fingerprints of processed images, with their derivatives, so the same photo served from another url or for
+    another sku is reused instead of processed and encoded again. Fingerprints find a candidate match quickly, which
+    is then checked against a detailed thumbnail, so only near exact copies are reused.
+    Each image's derivatives are kept in a directory named by its fingerprint under INDEX_DIR, which is the whole
+    index, so it persists between runs and can be shared by processes. Directories are written under a temporary name
+    and renamed, so a partly written image is never reused. A directory's modified time is when the image was last
+    added or reused, and only the most recently used max_images are kept.
+    """
+
+    def __init__(self, path=INDEX_DIR, threshold=THRESHOLD, colour_tolerance=COLOUR_TOLERANCE, max_images=MAX_IMAGES):
+        """
+        :param path: Directory of the index
+        :param threshold: Largest number of differing hash bits for images to match
+        :param colour_tolerance: Largest colour thumbnail difference for images to match
+        :param max_images: Most images kept in the index
+        """
+        self.path = path
+        self.threshold = threshold
+        self.colour_tolerance = colour_tolerance
+        self.max_images = max_images
+        # Fingerprints are appended to a buffer grown by doubling, the first _count rows are in use
+        self._buffer = np.zeros((0, FINGERPRINT_BYTES), dtype=np.uint8)
+        self._count = 0
+
+    @property
+    def fingerprints(self):
+        """ Array of the fingerprints in the index, one row each """
+        return self._buffer[:self._count]
+
+    def load(self):
+        """
+        Prunes the index directory, then loads the fingerprints of its images
+        :return: self
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._prune()
+        names = [name for name in os.listdir(self.path) if len(name) == 2 * FINGERPRINT_BYTES]
+        fingerprints = np.frombuffer(b"".join(bytes.fromhex(name) for name in names), dtype=np.uint8)
+        self._buffer = fingerprints.reshape(-1, FINGERPRINT_BYTES)
+        self._count = len(self._buffer)
+        return self
+
+    def _prune(self):
+        """
+        Deletes the least recently used images beyond max_images, and temporary directories that were abandoned
+        :return: None
+        """
+        now = time.time()
+        images = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                modified = os.stat(path).st_mtime
+            except FileNotFoundError:
+                # Deleted by another process
+                continue
+            if name.endswith(".tmp"):
+                if now - modified > TMP_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            elif len(name) == 2 * FINGERPRINT_BYTES:
+                images.append((modified, path))
+        images.sort(reverse=True)
+        for _, path in images[self.max_images:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _append(self, image_fingerprint):
+        if self._count == len(self._buffer):
+            buffer = np.zeros((max(64, 2 * len(self._buffer)), FINGERPRINT_BYTES), dtype=np.uint8)
+            buffer[:self._count] = self._buffer[:self._count]
+            self._buffer = buffer
+        self._buffer[self._count] = np.frombuffer(image_fingerprint, dtype=np.uint8)
+        self._count += 1
+
+    def _dir(self, image_fingerprint):
+        return os.path.join(self.path, image_fingerprint.hex())
+
+    def find(self, image_fingerprint):
+        """
+        :param image_fingerprint: Fingerprint from fingerprint()
+        :return: Fingerprint of the closest matching image in the index, None if there isn't one
+        """
+        fingerprints = self.fingerprints
+        if len(fingerprints) == 0:
+            return None
+        query = np.frombuffer(image_fingerprint, dtype=np.uint8)
+        distances = _POPCOUNT[fingerprints[:, :HASH_BYTES] ^ query[:HASH_BYTES]].sum(axis=1, dtype=np.int32)
+        colour_differences = np.abs(fingerprints[:, HASH_BYTES:].astype(np.int16) - query[HASH_BYTES:]).max(axis=1)
+        distances[colour_differences > self.colour_tolerance] = HASH_BYTES * 8 + 1
+        closest = int(np.argmin(distances))
+        if distances[closest] > self.threshold:
+            return None
+        return fingerprints[closest].tobytes()
+
+    def get(self, image_fingerprint, image_detail, sizes, formats):
+        """
+        Gets the derivatives of a matching image
+        :param image_fingerprint: Fingerprint from fingerprint()
+        :param image_detail: Thumbnail from detail()
+        :param sizes: Derivative size names needed
+        :param formats: Derivative formats needed
+        :return: Dict of (size name, format) 2-tuples to image bytes, None if there is no match with every derivative
+        """
+        match = self.find(image_fingerprint)
+        if match is None:
+            dedupe.inc(result="miss")
+            return None
+        derivatives = {}
+        try:
+            with open(os.path.join(self._dir(match), DETAIL_FILE), "rb") as f:
+                match_detail = np.frombuffer(f.read(), dtype=np.uint8)
+            query_detail = np.frombuffer(image_detail, dtype=np.uint8)
+            if len(match_detail) != len(query_detail) or \
+                    np.abs(match_detail.astype(np.int16) - query_detail).max() > DETAIL_TOLERANCE:
+                dedupe.inc(result="miss")
+                return None
+            for name in sizes:
+                for image_format in formats:
+                    with open(os.path.join(self._dir(match), f"{name}.{EXTENSIONS[image_format]}"), "rb") as f:
+                        derivatives[(name, image_format)] = f.read()
+            # Mark the image used, so it isn't pruned
+            os.utime(self._dir(match))
+        except OSError:
+            dedupe.inc(result="miss")
+            return None
+        dedupe.inc(result="hit")
+        return derivatives
+
+    def add(self, image_fingerprint, image_detail, derivatives):
+        """
+        Adds an image's derivatives to the index, replacing any with the same fingerprint
+        :param image_fingerprint: Fingerprint from fingerprint()
+        :param image_detail: Thumbnail from detail()
+        :param derivatives: Dict of (size name, format) 2-tuples to image bytes, from images.process_image
+        :return: None
+        """
+        path = self._dir(image_fingerprint)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        with open(os.path.join(tmp_path, DETAIL_FILE), "wb") as f:
+            f.write(image_detail)
+        for (name, image_format), image in derivatives.items():
+            with open(os.path.join(tmp_path, f"{name}.{EXTENSIONS[image_format]}"), "wb") as f:
+                f.write(image)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        if self.find(image_fingerprint) != image_fingerprint:
+            self._append(image_fingerprint)
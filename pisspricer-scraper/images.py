@@ -1,7 +1,37 @@
 from PIL import Image, ImageChops, ImageOps
 from io import BytesIO
+import os
 import requests
 import copy
+from custom_exceptions import ImageTooLargeException
+
+
+def _parse_sizes(spec):
+    """
+    :param spec: Comma separated name:longest side pairs, eg. "thumbnail:150,list:400,full:800"
+    :return: Dict of derivative names to longest sides
+    """
+    sizes = {}
+    for part in spec.split(","):
+        name, size = part.split(":")
+        sizes[name.strip()] = int(size)
+    return sizes
+
+
+# Derivatives made of every image, by name. The largest is the item's main image
+SIZES = _parse_sizes(os.getenv("pisspricer.image_sizes", "thumbnail:150,list:400,full:800"))
+MAIN_SIZE = max(SIZES, key=SIZES.get)
+
+# Formats each derivative is encoded in, jpeg and optionally webp
+FORMATS = os.getenv("pisspricer.image_formats", "jpeg").split(",")
+CONTENT_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+ENCODE_OPTIONS = {"jpeg": {"format": "JPEG"}, "webp": {"format": "WEBP", "quality": 80, "method": 4}}
+
+# Longest side of decoded images, larger sources are scaled down when they are decoded
+MAX_SIZE = SIZES[MAIN_SIZE]
+
+# Largest source image decoded, in pixels, so a small file can't expand into gigabytes of pixels
+MAX_PIXELS = 40000000
 
 
 def trim(im, border):
@@ -22,10 +52,30 @@ def process_response_content(content):
     """
     Processes a response content
     :param content: Content from a response
-    :return: Image content
+    :return: Dict of (size name, format) 2-tuples to image bytes, see process_image
+    """
+    return process_image(open_image(content))
+
+
+def open_image(content, max_size=MAX_SIZE, max_pixels=MAX_PIXELS):
+    """
+    Decodes an image, scaled down to fit in max_size x max_size.
+    Jpegs are decoded at a reduced scale (draft mode) when they are at least twice max_size, and other formats are
+    reduced by an integer factor before resampling, so oversized sources are never resampled at full size.
+    :param content: Image file bytes
+    :param max_size: Longest side of the decoded image
+    :param max_pixels: Largest number of pixels in the source image
+    :return: PIL.Image
     """
     image = Image.open(BytesIO(content))
-    return process_image(image)
+
+    # Only the header has been read so far, check the size before decoding any pixels
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLargeException(width, height, max_pixels)
+
+    image.thumbnail((max_size, max_size), reducing_gap=2.0)
+    return image
 
 
 def remove_background_jpeg(pixel_list, width, height, tolerance=100):
@@ -173,38 +223,70 @@ def remove_background_png(pixel_list, width, height, tolerance=40):
     return box, new_pixels
 
 
-def process_image(image):
+def process_image(image, sizes=None, formats=None):
     """
-    Processes an item image: Removes the background, and crops to the sides of the item
+    Processes an item image: Removes the background, crops to the sides of the item, then scales and encodes the
+    cropped image once for each derivative size and format
     :param image: PIL.Image object
-    :return: PIL.Image
+    :param sizes: Dict of derivative names to longest sides, default SIZES
+    :param formats: List of formats to encode, default FORMATS
+    :return: Dict of (size name, format) 2-tuples to image bytes
+    """
+    if sizes is None:
+        sizes = SIZES
+    if formats is None:
+        formats = FORMATS
+
+    img = remove_background(image)
+
+    derivatives = {}
+    for name, size in sizes.items():
+        resized = img
+        if max(img.size) > size:
+            resized = img.copy()
+            resized.thumbnail((size, size))
+        for image_format in formats:
+            img_byte_arr = BytesIO()
+            resized.save(img_byte_arr, **ENCODE_OPTIONS[image_format])
+            derivatives[(name, image_format)] = img_byte_arr.getvalue()
+    return derivatives
+
+
+def remove_background(image):
+    """
+    Sets the white or transparent background of an item image to white, and crops to the sides of the item
+    :param image: PIL.Image object
+    :return: PIL.Image in RGB mode
     """
     # Get image details
     width, height = image.size
 
-    # Convert to RBG, then convert to list of pixels
-    img_rbga = image.convert("RGBA")
-    img = image.convert("RGB")
-    pixel_list = list(img_rbga.getdata())
+    # Convert to RBGA once, then convert to list of pixels
+    pixel_list = list(image.convert("RGBA").getdata())
 
     # Remove image background
     box, new_pixels = remove_background_png(pixel_list, width, height)
 
-    # Set data for image
+    # Set data for image. Every pixel is replaced, so the image doesn't need converting to RGB
+    img = Image.new("RGB", (width, height))
     img.putdata(new_pixels)
 
     # Crop image
-    img = img.crop(box)
+    return img.crop(box)
 
-    # img.show()
 
-    # Image bytes
-    img_byte_arr = BytesIO()
-    img.save(img_byte_arr, format='JPEG')
-    img_byte_arr = img_byte_arr.getvalue()
-
-    # img_byte = bytearray(img)
-    return img_byte_arr
+def uploads(sku, derivatives):
+    """
+    :param sku: Item sku
+    :param derivatives: Dict of (size name, format) 2-tuples to image bytes, from process_image
+    :return: List of (path, content type, image bytes) 3-tuples. Paths are under /items, '{sku}/image' for the main
+        size jpeg and '{sku}/image/{size name}' for the others
+    """
+    image_uploads = []
+    for (name, image_format), image in derivatives.items():
+        path = f"{sku}/image" if (name, image_format) == (MAIN_SIZE, "jpeg") else f"{sku}/image/{name}"
+        image_uploads.append((path, CONTENT_TYPES[image_format], image))
+    return image_uploads
 
 
 if __name__ == '__main__':
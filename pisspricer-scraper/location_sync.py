@@ -0,0 +1,217 @@
+import aiohttp
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import custom_exceptions
+import custom_requests as req
+import phases
+import reference_data
+import tools
+from dead_letter import dead_letters
+from regions import RegionResolver
+
+GEOCODE_CONCURRENCY = 8
+POST_CONCURRENCY = 10
+
+
+class LocationSync:
+    """
+    Adds a brand's new store locations to pisspricer, in stages:
+        get stores       - Internal ids of the brand's stores already in pisspricer
+        diff             - Locations with internal ids not in pisspricer
+        geocode          - Geocodes new locations with incomplete address data, GEOCODE_CONCURRENCY at a time
+        post stores      - Resolves the region id of each new location, creating missing regions, and posts the new
+                           stores, POST_CONCURRENCY at a time
+    Each stage is timed as a phase of the store's run.
+    """
+
+    def __init__(self, api, store, brand_id, print_func=None):
+        """
+        :param api: Pisspricer api module
+        :param store: Store name
+        :param brand_id: Brand id of the store locations
+        :param print_func: Progress print function, optional
+        """
+        self.api = api
+        self.store = store
+        self.brand_id = brand_id
+        self.print_func = print_func
+        self.timings = {}
+        self.counts = {}
+
+    @contextmanager
+    def _stage(self, name):
+        start = time.monotonic()
+        with phases.phase(self.store, f"locations {name}"):
+            yield
+        self.timings[name] = time.monotonic() - start
+
+    def _progress(self, iteration, total, task):
+        if self.print_func is not None:
+            self.print_func(iteration, total, task)
+
+    def run(self, locations):
+        """
+        Syncs locations with pisspricer
+        :param locations: List of dict objects
+            {
+                name: "required|string",
+                url: "required|string",
+                region: "required|string",
+                region_lat: "numeric",
+                region_lng: "numeric",
+                address: "required|string",
+                postcode: "numeric",
+                lattitude: "numeric",
+                longitude: "numeric"
+                internalId: "string"
+            }
+        :return: Number of stores posted
+        """
+        with self._stage("get stores"):
+            existing = self._get_existing()
+        with self._stage("diff"):
+            new_locations = self._diff(locations, existing)
+        with self._stage("geocode"):
+            new_locations = self._geocode(new_locations)
+        with self._stage("post stores"):
+            posted = self._post_stores(new_locations)
+
+        self.counts = {"locations": len(locations), "new": len(new_locations), "posted": posted}
+        print(self.summary())
+        return posted
+
+    def summary(self):
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.timings.items())
+        return f"{self.store} locations: {self.counts.get('new', 0)} new of {self.counts.get('locations', 0)}, " \
+               f"{self.counts.get('posted', 0)} posted ({stages})"
+
+    def _get_existing(self):
+        """
+        :return: Set of internal ids of the brand's stores in pisspricer
+        """
+        return {str(store["internalId"]) for store in reference_data.get_stores(self.api, self.brand_id)}
+
+    @staticmethod
+    def _diff(locations, existing):
+        """
+        :param locations: List of location dicts
+        :param existing: Set of internal ids in pisspricer
+        :return: Locations with new internal ids, the first of any with the same internal id
+        """
+        new_locations = []
+        seen = set(existing)
+        for loc in locations:
+            internal_id = str(loc["internalId"])
+            if internal_id not in seen:
+                seen.add(internal_id)
+                new_locations.append(loc)
+        return new_locations
+
+    def _geocode(self, locations):
+        """
+        Fills in the address data of locations missing any of it from the google geocoding api.
+        Locations that fail to geocode are logged and dropped.
+        :param locations: List of location dicts
+        :return: List of complete location dicts
+        """
+        fields = ("region", "lattitude", "longitude", "postcode", "address")
+        complete = [loc for loc in locations if all(loc[field] is not None for field in fields)]
+        todo = [loc for loc in locations if any(loc[field] is None for field in fields)]
+        if len(todo) == 0:
+            return complete
+
+        iteration = [0]
+
+        def geocode(loc):
+            try:
+                lat, lng, address, postcode, region = tools.geocode_address(f"{loc['name']}, {loc['address']}")
+                return {**loc, "lattitude": lat, "longitude": lng, "address": address, "postcode": postcode,
+                        "region": region}
+            except custom_exceptions.ApiException as err:
+                tools.log_error(err, internalId=loc["internalId"])
+                return None
+            finally:
+                iteration[0] += 1
+                self._progress(iteration[0], len(todo), f"{self.store} geocode locations")
+
+        self._progress(0, len(todo), f"{self.store} geocode locations")
+        with ThreadPoolExecutor(GEOCODE_CONCURRENCY) as executor:
+            geocoded = list(executor.map(geocode, todo))
+        return complete + [loc for loc in geocoded if loc is not None]
+
+    def _store_payload(self, loc, region_id):
+        """
+        :param loc: Complete location dict
+        :param region_id: Pisspricer region id of the location
+        :return: Store payload for pisspricer api
+        """
+        return {
+            "name": loc["name"],
+            "url": loc["url"],
+            "brandId": self.brand_id,
+            "regionId": region_id,
+            "lattitude": loc["lattitude"],
+            "longitude": loc["longitude"],
+            "postcode": loc["postcode"],
+            "address": loc["address"],
+            "internalId": str(loc["internalId"])
+        }
+
+    def _post_stores(self, locations):
+        """
+        Posts new stores, resolving their regions as they are posted. Stores in a missing region share one post of
+        the region. Failures are logged, and failed store posts are kept as dead letters to retry.
+        :param locations: List of complete location dicts
+        :return: Number of stores posted
+        """
+        if len(locations) == 0:
+            return 0
+        regions = RegionResolver(self.api).load()
+        url = self.api.url + "/stores"
+        iteration = [0]
+        self._progress(0, len(locations), f"{self.store} post stores")
+
+        async def post_all():
+            async with req.client_session(connector=aiohttp.TCPConnector(limit=POST_CONCURRENCY)) as session:
+                return await asyncio.gather(*[post(session, loc) for loc in locations])
+
+        async def post(session, loc):
+            try:
+                region_id = await regions.async_get_id(session, loc["region"], lat=loc.get("region_lat"),
+                                                       lng=loc.get("region_lng"), headers=self.api.headers)
+            except (custom_exceptions.AiohttpException, asyncio.TimeoutError, aiohttp.ClientError) as err:
+                iteration[0] += 1
+                self._progress(iteration[0], len(locations), f"{self.store} post stores")
+                tools.log_error(err, internalId=loc["internalId"])
+                return False
+            store = self._store_payload(loc, region_id)
+            try:
+                async with session.post(url, headers=self.api.headers, json=store) as response:
+                    status = response.status
+            except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+                status = type(err).__name__
+            iteration[0] += 1
+            self._progress(iteration[0], len(locations), f"{self.store} post stores")
+            if status != 201:
+                tools.log_error(f"Posting store failed, status {status}", url=url, internalId=store["internalId"])
+                dead_letters.add("POST", url, store, status, key=f"{url}#{store['internalId']}")
+            return status == 201
+
+        posted = sum(asyncio.run(post_all()))
+        dead_letters.flush()
+        return posted
+
+
+def sync_locations(api, store, brand_id, locations, print_func=None):
+    """
+    Adds new store locations to pisspricer, see LocationSync
+    :param api: Pisspricer api module
+    :param store: Store name
+    :param brand_id: Brand id of the store locations
+    :param locations: List of location dicts
+    :param print_func: Progress print function, optional
+    :return: Number of stores posted
+    """
+    return LocationSync(api, store, brand_id, print_func).run(locations)
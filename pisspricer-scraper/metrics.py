@@ -0,0 +1,248 @@
+import json
+import math
+import os
+import threading
+import time
+import aiohttp
+from yarl import URL
+
+METRICS_DIR = os.getenv("pisspricer.metrics_dir", os.path.join(os.path.dirname(__file__), "metrics"))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Images are processed on a worker thread while prices are put, so updates are locked
+_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key):
+    if len(label_key) == 0:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in label_key]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """ Monotonic count, one value per set of labels """
+
+    TYPE = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self):
+        """
+        Prometheus samples for the metric
+        :return: List of (name, label_key, value) tuples
+        """
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+    def snapshot(self):
+        return [{"labels": dict(key), "value": value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """ Value that can be set, one value per set of labels """
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram:
+    """ Bucketed counts of observed values, one histogram per set of labels """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            if key not in self.values:
+                self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            hist = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist["counts"][i] += 1
+                    break
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def samples(self):
+        samples = []
+        for key, hist in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, hist["counts"]):
+                cumulative += count
+                samples.append((self.name + "_bucket", key + (("le", _format_value(bound)),), cumulative))
+            samples.append((self.name + "_sum", key, hist["sum"]))
+            samples.append((self.name + "_count", key, hist["count"]))
+        return samples
+
+    def snapshot(self):
+        return [{"labels": dict(key),
+                 "buckets": {_format_value(b): c for b, c in zip(self.buckets, hist["counts"])},
+                 "sum": hist["sum"],
+                 "count": hist["count"]}
+                for key, hist in self.values.items()]
+
+
+class Registry:
+    """ Collection of named metrics for a run """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, description, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, description, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, description):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, description, buckets=buckets)
+
+    def to_prometheus(self):
+        """
+        Renders all metrics in the Prometheus text exposition format
+        :return: String
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        return {name: {"type": metric.TYPE, "help": metric.description, "values": metric.snapshot()}
+                for name, metric in self.metrics.items()}
+
+    def write(self, metrics_dir=METRICS_DIR):
+        """
+        Writes a Prometheus textfile and JSON snapshot of all metrics.
+        Files are written then renamed so node-exporter never reads a partial file.
+        :param metrics_dir: Directory to write 'pisspricer.prom' and 'pisspricer.json' to
+        :return: None
+        """
+        os.makedirs(metrics_dir, exist_ok=True)
+        for file_name, content in (("pisspricer.prom", self.to_prometheus()),
+                                   ("pisspricer.json", json.dumps(self.to_json(), indent=1))):
+            path = os.path.join(metrics_dir, file_name)
+            with open(path + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+
+registry = Registry()
+
+http_requests = registry.counter("pisspricer_http_requests_total",
+                                 "Http requests made, by host, method and status")
+http_latency = registry.histogram("pisspricer_http_request_duration_seconds",
+                                  "Time from sending a request to receiving the response headers, by host")
+http_coalesced = registry.counter("pisspricer_http_requests_coalesced_total",
+                                  "Http gets that shared an identical in-flight request instead of making their own")
+http_bytes = registry.counter("pisspricer_http_response_bytes_total",
+                              "Response body bytes received, by host")
+items_parsed = registry.counter("pisspricer_items_parsed_total",
+                                "Items parsed from store websites, by store")
+items_uploaded = registry.counter("pisspricer_items_uploaded_total",
+                                  "Items uploaded to the pisspricer api, by store, kind and result")
+images_processed = registry.counter("pisspricer_images_processed_total",
+                                    "Item images processed, by result")
+phase_duration = registry.gauge("pisspricer_phase_duration_seconds",
+                                "Duration of the last run of each phase, by store and phase")
+run_success = registry.gauge("pisspricer_run_success",
+                             "1 if the last run of the store succeeded, 0 if it failed")
+run_timestamp = registry.gauge("pisspricer_run_timestamp_seconds",
+                               "Unix time the last run of the store finished")
+
+
+def record_run(store, success):
+    """
+    Records the result of a store run
+    :param store: Store name
+    :param success: True if the run completed
+    :return: None
+    """
+    run_success.set(1 if success else 0, store=store.lower())
+    run_timestamp.set(time.time(), store=store.lower())
+
+
+def _host(url):
+    return URL(str(url)).host or ""
+
+
+async def _on_request_start(session, ctx, params):
+    ctx.start = time.monotonic()
+
+
+async def _on_request_end(session, ctx, params):
+    host = _host(params.url)
+    http_requests.inc(host=host, method=params.method, status=params.response.status)
+    http_latency.observe(time.monotonic() - ctx.start, host=host)
+
+
+async def _on_request_exception(session, ctx, params):
+    http_requests.inc(host=_host(params.url), method=params.method, status=type(params.exception).__name__)
+
+
+async def _on_response_chunk_received(session, ctx, params):
+    http_bytes.inc(len(params.chunk), host=_host(params.url))
+
+
+def trace_config():
+    """
+    Creates an aiohttp TraceConfig that records http metrics for a session
+    :return: aiohttp.TraceConfig
+    """
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(_on_request_start)
+    config.on_request_end.append(_on_request_end)
+    config.on_request_exception.append(_on_request_exception)
+    config.on_response_chunk_received.append(_on_response_chunk_received)
+    return config
+
+
+def record_requests_response(res, *args, **kwargs):
+    """
+    Records metrics for a response from the requests library. Used as a requests response hook.
+    :param res: requests.Response object
+    :return: None
+    """
+    host = _host(res.url)
+    http_requests.inc(host=host, method=res.request.method, status=res.status_code)
+    http_latency.observe(res.elapsed.total_seconds(), host=host)
+    http_bytes.inc(len(res.content), host=host)
+
@@ -0,0 +1,50 @@
+import asyncio
+import collections
+import custom_requests as req
+
+
+def _no_items(page):
+    return len(page) == 0
+
+
+async def paginate(fetch_page, page_count=None, start=0, stop=None, prefetch=None, is_empty=_no_items):
+    """
+    Gets every page of a paginated listing, as an async stream of parsed pages in page order.
+    Unless stop is given, the first page is fetched alone and page_count works out the number of pages from it. The
+    rest are prefetched up to prefetch pages ahead of the one being consumed, sharing the connection limit of the
+    session fetch_page uses. The stream ends after the first empty page, cancelling any pages fetched past it.
+    :param fetch_page: Function taking a page number and returning a coroutine that gets and parses the page
+    :param page_count: Function taking the parsed first page and returning the number of pages, counted from start
+    :param start: First page number
+    :param stop: Page number after the last page, if it is already known
+    :param prefetch: Most pages fetched at once, defaults to the connection limit of sessions
+    :param is_empty: Function taking a parsed page and returning True if it has no items
+    :return: Async generator of (page number, parsed page) 2-tuples
+    """
+    if prefetch is None:
+        prefetch = req.concurrency
+
+    next_page = start
+    if stop is None:
+        first = await fetch_page(start)
+        yield start, first
+        if is_empty(first):
+            return
+        stop = start + page_count(first)
+        next_page += 1
+
+    pending = collections.deque()
+    try:
+        while next_page < stop or len(pending) > 0:
+            while next_page < stop and len(pending) < prefetch:
+                pending.append((next_page, asyncio.ensure_future(fetch_page(next_page))))
+                next_page += 1
+            page, task = pending.popleft()
+            parsed = await task
+            yield page, parsed
+            if is_empty(parsed):
+                return
+    finally:
+        for _, task in pending:
+            task.cancel()
+        await asyncio.gather(*[task for _, task in pending], return_exceptions=True)
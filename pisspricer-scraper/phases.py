@@ -0,0 +1,32 @@
+import contextvars
+import time
+from contextlib import contextmanager, nullcontext
+import metrics
+import profiling
+import tracing
+
+current_store = contextvars.ContextVar("current_store", default=None)
+current_phase = contextvars.ContextVar("current_phase", default=None)
+
+
+@contextmanager
+def phase(store, name):
+    """
+    Context manager for a phase of a store run. Records how long the phase took,
+    a span when tracing, and a cpu/memory profile when profiling. The store and phase are available to error logging through current_store and current_phase.
+    :param store: Store name
+    :param name: Phase name
+    :return: None
+    """
+    labels = {"store": store.lower(), "phase": name}
+    store_token = current_store.set(labels["store"])
+    phase_token = current_phase.set(name)
+    start = time.monotonic()
+    try:
+        with tracing.span(f"{store} {name}", **labels):
+            with profiling.profile(store, name) if profiling.enabled else nullcontext():
+                yield
+    finally:
+        current_phase.reset(phase_token)
+        current_store.reset(store_token)
+        metrics.phase_duration.set(time.monotonic() - start, **labels)
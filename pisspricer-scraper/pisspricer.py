@@ -1,9 +1,23 @@
 import aiohttp
 import asyncio
+import concurrent.futures
+import copy
 import custom_exceptions
 import custom_requests as req
 import tools
 import images
+import image_hashes
+import reference_data
+import metrics
+import phases
+import profiling
+import tracing
+from checkpoint import NoCheckpoint
+from dead_letter import dead_letters
+
+
+def _no_progress(iteration, total, task=None):
+    """ Print function for work running alongside another task's progress """
 
 
 class Pisspricer:
@@ -11,102 +25,6 @@ class Pisspricer:
     def __init__(self, api):
         self.api = api
 
-    def upload_new_stores(self, locations, brand_id, printer=None):
-        """
-        Posts stores to pisspricer api that are new (based on internal id).
-        Gets data from google maps api if location data is incomplete.
-        Uploads region if it doesn't already exist.
-        :param printer: (print_function, total, title) for printing
-        :param brand_id: Brand id of store locations
-        :param locations: List of dict objects
-            {
-                name: "required|string",
-                url: "required|string",
-                region: "required|string",
-                region_lat: "numeric",
-                region_lng: "numeric",
-                address: "required|string",
-                postcode: "numeric",
-                lattitude: "numeric",
-                longitude: "numeric"
-                internalId: "string"
-            }
-        :return: None
-        """
-        # Get current locations
-        cur_locations_res = req.get(self.api.url + "/stores",
-                                    headers=self.api.headers,
-                                    params={"brandId": brand_id})
-        if cur_locations_res.status != 200:
-            raise custom_exceptions.AiohttpException(cur_locations_res, "get stores", "pisspricer")
-        cur_locations = cur_locations_res.json()
-
-        # Create a set of internal ids
-        cur_locs_set = set()
-        for loc in cur_locations:
-            cur_locs_set.add(loc["internalId"])
-
-        # Get a list of regions
-        regions = self.get_regions()
-
-        # Print first iteration
-        if printer is not None:
-            print_func, total, task = printer
-            print_func(0, total, task)
-
-        # Create a list of new stores
-        new_locations = []
-        for i, loc in enumerate(locations):
-            try:
-                # Check if the store is new
-                if loc["internalId"] not in cur_locs_set:
-
-                    # Get location if data not supplied
-                    region = loc["region"]
-                    lat = loc["lattitude"]
-                    lng = loc["longitude"]
-                    postcode = loc["postcode"]
-                    address = loc["address"]
-                    location_list = [region, lat, lng, postcode, address]
-                    if any(item is None for item in location_list):
-                        lat, lng, address, postcode, region = tools.geocode_address(f"{loc['name']}, {address}")
-
-                    # Create new location dict
-                    new_loc = {
-                        "name": loc["name"],
-                        "url": loc["url"],
-                        "brandId": brand_id,
-                        "regionId": self._get_region_id(regions, region, lat=loc["region_lat"], lng=loc["region_lng"]),
-                        "lattitude": lat,
-                        "longitude": lng,
-                        "postcode": postcode,
-                        "address": address,
-                        "internalId": loc["internalId"]
-                    }
-
-                    # Add new store to task list
-                    new_locations.append([self.api.url + "/stores", new_loc])
-
-            except custom_exceptions.GoogleApiException as err:
-                tools.log_error(err)
-            except custom_exceptions.AiohttpException as err:
-                tools.log_error(err)
-            finally:
-                if printer is not None:
-                    print_func(i+1, total, task)
-
-        # Post all stores
-        # TODO Change post function
-        iteration = [0]
-        print_func, _, task = printer
-        kwargs = {"headers": self.api.headers,
-                  "printer": (print_func, len(new_locations), task),
-                  "iteration": iteration}
-        responses = asyncio.run(req.create_async_tasks(new_locations, kwargs, self._async_post_json))
-        for res in responses:
-            if res.status != 201:
-                tools.log_error(custom_exceptions.AiohttpException(res, "post stores", "pisspricer"))
-
     @staticmethod
     async def _async_post_json(session, url, payload, headers={}, cookies={}, params={}, printer=None, iteration=None):
         """
@@ -146,6 +64,10 @@ class Pisspricer:
                 iteration[0] += 1
                 print_func, total, task = printer
                 print_func(iteration[0], total, task)
+            if 200 <= response.status <= 299:
+                dead_letters.resolve("PUT", url)
+            else:
+                dead_letters.add("PUT", url, payload, response.status)
             heads1, json1, body1 = None, None, None
             return req.Response(response, payload, heads1, json1, body1)
 
@@ -161,68 +83,12 @@ class Pisspricer:
         :param iteration: List with single integer for counting current iteration
         :return: Custom response object
         """
-        async with session.get(url, headers=headers, cookies=cookies, params=params) as response:
-            if printer is not None and iteration is not None:
-                iteration[0] += 1
-                print_func, total, task = printer
-                print_func(iteration[0], total, task)
-            image = await response.read()
-            return item, req.Response(response, None, None, None, None, read=image)
-
-    def _get_region_id(self, regions, region_name, lat=None, lng=None):
-        """
-        Gets the id of an existing region, or creates a region if it doesn't exist.
-        :param regions: List of regions from pisspricer api
-        :param region_name: Name of region as a string
-        :return: Region id integer
-        """
-        region_id = None
-        for region in regions:
-            if region["name"] == region_name.capitalize():
-                region_id = region["regionId"]
-                break
-
-        if region_id is None:
-
-            # Post new region
-            payload = {"name": region_name.capitalize()}
-            if lat is not None:
-                payload["lattitude"] = lat
-                payload["longitude"] = lng
-            res = req.post(self.api.url + "/regions",
-                           payload,
-                           headers=self.api.headers)
-
-            # Check success
-            if res.status != 201:
-                raise custom_exceptions.AiohttpException(res, "_get_region_id", "liquorland")
-
-            # Get created regionId
-            region_id = res.json()["regionId"]
-
-            # Add new region to regions list
-            new_region = {
-                "regionId": region_id,
-                "name": payload["name"],
-                "lattitude": lat,
-                "longitude": lng
-            }
-            regions.append(new_region)
-
-        return region_id
-
-    def get_regions(self):
-        """
-        Get a list of regions from pisspricer api
-        :return: List of region dict objects from pisspricer api
-        """
-        regions_res = req.get(self.api.url + "/regions",
-                              headers=self.api.headers)
-        if regions_res.status != 200:
-            raise custom_exceptions.AiohttpException(regions_res, "get_regions", "pisspricer")
-        regions = regions_res.json()
-
-        return regions
+        response = await req.shared_get(session, url, headers=headers, cookies=cookies, params=params, decode=False)
+        if printer is not None and iteration is not None:
+            iteration[0] += 1
+            print_func, total, task = printer
+            print_func(iteration[0], total, task)
+        return item, response
 
     def get_stores(self, brand_id=None):
         """
@@ -230,13 +96,9 @@ class Pisspricer:
         :param brand_id: Optional brand id filter
         :return: List of json objects
         """
-        params = {}
-        if brand_id is not None:
-            params = {"brandId": brand_id}
-        res = req.get(self.api.url + "/stores", headers=self.api.headers, params=params)
-        return res.json()
+        return reference_data.get_stores(self.api, brand_id)
 
-    def update_item_prices(self, items, brand_id, brand_name, print_func=None):
+    def update_item_prices(self, items, brand_id, brand_name, print_func=None, checkpoint=None):
         """
         Posts items to pisspricer api that are new
         :param items: List of dict items
@@ -249,13 +111,110 @@ class Pisspricer:
                 "storeId"
             }
         :param brand_id: Store brand id
+        :param brand_name: Store name, used for metrics
+        :param print_func: Function for printing
+        :param checkpoint: RunCheckpoint to save and resume phases with, optional
+        :return: List of price put responses
+        """
+        if checkpoint is None:
+            checkpoint = NoCheckpoint()
+
+        with phases.phase(brand_name, "create new products"):
+            items = checkpoint.run("create new products", self._create_new_products,
+                                   items, brand_id, brand_name, print_func)
+
+            # Create request list for prices
+            requests = [[f"{self.api.url}/items/{item['sku']}/stores/{item['storeId']}", item] for item in items]
+
+        reses = asyncio.run(self._async_upload(requests, items, brand_name, print_func, checkpoint))
+        dead_letters.flush()
+        return reses
+
+    async def _async_upload(self, requests, items, brand_name, print_func, checkpoint):
+        """
+        Puts prices while the images are uploaded, as prices are what users see, returning once both have finished.
+        Both share one session, with separate connection budgets so images never hold up the prices. Profiles are per
+        phase, so when profiling the images are uploaded first instead, and the profiles don't include the overlap.
+        :param requests: List of [url, item] price put requests
+        :param items: List of item dict objects with skus
+        :param brand_name: Store name, used for metrics
+        :param print_func: Function for printing
+        :param checkpoint: RunCheckpoint to save and resume phases with
+        :return: List of price put responses
+        """
+        price_budget = asyncio.Semaphore(req.concurrency)
+        image_budget = asyncio.Semaphore(req.image_concurrency)
+        timeout = aiohttp.ClientTimeout(total=20*60)
+        async with req.client_session(limit=req.concurrency + req.image_concurrency, timeout=timeout) as session:
+            images_done = asyncio.ensure_future(self._async_upload_images_phase(
+                session, image_budget, items, brand_name, checkpoint, print_func if profiling.enabled else _no_progress))
+            if profiling.enabled:
+                await images_done
+            try:
+                reses = await self._async_put_prices_phase(session, price_budget, requests, brand_name, checkpoint,
+                                                           print_func)
+            finally:
+                if not images_done.done():
+                    print("Waiting for images to finish uploading...")
+                await asyncio.wait([images_done])
+            images_done.result()
+        return reses
+
+    async def _async_put_prices_phase(self, session, budget, requests, brand_name, checkpoint, print_func):
+        """
+        Runs the put prices phase
+        :param session: Aiohttp session
+        :param budget: Semaphore limiting the simultaneous price puts
+        :param requests: List of [url, item] price put requests
+        :param brand_name: Store name, used for metrics
+        :param checkpoint: RunCheckpoint to save and resume the phase with
+        :param print_func: Function for printing
+        :return: List of price put responses
+        """
+        with phases.phase(brand_name, "put prices"):
+            iteration = [0]
+            if print_func is not None:
+                print_func(0, len(requests), "post new prices")
+
+            async def put(url, item):
+                async with budget:
+                    return await self._async_put_json(session, url, item, headers=self.api.headers,
+                                                      printer=(print_func, len(requests), "post new prices"),
+                                                      iteration=iteration)
+
+            async def put_batch(batch):
+                return await asyncio.gather(*[put(url, item) for url, item in batch])
+
+            reses = await checkpoint.async_run_batches("put prices", requests, put_batch)
+            for res in reses:
+                metrics.items_uploaded.inc(store=brand_name.lower(), kind="price", result=res.status)
+        return reses
+
+    async def _async_upload_images_phase(self, session, budget, items, brand_name, checkpoint, print_func):
+        """
+        Runs the upload images phase
+        :param session: Aiohttp session
+        :param budget: Semaphore limiting the simultaneous image gets and puts
+        :param items: List of item dict objects with skus
+        :param brand_name: Store name, used for metrics
+        :param checkpoint: RunCheckpoint to save and resume the phase with
         :param print_func: Function for printing
         :return: None
         """
-        barcodes = req.get(self.api.url + "/barcodes", headers=self.api.headers)
-        skus = req.get(self.api.url + "/internalids", headers=self.api.headers, params={"brandId": brand_id})
-        barcodes = barcodes.json()
-        skus = skus.json()
+        with phases.phase(brand_name, "upload images"):
+            await checkpoint.async_run("upload images", self.async_upload_new_images, session, budget, items,
+                                       print_func)
+
+    def _create_new_products(self, items, brand_id, brand_name, print_func=None):
+        """
+        Posts items that aren't in pisspricer yet, by barcode or else internal sku, and assigns every item its sku
+        :param items: List of dict items, see update_item_prices
+        :param brand_id: Store brand id
+        :param brand_name: Store name, used for metrics
+        :param print_func: Function for printing
+        :return: List of items with "sku" set, excluding items that failed to post
+        """
+        barcodes, skus = reference_data.get_products(self.api, brand_id)
 
         requests = []
         for item in items:
@@ -265,13 +224,42 @@ class Pisspricer:
                     # Add item to requests list
                     requests.append([self.api.url + "/items",
                                      item])
-                    barcodes[barcode] = []
+                    barcodes[barcode] = None
             elif item.get("internalSku", None) is None or item.get("internalSku", None) not in skus:
                 requests.append([self.api.url + "/items",
                                  item])
-                skus[item["internalSku"]] = []
+                skus[item["internalSku"]] = None
 
-        # Post all items
+        # Post all items. Every shard posts the products it is missing, and one already created by another shard is
+        # looked up rather than created again
+        self._post_products(requests, barcodes, skus, brand_id, brand_name, print_func)
+
+        # Assign skus, leaving out items whose product failed to post. The posts are retried from the dead letter store.
+        items_with_skus = []
+        for item in items:
+            if item.get("barcode") is not None:
+                sku = barcodes[item["barcode"]]
+            else:
+                sku = skus[item["internalSku"]]
+            if sku is not None:
+                item["sku"] = sku
+                items_with_skus.append(item)
+        return items_with_skus
+
+    def _post_products(self, requests, barcodes, skus, brand_id, brand_name, print_func=None):
+        """
+        Posts new products, adding their skus to barcodes and skus.
+        Posting a product that already exists, eg. created by another shard, is rejected by the api (409). Rather than
+        relying on the status, the products of every rejected post are looked up again once all are posted, and only
+        posts of products that still don't exist are kept as dead letters to retry.
+        :param requests: List of [url, item] lists
+        :param barcodes: Dict of barcodes to skus from pisspricer api
+        :param skus: Dict of internal skus to skus from pisspricer api
+        :param brand_id: Store brand id
+        :param brand_name: Store name, used for metrics
+        :param print_func: Function for printing
+        :return: None
+        """
         iteration = [0]
         if print_func is not None and len(requests) > 0:
             print_func(0, len(requests), "create new products")
@@ -282,106 +270,150 @@ class Pisspricer:
                                            self._async_post_json))
 
         # Add new items to dictionaries
+        rejected = []
         for res in responses:
+            metrics.items_uploaded.inc(store=brand_name.lower(), kind="item", result=res.status)
             if res.status == 200 or res.status == 201:
                 data = res.json()
                 new_sku = data["sku"]
                 item = res.content
                 barcode = item.get("barcode", None)
                 if barcode is not None:
-                    barcodes[barcode] = [new_sku]
+                    barcodes[barcode] = new_sku
                 else:
-                    skus[item["internalSku"]] = [new_sku]
-
-        # Create request list for prices
-        requests = []
-        for item in items:
+                    skus[item["internalSku"]] = new_sku
+            else:
+                rejected.append(res)
+        if len(rejected) == 0:
+            return
 
+        self._refresh_products(barcodes, skus, brand_id)
+        for res in rejected:
+            item = res.content
             if item.get("barcode") is not None:
-                sku = barcodes[item["barcode"]][0]
+                key, sku = item["barcode"], barcodes.get(item["barcode"])
             else:
-                sku = skus[item["internalSku"]][0]
-            item["sku"] = sku
-            requests.append([f"{self.api.url}/items/{sku}/stores/{item['storeId']}",
-                             item])
-
-        # Upload images
-        self.upload_new_images(items, print_func)
+                key, sku = item.get("internalSku"), skus.get(item.get("internalSku"))
+            if sku is None:
+                dead_letters.add("POST", self.api.url + "/items", item, res.status, key=f"{self.api.url}/items#{key}")
 
-        # Put prices
-        iteration = [0]
-        if print_func is not None:
-            print_func(0, len(requests), "post new prices")
-        reses = asyncio.run(req.create_async_tasks(requests,
-                                           {"headers": self.api.headers,
-                                            "printer": (print_func, len(requests), "post new prices"),
-                                            "iteration": iteration}, self._async_put_json))
-        return reses
+    def _refresh_products(self, barcodes, skus, brand_id):
+        """
+        Adds skus of products created elsewhere to barcodes and skus
+        :return: None
+        """
+        for kind, existing in zip(("barcode", "internalSku"), reference_data.get_products(self.api, brand_id)):
+            known = barcodes if kind == "barcode" else skus
+            for key in known:
+                if known[key] is None and existing.get(key) is not None:
+                    known[key] = existing[key]
 
     def upload_new_images(self, items, print_func):
         """
         Uploads images for items that don't have one
         :param items: List of item dict objects. {"sku": int, "image_url": string}
+        :param print_func: Function for printing
+        :return: None
+        """
+        async def upload():
+            async with req.client_session(limit=req.image_concurrency) as session:
+                await self.async_upload_new_images(session, asyncio.Semaphore(req.image_concurrency), items, print_func)
+
+        asyncio.run(upload())
+
+    async def async_upload_new_images(self, session, budget, items, print_func):
+        """
+        Uploads images for items that don't have one. Each image is got, processed and its derivatives put on its own,
+        so other requests in the session carry on while it is processed on a worker thread.
+        :param session: Aiohttp session
+        :param budget: Semaphore limiting the simultaneous image gets and puts
+        :param items: List of item dict objects. {"sku": int, "image_url": string}
+        :param print_func: Function for printing
         :return: None
         """
-        all_items = req.get(self.api.url + "/allitems", headers=self.api.headers).json()
-        print('start')
+        has_images = await reference_data.async_get_image_index(session, self.api)
 
-        # Iterate through items and add to get list if there isn't an image
-        req_list = []
+        # Iterate through items and add to upload list if there isn't an image
+        upload_list = []
 
         checked_skus = set()
         for item in items:
             if item["sku"] not in checked_skus:
 
-                has_image = True
-                for cur_item in all_items:
-                    if cur_item["sku"] == item["sku"]:
-                        # Check if item doesn't have an image
-                        if cur_item["hasImage"] == 0:
-                            has_image = False
-                        break
-                if not has_image:
+                if not has_images.get(item["sku"], True):
 
                     # Item doesn't have image
-                    req_list.append([
-                        item["image_url"],
-                        item
-                    ])
+                    upload_list.append(item)
 
                 # Add sku to set
                 checked_skus.add(item["sku"])
 
-        # Get images
+        index = image_hashes.ImageIndex().load()
         iteration = [0]
-        if len(req_list) > 0:
-            print_func(0, len(req_list), "get images")
-        responses = asyncio.run(
-            req.create_async_tasks(req_list,
-                                   {"headers": self.api.headers,
-                                    "printer": (print_func, len(req_list), "get images"),
-                                    "iteration": iteration},
-                                   self._async_get))
-
-        # Create put image request list
-        image_list = []
-        print_func(0, len(responses), 'processing images')
-        for i, (item, res) in enumerate(responses):
+        if len(upload_list) > 0:
+            print_func(0, len(upload_list), "upload images")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="images") as processor:
+            await asyncio.gather(*[
+                self._async_upload_image(session, budget, processor, index, item,
+                                         (print_func, len(upload_list), "upload images"), iteration)
+                for item in upload_list])
+
+    async def _async_upload_image(self, session, budget, processor, index, item, printer, iteration):
+        """
+        Gets, processes and puts the derivatives of an item's image, logging any error
+        :param session: Aiohttp session
+        :param budget: Semaphore limiting the simultaneous image gets and puts
+        :param processor: Executor to process the image on
+        :param index: ImageIndex of derivatives already processed
+        :param item: Item dict object. {"sku": int, "image_url": string}
+        :param printer: (print_func, total, task) for printing
+        :param iteration: List with single integer for counting current iteration
+        :return: None
+        """
+        try:
             try:
-                content = res.read()
-                image_bytes = images.process_response_content(content)
-                image_list.append((item["sku"], image_bytes))
+                async with budget:
+                    _, res = await self._async_get(session, item["image_url"], item)
+                with tracing.span("process image", sku=item["sku"]):
+                    uploads = await asyncio.get_running_loop().run_in_executor(
+                        processor, self._process_image, item["sku"], res.read(), index)
+                metrics.images_processed.inc(result="ok")
             except Exception as err:
-                tools.log_error(err)
-            finally:
-                print_func(i + 1, len(responses))
-
-        if len(image_list) > 0:
-            print_func(0, len(image_list), "put images")
-        responses = req.post_images(image_list,
-                                    self.api.url + "/items",
-                                    headers=self.api.headers,
-                                    printer=(print_func, len(image_list), "put images"))
+                metrics.images_processed.inc(result="error")
+                tools.log_error(err, url=item.get("image_url"), sku=item["sku"])
+                return
+
+            for path, content_type, image in uploads:
+                headers = copy.deepcopy(self.api.headers)
+                headers["Content-Type"] = content_type
+                async with budget:
+                    try:
+                        await req.async_post_image(session, f"{self.api.url}/items/{path}", image, headers=headers)
+                    except Exception:
+                        # Logged by async_post_image, the item's other derivatives are still put
+                        pass
+        finally:
+            iteration[0] += 1
+            print_func, total, task = printer
+            print_func(iteration[0], total, task)
+
+    @staticmethod
+    def _process_image(sku, content, index):
+        """
+        Processes an image, reusing the derivatives of a matching image already processed
+        :param sku: Item sku
+        :param content: Image bytes
+        :param index: ImageIndex of derivatives already processed
+        :return: List of (path, content type, image) tuples, see images.uploads
+        """
+        image = images.open_image(content)
+        image_fingerprint = image_hashes.fingerprint(image)
+        image_detail = image_hashes.detail(image)
+        derivatives = index.get(image_fingerprint, image_detail, images.SIZES, images.FORMATS)
+        if derivatives is None:
+            derivatives = images.process_image(image)
+            index.add(image_fingerprint, image_detail, derivatives)
+        return images.uploads(sku, derivatives)
 
 
 
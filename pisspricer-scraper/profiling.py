@@ -0,0 +1,115 @@
+import cProfile
+import os
+import pstats
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_DIR = os.getenv("pisspricer.profile_dir", os.path.join(os.path.dirname(__file__), "profiles"))
+TOP_N = 30
+
+enabled = False
+run_dir = None
+_active = []
+
+
+def enable(profile_dir=PROFILE_DIR):
+    """
+    Turns on profiling of every phase for the rest of the run.
+    Output is written to a new directory '{profile_dir}/{timestamp}'.
+    :param profile_dir: Parent directory for run directories
+    :return: Path of the run directory
+    """
+    global enabled, run_dir
+    run_dir = os.path.join(profile_dir, time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+    tracemalloc.start(25)
+    enabled = True
+    return run_dir
+
+
+@contextmanager
+def profile(store, phase):
+    """
+    Profiles cpu time and memory allocations of a phase. Writes to the run directory:
+        {store}-{phase}.pstats     - cProfile stats, loadable with pstats, snakeviz, gprof2dot or flameprof
+        {store}-{phase}.collapsed  - Folded stacks for flamegraph.pl / speedscope, built from the pstats call graph
+        {store}-{phase}.txt        - Top functions by cumulative time
+        {store}-{phase}-memory.txt - Peak traced memory and top allocation sites still held at the end of the phase
+    Nested phases pause the outer phase's profiler, so time is only counted in the innermost phase.
+    :param store: Store name
+    :param phase: Phase name
+    :return: None
+    """
+    profiler = cProfile.Profile()
+    if len(_active) > 0:
+        _active[-1].disable()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    _active.append(profiler)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _active.pop()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        if len(_active) > 0:
+            _active[-1].enable()
+        _write(f"{_file_name(store)}-{_file_name(phase)}", profiler, peak, before, after)
+
+
+def _file_name(name):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name.strip().lower())
+
+
+def _write(name, profiler, peak, before, after):
+    base = os.path.join(run_dir, name)
+    profiler.dump_stats(base + ".pstats")
+
+    with open(base + ".txt", "w") as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats("cumulative").print_stats(TOP_N)
+
+    with open(base + ".collapsed", "w") as f:
+        for stack, micros in _collapsed_stacks(pstats.Stats(profiler)):
+            f.write(f"{stack} {micros}\n")
+
+    with open(base + "-memory.txt", "w") as f:
+        f.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MiB\n\n")
+        f.write(f"Top {TOP_N} allocation sites by growth during the phase:\n")
+        for stat in after.compare_to(before, "lineno")[:TOP_N]:
+            f.write(f"{stat}\n")
+
+
+def _collapsed_stacks(stats):
+    """
+    Approximates folded stacks from a cProfile call graph. Each function's own time is attributed to the
+    chain of its most expensive callers, as cProfile doesn't record full stacks.
+    :param stats: pstats.Stats object
+    :return: List of (stack_string, self_time_microseconds) tuples
+    """
+    def label(func):
+        file_name, line, func_name = func
+        return f"{func_name} ({os.path.basename(file_name)}:{line})"
+
+    stacks = {}
+    for func, (_, _, self_time, _, callers) in stats.stats.items():
+        micros = int(self_time * 1e6)
+        if micros == 0:
+            continue
+        chain = [func]
+        seen = {func}
+        current = callers
+        while len(current) > 0:
+            caller = max(current, key=lambda c: current[c][3])
+            if caller in seen:
+                break
+            chain.append(caller)
+            seen.add(caller)
+            current = stats.stats[caller][4] if caller in stats.stats else {}
+        stack = ";".join(label(f) for f in reversed(chain))
+        stacks[stack] = stacks.get(stack, 0) + micros
+    return sorted(stacks.items())
@@ -0,0 +1,127 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+TTY = "tty"
+JSON = "json"
+QUIET = "quiet"
+MODES = (TTY, JSON, QUIET)
+
+
+class ProgressReporter:
+    """
+    Aggregates progress updates from the scrapers and renders them at a fixed rate from a background thread,
+    so updating progress inside hot loops and coroutines is just an assignment.
+    Modes:
+        tty   - Progress bar redrawn in place
+        json  - One json object per line, for cron logs and log shipping
+        quiet - Nothing
+    """
+
+    def __init__(self, mode=None, interval=None):
+        if mode is None:
+            mode = os.getenv("pisspricer.progress", TTY if sys.stdout.isatty() else JSON)
+        self.mode = mode
+        self.interval = interval if interval is not None else (0.2 if mode == TTY else 10)
+        self.length = 50
+        self._state = None
+        self._rendered = None
+        self._finished = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_mode(self, mode):
+        """
+        Changes the output mode
+        :param mode: One of MODES
+        :return: None
+        """
+        if mode not in MODES:
+            raise ValueError(f"Progress mode must be one of {MODES}, not '{mode}'")
+        self.mode = mode
+        self.interval = 0.2 if mode == TTY else 10
+
+    def update(self, iteration, total, task=None):
+        """
+        Records progress of the current task. Cheap enough to call for every completed request.
+        :param iteration: Iteration number
+        :param total: Total number of iterations there will be
+        :param task: Task name, starts a new task if it differs from the current one or iteration is zero
+        :return: None
+        """
+        if self.mode == QUIET:
+            return
+        state = self._state
+        if state is None or (task and (task != state[0] or iteration == 0)):
+            if state is not None:
+                self._finished.append(state)
+            self._state = (task or "", iteration, total, time.monotonic())
+            self._ensure_started()
+        else:
+            self._state = (state[0], iteration, total, state[3])
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+
+    def stop(self):
+        """
+        Stops the render thread after rendering the final state
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.render()
+        self._stop.clear()
+
+    def render(self):
+        """
+        Renders tasks that finished since the last render, then the current task if it has changed
+        :return: None
+        """
+        while len(self._finished) > 0:
+            state = self._finished.pop(0)
+            self._render_state(state, done=True)
+            self._rendered = None
+        state = self._state
+        if state is not None and state != self._rendered:
+            self._render_state(state)
+            self._rendered = state
+
+    def _render_state(self, state, done=False):
+        task, iteration, total, start = state
+        elapsed = time.monotonic() - start
+        if self.mode == JSON:
+            line = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "task": task,
+                "iteration": iteration,
+                "total": total,
+                "elapsed": round(elapsed, 2),
+                "rate": round(iteration / elapsed, 2) if elapsed > 0 else None,
+                "done": done or (total > 0 and iteration >= total)
+            }
+            print(json.dumps(line), flush=True)
+        elif self.mode == TTY:
+            fraction = min(iteration / total, 1) if total > 0 else 1
+            filled = int(self.length * fraction)
+            bar = "█" * filled + "-" * (self.length - filled)
+            end = "\n" if done else ""
+            print(f"\r{task}: |{bar}| {100 * fraction:.1f}% {iteration}/{total} {elapsed:.0f}s", end=end, flush=True)
+
+
+reporter = ProgressReporter()
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import custom_requests as req
+from custom_exceptions import AiohttpException
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    # The stdlib decoder also takes bytes, it is just slower
+    orjson = None
+    loads = json.loads
+
+CHUNK_SIZE = 64 * 1024
+
+# Number of earlier cut points tried in a chunk before waiting for more data
+MAX_CUT_ATTEMPTS = 8
+
+
+class StreamDecoder:
+    """
+    Decodes a json document with a top level array or object incrementally, as it is received.
+    After each chunk the complete elements received so far are decoded as one batch (a list, or a dict for an object),
+    so only the batch and the partial element after it are held in memory rather than the whole document.
+    Batches are cut after a '},' or '],' and decoded with the closing bracket added. A cut inside a string or a nested
+    value leaves the batch unterminated or unbalanced, so it fails to decode and an earlier cut is tried instead.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._open = None
+        self._close = None
+
+    def feed(self, chunk):
+        """
+        :param chunk: Next bytes of the document
+        :return: List of decoded batches, empty if no element was completed by the chunk
+        """
+        self._buffer += chunk
+        if self._open is None:
+            self._buffer = self._buffer.lstrip()
+            if len(self._buffer) == 0:
+                return []
+            self._open = self._buffer[:1]
+            if self._open not in (b"[", b"{"):
+                raise ValueError(f"Expected a json array or object, got {self._buffer[:20]}")
+            self._close = b"]" if self._open == b"[" else b"}"
+            self._buffer = self._buffer[1:]
+        return self._cut()
+
+    def _cut(self):
+        end = len(self._buffer)
+        for _ in range(MAX_CUT_ATTEMPTS):
+            pos = max(self._buffer.rfind(b"},", 0, end), self._buffer.rfind(b"],", 0, end))
+            if pos < 0:
+                return []
+            try:
+                batch = loads(self._open + self._buffer[:pos + 1] + self._close)
+            except ValueError:
+                end = pos
+                continue
+            self._buffer = self._buffer[pos + 2:]
+            return [batch]
+        return []
+
+    def close(self):
+        """
+        :return: List of the last decoded batch
+        """
+        if self._open is None:
+            raise ValueError("Empty json document")
+        batch = loads(self._open + self._buffer)
+        self._buffer = b""
+        return [batch]
+
+
+async def _async_stream(session, url, headers, params, add_batch):
+    """
+    Gets a json document, passing each decoded batch of its elements to add_batch
+    :param session: Aiohttp session
+    :param url: Url string
+    :param headers: Dict of headers
+    :param params: Dict of query parameters
+    :param add_batch: Function taking a list or dict batch
+    :return: None
+    """
+    async with session.get(url, headers=headers, params=params) as response:
+        if response.status != 200:
+            raise AiohttpException(req.Response(response, None, response.headers, None, None), f"get {url}",
+                                   "pisspricer")
+        decoder = StreamDecoder()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            for batch in decoder.feed(chunk):
+                add_batch(batch)
+        for batch in decoder.close():
+            add_batch(batch)
+
+
+async def _async_load(session, api, *documents):
+    """
+    Streams pisspricer api documents concurrently
+    :param session: Aiohttp session
+    :param api: Pisspricer api module
+    :param documents: (path, params, add_batch) 3-tuples
+    :return: None
+    """
+    await asyncio.gather(*[_async_stream(session, api.url + path, api.headers, params, add_batch)
+                           for path, params, add_batch in documents])
+
+
+def _load(api, *documents):
+    """
+    Streams pisspricer api documents concurrently in a new session
+    :param api: Pisspricer api module
+    :param documents: (path, params, add_batch) 3-tuples
+    :return: None
+    """
+    async def load_all():
+        async with req.client_session() as session:
+            await _async_load(session, api, *documents)
+
+    asyncio.run(load_all())
+
+
+def _sku_index(index):
+    """
+    :param index: Dict to add to
+    :return: Function adding a batch of {key: [sku, ...]} to the index as {key: first sku}, or None if it has no skus
+    """
+    def add_batch(batch):
+        index.update({key: skus[0] if len(skus) > 0 else None for key, skus in batch.items()})
+    return add_batch
+
+
+def get_barcodes(api):
+    """
+    :param api: Pisspricer api module
+    :return: Dict of barcodes to skus, None for barcodes without a sku
+    """
+    barcodes = {}
+    _load(api, ("/barcodes", {}, _sku_index(barcodes)))
+    return barcodes
+
+
+def get_products(api, brand_id):
+    """
+    Gets the barcode and internal sku indexes concurrently
+    :param api: Pisspricer api module
+    :param brand_id: Brand id of the internal skus
+    :return: (barcodes, internal skus) 2-tuple of dicts to skus, None for keys without a sku
+    """
+    barcodes = {}
+    skus = {}
+    _load(api,
+          ("/barcodes", {}, _sku_index(barcodes)),
+          ("/internalids", {"brandId": brand_id}, _sku_index(skus)))
+    return barcodes, skus
+
+
+async def async_get_image_index(session, api):
+    """
+    :param session: Aiohttp session
+    :param api: Pisspricer api module
+    :return: Dict of skus to True if the item has an image
+    """
+    has_image = {}
+
+    def add_batch(batch):
+        has_image.update({item["sku"]: bool(item["hasImage"]) for item in batch})
+
+    await _async_load(session, api, ("/allitems", {}, add_batch))
+    return has_image
+
+
+def get_stores(api, brand_id=None):
+    """
+    :param api: Pisspricer api module
+    :param brand_id: Optional brand id filter
+    :return: List of store dicts
+    """
+    stores = []
+    _load(api, ("/stores", {} if brand_id is None else {"brandId": brand_id}, stores.extend))
+    return stores
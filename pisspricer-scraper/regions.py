@@ -0,0 +1,74 @@
+import requests
+import custom_requests as req
+from custom_exceptions import AiohttpException, PisspricerApiException
+
+
+def normalize(name):
+    """
+    :param name: Region name
+    :return: Key matching the same region however it is capitalized or spaced
+    """
+    return " ".join(name.split()).casefold()
+
+
+class RegionResolver:
+    """
+    Resolves region names to pisspricer region ids, creating missing regions.
+    Regions are indexed by normalized name. Each missing region is created once, even when many stores in it are
+    posted concurrently. The first caller posts it and the others wait for its id. If another process creates the
+    region first, posting fails, so the resolver reloads the regions and takes the id from there.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.index = {}
+        self._single_flight = req.SingleFlight()
+
+    def load(self):
+        """
+        Loads the regions from pisspricer api into the index
+        :return: self
+        """
+        res = requests.get(self.api.url + "/regions", headers=self.api.headers, hooks=req.requests_hooks)
+        if not res.ok:
+            raise PisspricerApiException(res, "get regions")
+        self.index.update({normalize(region["name"]): region["regionId"] for region in res.json()})
+        return self
+
+    @staticmethod
+    def _payload(name, lat, lng):
+        payload = {"name": " ".join(name.split()).capitalize()}
+        if lat is not None:
+            payload["lattitude"] = lat
+            payload["longitude"] = lng
+        return payload
+
+    async def async_get_id(self, session, name, lat=None, lng=None, headers={}):
+        """
+        Gets the id of a region using an aiohttp session, creating the region if it doesn't exist
+        :param session: Aiohttp session
+        :param name: Region name
+        :param lat: Latitude of the region, used if it is created
+        :param lng: Longitude of the region, used if it is created
+        :param headers: Headers for the pisspricer api
+        :return: Region id integer
+        """
+        key = normalize(name)
+        if key in self.index:
+            return self.index[key]
+        return await self._single_flight.do(key, lambda: self._async_create(session, key, name, lat, lng, headers))
+
+    async def _async_create(self, session, key, name, lat, lng, headers):
+        payload = self._payload(name, lat, lng)
+        async with session.post(self.api.url + "/regions", headers=headers, json=payload) as response:
+            heads, json_body, body = await req.Response.build_params(response)
+            res = req.Response(response, payload, heads, json_body, body)
+        if res.status == 201:
+            self.index[key] = res.json()["regionId"]
+            return self.index[key]
+        async with session.get(self.api.url + "/regions", headers=headers) as response:
+            if response.status == 200:
+                self.index.update({normalize(region["name"]): region["regionId"] for region in await response.json()})
+        if key not in self.index:
+            raise AiohttpException(res, f"posting to /regions {name}", "pisspricer")
+        return self.index[key]
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import time
+
+SHARD_DIR = os.getenv("pisspricer.shard_dir", os.path.join(os.path.dirname(__file__), "shards"))
+
+
+class Shard:
+    """
+    One of count shards of the work, numbered from 0. Keys (store internal ids, barcodes) are assigned to shards by
+    rendezvous hashing, so every host agrees on the assignment without coordinating, and changing the number of
+    shards only moves the keys of the added or removed shards.
+    """
+
+    def __init__(self, index=0, count=1):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard index must be between 0 and {count - 1}, not {index}")
+        self.index = index
+        self.count = count
+
+    @staticmethod
+    def parse(spec):
+        """
+        :param spec: 'i/N' string
+        :return: Shard
+        """
+        index, _, count = spec.partition("/")
+        return Shard(int(index), int(count))
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    @property
+    def suffix(self):
+        """ Suffix for file names of this shard, empty when not sharded """
+        return f"-shard-{self.index}-of-{self.count}" if self.sharded else ""
+
+    def owner(self, key):
+        """
+        :param key: Key to assign, eg. a store internal id or barcode
+        :return: Index of the shard owning the key
+        """
+        key = str(key).encode()
+        return max(range(self.count), key=lambda i: hashlib.blake2b(key + b":%d" % i, digest_size=8).digest())
+
+    def owns(self, key):
+        """
+        :param key: Key to assign
+        :return: True if this shard owns the key
+        """
+        return not self.sharded or self.owner(key) == self.index
+
+    def filter_stores(self, stores):
+        """
+        :param stores: List of store dicts from pisspricer api
+        :return: Stores owned by this shard, by internal id
+        """
+        if not self.sharded:
+            return stores
+        owned = [store for store in stores if self.owns(store["internalId"])]
+        print(f"Shard {self.index}/{self.count} has {len(owned)} of {len(stores)} stores")
+        return owned
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+current = Shard()
+
+
+def write_summary(registry, name, shard_dir=SHARD_DIR):
+    """
+    Writes this shard's metrics to '{shard_dir}/{name}-shard-{i}-of-{N}.json', to be combined with the other shards'
+    :param registry: metrics.Registry
+    :param name: Name of what was run, eg. the store name
+    :return: Path of the written file
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    path = os.path.join(shard_dir, f"{name.lower()}{current.suffix}.json")
+    summary = {"shard": str(current), "finished": time.strftime("%Y-%m-%dT%H:%M:%S"), "metrics": registry.to_json()}
+    with open(path + ".tmp", "w") as f:
+        json.dump(summary, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def combine(paths):
+    """
+    Combines shard summaries. Counters and histograms are summed. Gauges take the maximum, so phase durations are the
+    slowest shard's, except run success which takes the minimum, so it is 0 if any shard failed.
+    :param paths: List of summary file paths
+    :return: Combined summary dict
+    """
+    shards = []
+    combined = {}
+    for path in paths:
+        with open(path) as f:
+            summary = json.load(f)
+        shards.append(summary["shard"])
+        for name, metric in summary["metrics"].items():
+            target = combined.setdefault(name, {"type": metric["type"], "help": metric["help"], "values": {}})
+            for value in metric["values"]:
+                key = json.dumps(value["labels"], sort_keys=True)
+                current_value = target["values"].get(key)
+                if current_value is None:
+                    target["values"][key] = value
+                elif metric["type"] == "counter":
+                    current_value["value"] += value["value"]
+                elif metric["type"] == "gauge" and name.endswith("_success"):
+                    current_value["value"] = min(current_value["value"], value["value"])
+                elif metric["type"] == "gauge":
+                    current_value["value"] = max(current_value["value"], value["value"])
+                else:
+                    current_value["sum"] += value["sum"]
+                    current_value["count"] += value["count"]
+                    for bound, count in value["buckets"].items():
+                        current_value["buckets"][bound] = current_value["buckets"].get(bound, 0) + count
+    for metric in combined.values():
+        metric["values"] = list(metric["values"].values())
+    return {"shards": sorted(shards), "metrics": combined}
+
+
+def main(args):
+    """
+    Command line entry point, combines the shard summaries in a directory and prints the totals
+    :param args: List of command line args after 'combine-shards', optionally the summary directory
+    :return: None
+    """
+    shard_dir = args[0] if len(args) > 0 else SHARD_DIR
+    paths = sorted(os.path.join(shard_dir, name) for name in os.listdir(shard_dir)
+                   if "-shard-" in name and name.endswith(".json"))
+    combined = combine(paths)
+    with open(os.path.join(shard_dir, "combined.json"), "w") as f:
+        json.dump(combined, f, indent=1)
+    print(f"Combined shards {', '.join(combined['shards'])}")
+    for name in ("pisspricer_items_parsed_total", "pisspricer_items_uploaded_total", "pisspricer_run_success"):
+        for value in combined["metrics"].get(name, {}).get("values", []):
+            labels = ", ".join(f"{k}={v}" for k, v in sorted(value["labels"].items()))
+            print(f"{name}{{{labels}}} {value['value']}")
@@ -0,0 +1,348 @@
+"""
+Local simulator of the Countdown, Liquorland and Henrys websites, serving deterministic synthetic catalogs in each
+site's real format, for measuring crawler throughput and memory at any scale.
+
+    python3 pisspricer-scraper simulate-sites --port=8001 --stores=500 --products=50000 --latency=uniform:0.01,0.05
+
+Then run the scrapers with
+    countdown.url=http://localhost:8001/countdown
+    liquorland.url=http://localhost:8001/liquorland
+    liquorland.locations_url=http://localhost:8001/liquorland/branches.json
+    henrys.url=http://localhost:8001/henrys
+and pisspricer.url pointing at the stub api, with stores added for each brand (see find_stores).
+"""
+import asyncio
+import functools
+import json
+import math
+import random
+import uuid
+from io import BytesIO
+from aiohttp import web
+from PIL import Image, ImageDraw
+from stub_api import Latency
+
+REGIONS = ["Auckland", "Waikato", "Bay of Plenty", "Wellington", "Canterbury", "Otago"]
+NAMES = ["Speight's Gold Medal Ale", "Jim Beam White Bourbon", "Absolut Vodka", "Gordon's London Dry Gin",
+         "Oyster Bay Sauvignon Blanc", "Villa Maria Pinot Noir", "Baileys Irish Cream", "Scrumpy Crisp Apple Cider",
+         "Cody's Bourbon & Cola", "Heineken Lager", "Jameson Irish Whiskey", "Bacardi Carta Blanca Rum",
+         "Lindauer Classic Brut", "Kahlua Coffee Liqueur", "Corona Extra", "Steinlager Pure", "Smirnoff Ice"]
+VOLUMES = [("330ml", 330), ("1L", 1000), ("700ml", 700), ("750ml", 750), ("1.5Lt", 1500), ("375ML", 375)]
+COUNTDOWN_AISLES = ["beer", "cider", "red wine", "white wine", "sparkling wine", "spirits", "liqueurs",
+                    "ready to drink"]
+LIQUORLAND_ENDPOINTS = ["/Bourbon.aspx", "/brandy.aspx", "/whisky.aspx", "/vodka.aspx", "/gin.aspx", "/rum.aspx",
+                        "/tequila.aspx", "/otherspirits.aspx", "/liqueurs.aspx", "/beer.aspx", "/craftbeer.aspx",
+                        "/redwine.aspx", "/whitewine.aspx", "/rose.aspx", "/sparklingwine.aspx", "/champagne.aspx",
+                        "/port.aspx", "/caskwine.aspx", "/cider.aspx", "/rtds.aspx"]
+HENRYS_KEYS = [24350, 13587, 24680, 24675, 13651, 13650, 13652, 23625, 23626, 23627, 23629, 16639, 16642]
+STOCK = ["Stock High", "Stock Medium", "Stock Low", "Out of Stock"]
+COUNTDOWN_PAGE_SIZE = 120
+HENRYS_PAGE_SIZE = 48
+
+
+class Catalog:
+    """ Deterministic synthetic products and stores, shared by all three sites """
+
+    def __init__(self, n_stores, n_products, seed=1):
+        rand = random.Random(seed)
+        self.n_stores = n_stores
+        self.products = []
+        for i in range(n_products):
+            volume_name, volume = rand.choice(VOLUMES)
+            self.products.append({
+                "id": i,
+                "name": f"{rand.choice(NAMES)} {volume_name}",
+                "brand": rand.choice(NAMES).split(" ")[0],
+                "barcode": "94" + str(rand.randrange(10 ** 10, 10 ** 11)),
+                "volume": volume,
+                "price": rand.randint(500, 12000) / 100,
+                "aisle": rand.choice(COUNTDOWN_AISLES),
+                "endpoint": rand.choice(LIQUORLAND_ENDPOINTS).lower(),
+                "department": rand.choice(HENRYS_KEYS)
+            })
+        self.stores = [{
+            "id": 100 + s,
+            "name": f"Store {s}",
+            "address": f"{rand.randint(1, 400)} Main Road",
+            "city": f"City {s % 50}",
+            "region": rand.choice(REGIONS),
+            "postcode": str(rand.randint(1000, 9999)),
+            "latitude": -36 - rand.random() * 10,
+            "longitude": 172 + rand.random() * 6
+        } for s in range(n_stores)]
+
+    @staticmethod
+    def in_store(product, store_index):
+        return (product["id"] * 7 + store_index) % 10 != 0
+
+    @staticmethod
+    def store_price(product, store_index):
+        """
+        :return: (price, sale_price) 2-tuple, sale_price is None if not on special
+        """
+        price = round(product["price"] * (1 + ((product["id"] * 31 + store_index * 17) % 11 - 5) / 100), 2)
+        if (product["id"] + store_index * 3) % 7 == 0:
+            return price, round(price * 0.85, 2)
+        return price, None
+
+    def store_index(self, store_id):
+        index = int(store_id) - 100
+        if not 0 <= index < self.n_stores:
+            raise web.HTTPNotFound()
+        return index
+
+    @functools.lru_cache(maxsize=512)
+    def store_products(self, store_index, key, value):
+        """
+        Products in a store with product[key] == value, or all products if key is None
+        :return: List of products
+        """
+        return [p for p in self.products
+                if (key is None or p[key] == value) and self.in_store(p, store_index)]
+
+
+@functools.lru_cache(maxsize=16)
+def product_image(variant):
+    """ Bottle on a transparent background, varied in colour by variant """
+    image = Image.new("RGBA", (500, 500), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    colour = ((variant * 70) % 200, (variant * 130) % 200, (variant * 40) % 200, 255)
+    draw.rectangle([190, 170, 310, 450], fill=colour)
+    draw.rectangle([230, 50, 270, 170], fill=colour)
+    data = BytesIO()
+    image.save(data, format="PNG")
+    return data.getvalue()
+
+
+class CountdownSite:
+    """ Countdown online shopping api, with the selected pickup store bound to the ASP.NET session cookie """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.sessions = {}
+
+    def routes(self, app):
+        app.router.add_get("/countdown/api/v1/products", self.products)
+        app.router.add_put("/countdown/api/v1/fulfilment/my/pickup-addresses", self.set_store)
+        app.router.add_get("/countdown/api/v1/addresses/pickup-addresses", self.pickup_addresses)
+        app.router.add_get("/countdown/images/{barcode}.png", image_handler)
+
+    async def products(self, request):
+        session_id = request.cookies.get("ASP.NET_SessionId")
+        new_session = session_id is None
+        if new_session:
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = 0
+        store_index = self.sessions.get(session_id, 0)
+
+        aisle = None
+        for das_filter in request.query.getall("dasFilter", []):
+            if das_filter.startswith("Aisle;;"):
+                aisle = das_filter.split(";;")[1].split(";")[0]
+        size = int(request.query.get("size", COUNTDOWN_PAGE_SIZE))
+        page = int(request.query.get("page", 1))
+
+        facets = []
+        for name in COUNTDOWN_AISLES:
+            count = len(self.catalog.store_products(store_index, "aisle", name))
+            facets.append({"key": name.replace(" ", "-"), "name": name, "productCount": count})
+
+        if aisle is None:
+            products = self.catalog.store_products(store_index, None, None)
+        else:
+            name = next((n for n in COUNTDOWN_AISLES if n.replace(" ", "-").replace("&", "") == aisle), None)
+            products = self.catalog.store_products(store_index, "aisle", name) if name is not None else []
+        page_products = products[(page - 1) * size:page * size]
+
+        items = []
+        origin = str(request.url.origin())
+        for p in page_products:
+            price, sale_price = self.catalog.store_price(p, store_index)
+            items.append({
+                "type": "Product",
+                "name": p["name"],
+                "barcode": p["barcode"],
+                "sku": str(p["id"]),
+                "brand": p["brand"],
+                "price": {"originalPrice": price, "salePrice": sale_price or price, "isSpecial": sale_price is not None},
+                "size": {"volumeSize": f"{p['volume']}ml"},
+                "images": {"big": f"{origin}/countdown/images/{p['barcode']}.png"}
+            })
+        response = web.json_response({
+            "dasFacets": facets,
+            "products": {"items": items, "totalItems": len(products)}
+        })
+        if new_session:
+            response.set_cookie("ASP.NET_SessionId", session_id)
+        return response
+
+    async def set_store(self, request):
+        session_id = request.cookies.get("ASP.NET_SessionId")
+        if session_id not in self.sessions:
+            return web.json_response({"error": "No session"}, status=401)
+        body = await request.json()
+        self.sessions[session_id] = self.catalog.store_index(body["addressId"])
+        return web.json_response({"isSuccessful": True})
+
+    async def pickup_addresses(self, request):
+        addresses = [{"id": s["id"], "name": f"Countdown {s['name']}", "address": f"{s['address']}, {s['city']}"}
+                     for s in self.catalog.stores]
+        return web.json_response({"storeAreas": [{"name": "All", "storeAddresses": addresses}]})
+
+
+class LiquorlandSite:
+    """ Liquorland shop category listing pages, with the store selected by the selectedStore cookie """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def routes(self, app):
+        app.router.add_get("/liquorland/branches.json", self.branches)
+        app.router.add_get("/liquorland/ProductImages/m/{barcode}.jpg", image_handler)
+        app.router.add_get("/liquorland/{endpoint}", self.listing)
+
+    async def branches(self, request):
+        return web.json_response([{
+            "ID": s["id"],
+            "Name": f"Liquorland {s['name']}",
+            "Address1": s["address"],
+            "Address2": "",
+            "City": s["city"],
+            "State": s["region"],
+            "PostCode": s["postcode"],
+            "BranchType": "Store"
+        } for s in self.catalog.stores])
+
+    async def listing(self, request):
+        endpoint = "/" + request.match_info["endpoint"].lower()
+        store_index = self.catalog.store_index(request.cookies.get("selectedStore", 100))
+        page_size = int(request.query.get("ps", 48))
+        page = int(request.query.get("p", 0))
+        products = self.catalog.store_products(store_index, "endpoint", endpoint)
+        page_products = products[page * page_size:(page + 1) * page_size]
+
+        divs = []
+        for p in page_products:
+            price, sale_price = self.catalog.store_price(p, store_index)
+            if sale_price is None:
+                price_html = f'<span class="value">${price:,.2f}</span>'
+            else:
+                price_html = (f'<span class="msrp">${price:,.2f}</span>'
+                              f'<span class="SpecialPriceFormat2">${sale_price:,.2f}</span>')
+            divs.append(f'''<div class="productItemDisplay">
+<div class="thumbnail"><a href="Product/{p['id']}.aspx"><img src="ProductImages/m/{p['barcode']}.jpg"/></a></div>
+<div class="w2mItemName"><a href="Product/{p['name'].replace(' ', '-')}_{p['id']}.aspx">{p['name']}</a></div>
+<div class="priceContainer">{price_html}</div>
+<div class="stockStatus"><span class="status">{STOCK[(p['id'] + store_index) % len(STOCK)]}</span></div>
+</div>''')
+        first = page * page_size + 1 if len(page_products) > 0 else 0
+        html = f'''<!DOCTYPE html><html><head><title>Liquorland</title></head><body>
+<div class="searchSortHeader"><span>{first} - {page * page_size + len(page_products)} of {len(products)} results</span></div>
+<div class="productList">{"".join(divs)}</div></body></html>'''
+        return web.Response(text=html, content_type="text/html")
+
+
+class HenrysSite:
+    """ Henrys products api, product pages with JSON-LD barcodes, and the store locations page """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def routes(self, app):
+        app.router.add_get("/henrys/api/products", self.products)
+        app.router.add_get("/henrys/product/{id}", self.product_page)
+        app.router.add_get("/henrys/store-locations", self.store_locations)
+        app.router.add_get("/henrys/images/{barcode}.png", image_handler)
+
+    async def products(self, request):
+        keys = {int(k) for k in request.query.get("categories", "").split(",") if k}
+        page = int(request.query.get("page", 0))
+        products = [p for p in self.catalog.products if len(keys) == 0 or p["department"] in keys]
+        page_products = products[page * HENRYS_PAGE_SIZE:(page + 1) * HENRYS_PAGE_SIZE]
+        origin = str(request.url.origin())
+
+        items = []
+        for p in page_products:
+            price, sale_price = self.catalog.store_price(p, 0)
+            items.append({
+                "id": p["id"],
+                "title": p["name"],
+                "url": f"{origin}/henrys/product/{p['id']}",
+                "productPrice": sale_price or price,
+                "isOnSpecial": sale_price is not None,
+                "savings": round(price - sale_price, 2) if sale_price is not None else None,
+                "sites": [str(s["id"]) for i, s in enumerate(self.catalog.stores) if self.catalog.in_store(p, i)],
+                "subDepartmentKey": p["department"]
+            })
+        return web.json_response({"totalPages": math.ceil(len(products) / HENRYS_PAGE_SIZE), "products": items})
+
+    async def product_page(self, request):
+        index = int(request.match_info["id"])
+        if not 0 <= index < len(self.catalog.products):
+            raise web.HTTPNotFound()
+        p = self.catalog.products[index]
+        graph = {"@context": "https://schema.org", "@graph": [{"@type": "Product", "name": p["name"], "sku": p["barcode"]}]}
+        origin = str(request.url.origin())
+        html = f'''<!DOCTYPE html><html><head><title>{p["name"]}</title>
+<script>window.config = {{}};</script>
+<script type="application/ld+json">{json.dumps(graph)}</script></head>
+<body><img class="w-full" src="{origin}/henrys/images/{p['barcode']}.png"/></body></html>'''
+        return web.Response(text=html, content_type="text/html")
+
+    async def store_locations(self, request):
+        locations = [{
+            "title": f"Henrys {s['name']}",
+            "uri": f"store-locations/{s['id']}",
+            "regions": s["region"],
+            "locationAddress": f"{s['address']}\n{s['city']} {s['postcode']}",
+            "locationCoordinates": [{"latitude": str(s["latitude"]), "longitude": str(s["longitude"])}],
+            "siteID": s["id"]
+        } for s in self.catalog.stores]
+        html = f'''<!DOCTYPE html><html><body>
+<store-locations :locations='{json.dumps(locations).replace("'", "&#39;")}'></store-locations></body></html>'''
+        return web.Response(text=html, content_type="text/html")
+
+
+async def image_handler(request):
+    return web.Response(body=product_image(int(request.match_info["barcode"]) % 16), content_type="image/png")
+
+
+def create_app(n_stores=20, n_products=2000, latency="none", seed=1):
+    """
+    Creates the simulator application
+    :param n_stores: Number of stores for each brand
+    :param n_products: Number of products in the catalog
+    :param latency: Latency distribution spec, see stub_api.Latency
+    :param seed: Seed for generating the catalog and latencies
+    :return: aiohttp.web.Application
+    """
+    catalog = Catalog(n_stores, n_products, seed)
+    delay = Latency(latency, random.Random(seed))
+
+    @web.middleware
+    async def latency_middleware(request, handler):
+        seconds = delay.sample()
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+        return await handler(request)
+
+    app = web.Application(middlewares=[latency_middleware])
+    for site in (CountdownSite(catalog), LiquorlandSite(catalog), HenrysSite(catalog)):
+        site.routes(app)
+    return app
+
+
+def main(args):
+    """
+    Command line entry point, runs the simulator until interrupted
+    :param args: List of command line args after 'simulate-sites'
+    :return: None
+    """
+    options = {"port": "8001", "stores": "20", "products": "2000", "latency": "none", "seed": "1"}
+    for arg in args:
+        name, _, value = arg.lstrip("-").partition("=")
+        if name not in options:
+            raise ValueError(f"Unknown option '{arg}'")
+        options[name] = value
+    app = create_app(int(options["stores"]), int(options["products"]), options["latency"], int(options["seed"]))
+    web.run_app(app, port=int(options["port"]))
@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import time
+import uuid
+import sharding
+
+SPOOL_DIR = os.getenv("pisspricer.spool_dir", os.path.join(os.path.dirname(__file__), "spool"))
+
+
+class Spool:
+    """
+    On disk queue of crawled records waiting to be uploaded, one NDJSON file per crawl in '{spool_dir}/{store}'.
+    Files are named by the time they were written, with a random suffix so crawls written in the same second don't
+    replace each other. They are written as '.tmp' and renamed when complete, so only whole crawls are ever uploaded.
+    Uploaded files are moved to '{spool_dir}/{store}/done' so they can be replayed.
+    """
+
+    def __init__(self, store, spool_dir=SPOOL_DIR):
+        self.store = store
+        self.path = os.path.join(spool_dir, store.lower())
+        self.done_path = os.path.join(self.path, "done")
+
+    def write(self, records):
+        """
+        Writes records to a new spool file
+        :param records: Iterable of json serializable records
+        :return: Path of the spool file
+        """
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}{sharding.current.suffix}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(self.path, f"{name}.ndjson")
+        count = 0
+        with open(path + ".tmp", "w") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")))
+                f.write("\n")
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        print(f"Spooled {count} {self.store} records to {path}")
+        return path
+
+    def pending(self):
+        """
+        :return: List of complete spool file paths waiting to be uploaded, oldest first
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path)) if name.endswith(".ndjson")]
+
+    @staticmethod
+    def read(path):
+        """
+        Reads the records of a spool file
+        :param path: Spool file path
+        :return: List of records
+        """
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def mark_done(self, path):
+        """
+        Moves an uploaded spool file to the done directory
+        :param path: Spool file path
+        :return: New path of the file
+        """
+        os.makedirs(self.done_path, exist_ok=True)
+        done = os.path.join(self.done_path, os.path.basename(path))
+        shutil.move(path, done)
+        return done
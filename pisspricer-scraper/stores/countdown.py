@@ -1,4 +1,7 @@
 import api
+import asyncio
+import math
+import os
 from stores import generic_store
 import time
 import requests
@@ -6,12 +9,19 @@ import tools
 from custom_exceptions import *
 import custom_requests as custom_reqs
 from pisspricer import Pisspricer
+import metrics
+import tracing
+import sharding
+import location_sync
+import paginator
+import taxonomy
+import reference_data
 
 
 class Countdown(generic_store.Store):
 
     cd_brand_id = 5
-    cd_base_url = "https://shop.countdown.co.nz/api/v1"
+    cd_base_url = os.getenv("countdown.url", "https://shop.countdown.co.nz") + "/api/v1"
     cd_items = "/products?dasFilter=Department%3B%3Bbeer-wine%3Bfalse&target=browse"
     cd_stores = "/addresses/pickup-addresses"
     cd_headers = {"x-requested-with": "OnlineShopping.WebApp"}
@@ -21,9 +31,16 @@ class Countdown(generic_store.Store):
     page_lim_str = "&size=" + str(page_lim)
 
     def __init__(self):
-        self.cookies = self.get_session_cookie()
+        self._cookies = None
         super().__init__()
 
+    @property
+    def cookies(self):
+        """ Countdown API session cookie, fetched on first use so uploading doesn't need the Countdown API """
+        if self._cookies is None:
+            self._cookies = self.get_session_cookie()
+        return self._cookies
+
     @staticmethod
     def get_session_cookie():
         """ Gets and returns a session cookie from countdown API
@@ -31,116 +48,37 @@ class Countdown(generic_store.Store):
             @return cookie  - Dict of cookie containing a Countdown API session id
         """
         res = requests.get(Countdown.cd_base_url + Countdown.cd_items,
-                           headers=Countdown.cd_headers)
+                           headers=Countdown.cd_headers,
+                           hooks=custom_reqs.requests_hooks)
         return {"ASP.NET_SessionId": res.cookies["ASP.NET_SessionId"]}
 
-    @staticmethod
-    def _get_new_stores(cd_json, cur_locations_json):
-        """ Returns countdown stores which aren't already in the database
-
-            @param cd_json             - List of stores from Countdown API
-            @param cur_locations_json  - List of stores from pisspricer API
-            @returns post_list         - List of new stores from Countdown API
-        """
-        post_list = []
-        for location in cd_json["storeAreas"][0]["storeAddresses"]:
-            # Check if store location is already in db
-            new_location = True
-            for cur_location in cur_locations_json:
-                if str(cur_location["internalId"]) == str(location["id"]):
-                    new_location = False
-                    break
-
-            if new_location:
-                post_list.append(location)
-        return post_list
-
-    @staticmethod
-    def _post_stores(post_list, regions):
-        """ Iterate through store locations and post to api
-
-            @param post_list    - List of stores from Countdown API to be posted to pisspricer api
-            @param regions      - List of regions from pisspricer API
-        """
-
-        Countdown.print_progress(0, len(post_list), title=Countdown.name + " Inserting Stores")
-        i = 0
-        for store_loc in post_list:
-            try:
-                # Get lat and lng
-                address_string = store_loc["name"] + ", " + store_loc["address"] + ", New Zealand"
-                lat, lng, address, postcode, region = tools.geocode_address(address_string)
-
-                # Set regionId
-                region_id = None
-                for reg in regions:
-                    if reg["name"] == region:
-                        region_id = reg["regionId"]
-                if region_id is None:
-                    new_region_res = requests.post(api.url + "/regions",
-                                                   headers=api.headers,
-                                                   json={"name": region})
-                    if not new_region_res.ok:
-                        raise PisspricerApiException(new_region_res, f"posting to /regions {region}")
-                    region_id = new_region_res.json()["regionId"]
-
-                # Set store values
-                store = {
-                    "name": store_loc["name"],
-                    "url": Countdown.store_url,
-                    "brandId": Countdown.cd_brand_id,
-                    "lattitude": lat,
-                    "longitude": lng,
-                    "regionId": region_id,
-                    "address": address,
-                    "postcode": postcode,
-                    "internalId": str(store_loc["id"])
-                }
-
-                # Post new store
-                new_store_res = requests.post(api.url + '/stores',
-                                              headers=api.headers,
-                                              json=store)
-                if not new_store_res.ok:
-                    raise PisspricerApiException(new_store_res, f"posting to /stores {store}")
-
-            except ApiException as err:
-                tools.log_error(err)
-
-            finally:
-                i += 1
-                Countdown.print_progress(i, len(post_list))
-                if i > 1000:
-                    break
-
-    def update_locations(self, debug=False):
+    def update_locations(self):
         """ Get stores from Countdown API and add all stores which are new """
         task = "update_locations"
 
-        # Get current locations from pisspricer api
-        cur_locations_res = requests.get(api.url + "/stores",
-                                         headers=api.headers,
-                                         params={"brandId": Countdown.cd_brand_id})
-        if not cur_locations_res.ok:
-            raise PisspricerApiException(cur_locations_res.status_code, task)
-
         # Get locations from Countdown api
         cd_locations_res = requests.get(Countdown.cd_base_url + Countdown.cd_stores,
-                                        headers=Countdown.cd_headers)
+                                        headers=Countdown.cd_headers,
+                                        hooks=custom_reqs.requests_hooks)
         if not cd_locations_res.ok:
-            raise CountdownApiException(cd_locations_res.status_code, task)
-
-        # Get regions from pisspricer api
-        regions_res = requests.get(api.url + "/regions",
-                                   headers=api.headers)
-        if not regions_res.ok:
-            raise PisspricerApiException(cur_locations_res.status_code, task)
-
-        # Iterate through store locations and check which ones are new
-        post_list = self._get_new_stores(cd_locations_res.json(), cur_locations_res.json())
-
-        # Post stores to pisspricer api
-        self._post_stores(post_list, regions_res.json())
+            raise CountdownApiException(cd_locations_res, task)
+
+        # Address data is left for location sync to geocode
+        locations = [{
+            "name": location["name"],
+            "url": Countdown.store_url,
+            "address": location["address"] + ", New Zealand",
+            "postcode": None,
+            "internalId": str(location["id"]),
+            "region": None,
+            "region_lat": None,
+            "region_lng": None,
+            "lattitude": None,
+            "longitude": None
+        } for location in cd_locations_res.json()["storeAreas"][0]["storeAddresses"]]
+
+        # Post new stores to pisspricer api
+        location_sync.sync_locations(api, self.name, Countdown.cd_brand_id, locations, self.print_progress)
 
     def _set_store(self, internal_id):
         """ Sets the current store of the session id
@@ -152,54 +90,136 @@ class Countdown(generic_store.Store):
         res = requests.put(Countdown.cd_base_url + "/fulfilment/my/pickup-addresses",
                            headers=self.cd_headers,
                            cookies=self.cookies,
-                           json=body)
+                           json=body,
+                           hooks=custom_reqs.requests_hooks)
         if not res.ok:
             raise CountdownApiException(res, task)
 
-    def update_all_items(self, debug=False):
-        """ Updates all items for all known Countdown store """
-        task = "update_all_items"
+    def crawl(self, run):
+        """
+        Gets items from the Countdown API for all known Countdown stores
+        :param run: RunCheckpoint for the run
+        :return: List of records, one per store and aisle {"internalId": str, "aisle": str, "items": []}
+        """
+        with self.phase("get stores"):
+            stores = sharding.current.filter_stores(self._get_stores())
 
-        # Get all current countdown stores
-        stores_res = requests.get(api.url + "/stores",
-                                  headers=api.headers,
-                                  params={"brandId": Countdown.cd_brand_id})
-        if not stores_res.ok:
-            raise PisspricerApiException(stores_res, task)
-        stores = stores_res.json()
+        # Iterate through stores and get items from countdown api
+        with self.phase("get items"):
+            cd_items_dict = run.run("get items", self._get_cd_items, stores)
 
-        # Get a set of barcodes from pisspricer
-        barcodes_res = requests.get(api.url + "/barcodes",
-                                    headers=api.headers)
-        tools.check_pisspricer_res(barcodes_res, task)
-        barcodes = barcodes_res.json()
+        return self._to_records(cd_items_dict)
 
-        # Iterate through stores and get items from countdown api
-        cd_items_dict = self._get_cd_items(stores)
+    def crawl_units(self):
+        """
+        :return: List of countdown stores from pisspricer api, one unit each
+        """
+        return sharding.current.filter_stores(self._get_stores())
 
-        # Get categories
-        categories_res = requests.get(api.url + "/categories", headers=api.headers)
-        tools.check_pisspricer_res(categories_res, task)
-        categories = categories_res.json()
+    def crawl_unit(self, store):
+        """
+        Gets items from the Countdown API for one store
+        :param store: Countdown store from pisspricer api
+        :return: List of records, as returned by crawl
+        """
+        return self._to_records(self._get_cd_items([store]))
 
+    @staticmethod
+    def _to_records(cd_items_dict):
+        """
+        :param cd_items_dict: Dictionary of items from _get_cd_items
+        :return: List of records, one per store and category
+        """
+        return [{"internalId": cd_id, **cat_obj} for cd_id, cats in cd_items_dict.items() for cat_obj in cats]
+
+    def upload(self, records, run):
+        """
+        Creates new items, uploads their images and puts prices for crawled countdown items
+        :param records: List of records from crawl
+        :param run: RunCheckpoint for the run
+        :return: None
+        """
+        cd_items_dict = dict()
+        for record in records:
+            cd_items_dict.setdefault(record["internalId"], []).append({"aisle": record["aisle"],
+                                                                       "items": record["items"]})
+
+        with self.phase("create new items"):
+            barcodes = self._get_barcodes()
+            created = run.run("create new items", self._create_new_items, cd_items_dict, barcodes)
+            new_items = created["new_items"]
+            barcodes = created["barcodes"]
+
+        with self.phase("upload images"):
+            run.run("upload images", self._upload_images, cd_items_dict, new_items, barcodes)
+
+        # Put price data into pisspricer api
+        with self.phase("put prices"):
+            prices_list = self._create_price_list(self._get_stores(), cd_items_dict, barcodes)
+
+            def put_batch(batch):
+                return custom_reqs.put_prices(batch, api.url, headers=api.headers, store=self.name)
+
+            run.run_batches("put prices", prices_list, put_batch)
+
+    @staticmethod
+    def _get_stores():
+        """
+        Gets all current countdown stores from pisspricer api
+        :return: List of stores
+        """
+        return reference_data.get_stores(api, Countdown.cd_brand_id)
+
+    def _create_new_items(self, cd_items_dict, barcodes):
+        """
+        Posts countdown items with barcodes not in pisspricer yet
+        :param cd_items_dict: Dictionary of countdown stores and items
+        :param barcodes: Dictionary of barcodes to skus from pisspricer api
+        :return: Dict {"new_items": list of posted items, "barcodes": barcodes from pisspricer api after posting}
+        """
         # Get a list of new items
-        new_items = self._get_new_items(cd_items_dict, barcodes, categories)
+        new_items = self._get_new_items(cd_items_dict, barcodes)
+        taxonomy.countdown.report()
+
+        # Async post all new items. Items already created by another shard are rejected, and get their skus from the
+        # barcodes got after posting
+        self._post_items(new_items)
+
+        return {"new_items": new_items, "barcodes": self._get_barcodes()}
 
-        # Async post all new items
+    def _post_items(self, new_items):
+        """
+        Posts new items to pisspricer api
+        :param new_items: List of items from _get_new_items
+        :return: None
+        """
         if len(new_items) != 0:
             self.print_progress(0, len(new_items), "upload new items")
             new_items_skus = tools.async_post_items(new_items,
                                                     api.url + "/items",
                                                     headers=api.headers,
                                                     printer=(self.print_progress, len(new_items), "upload new items"))
+            # Posts of items that already exist return None
+            created = sum(1 for res in new_items_skus if res is not None)
+            metrics.items_uploaded.inc(created, store="countdown", kind="item", result="201")
+            metrics.items_uploaded.inc(len(new_items_skus) - created, store="countdown", kind="item", result="409")
 
-        # Get a set of barcodes from pisspricer
-        barcodes_res = requests.get(api.url + "/barcodes",
-                                    headers=api.headers)
-        tools.check_pisspricer_res(barcodes_res, task)
-        barcodes = barcodes_res.json()
+    @staticmethod
+    def _get_barcodes():
+        """
+        Gets all barcodes from pisspricer api
+        :return: Dict of barcodes to skus
+        """
+        return reference_data.get_barcodes(api)
 
-        # Upload images for new items
+    def _upload_images(self, cd_items_dict, new_items, barcodes):
+        """
+        Uploads images for countdown items without one
+        :param cd_items_dict: Dictionary of countdown stores and items
+        :param new_items: List of items posted this run
+        :param barcodes: Dictionary of barcodes to skus from pisspricer api
+        :return: None
+        """
         pisspricer = Pisspricer(api)
         new_images_url = []
 
@@ -211,7 +231,7 @@ class Countdown(generic_store.Store):
                     try:
                         image_url = item["images"]["big"]
                         barcode = item["barcode"]
-                        sku = barcodes[barcode][0]
+                        sku = barcodes[barcode]
                         new_images_url.append({"sku": sku, "image_url": image_url})
                     except Exception as err:
                         tools.log_error(err)
@@ -226,26 +246,20 @@ class Countdown(generic_store.Store):
         #                                         headers=api.headers,
         #                                         printer=(self.print_progress, len(new_images), "upload item images"))
 
-        # Put price data into pisspricer api
-        prices_list = self._create_price_list(stores, cd_items_dict, barcodes)
-        price_data_res = custom_reqs.put_prices(prices_list,
-                                                api.url,
-                                                headers=api.headers)
-
     @staticmethod
     def _create_price_list(stores, cd_items_dict, barcodes):
         """
         Iterate through countdown items and create price data
         :param stores: List of countdown stores from pisspricer api
         :param cd_items_dict: Dictionary of countdown stores and items
-        :param barcodes: Dictionary of barcodes from pisspricer api
+        :param barcodes: Dictionary of barcodes to skus from pisspricer api
         :return: List of (sku, store_id, payload) tuples
         """
 
         # Create a dict of {"cd_id": "store_id"}
         store_dict = {}
         for store in stores:
-            cd_id = store["internalId"]
+            cd_id = str(store["internalId"])
             store_dict[cd_id] = store["storeId"]
 
         # Create a list of price data tuples
@@ -265,13 +279,15 @@ class Countdown(generic_store.Store):
                             price_item["salePrice"] = item["price"]["salePrice"]
 
                         # Get storeId and sku
-                        store_id = store_dict[cd_id]
-                        sku = barcodes[item["barcode"]][0]
+                        store_id = store_dict[str(cd_id)]
+                        sku = barcodes[item["barcode"]]
+                        if sku is None:
+                            raise KeyError(f"No sku for barcode {item['barcode']}")
 
                         # Add data to list
                         price_data.append((sku, store_id, price_item,))
                     except Exception as err:
-                        tools.log_error(err)
+                        tools.log_error(err, internalSku=item.get("sku"), storeId=cd_id)
 
         return price_data
 
@@ -280,25 +296,27 @@ class Countdown(generic_store.Store):
         """
         Returns a list of new images
         :param new_items: List of dict items that are new
-        :param barcodes: Dictionary of barcodes from pisspricer api
+        :param barcodes: Dictionary of barcodes to skus from pisspricer api
         :return: List of (sku, image)
         """
         new_images_url = []
         for item in new_items:
             barcode = item["barcode"]
-            if barcode in barcodes:
-                sku = barcodes[barcode][0]
+            if barcodes.get(barcode) is not None:
+                sku = barcodes[barcode]
                 new_images_url.append((sku, item["image_url"]))
         new_images = custom_reqs.async_get_images(new_images_url)
         return new_images
 
     @staticmethod
-    def _get_new_items(cd_items, barcodes, cur_cats):
+    def _get_new_items(cd_items, barcodes, categories=None):
         """
         Take a dictionary of countdown items and return a list of items that aren't in the database.
-        Categorys that aren't in database get added as it goes
+        Aisles are mapped to categories by taxonomy.countdown. Aisles missing from it are counted there, and get a
+        category (or a wine subcategory) named after the aisle, which is created if it doesn't exist.
         :param cd_items: Dictionary of countdown items
         :param barcodes: Dictionary of barcodes that are currently in the database
+        :param categories: Dictionary of categories from pisspricer api by name, got when first needed if not given
         :return: List of json items that aren't in the database
         """
         new_items = []
@@ -306,67 +324,55 @@ class Countdown(generic_store.Store):
         for store_id, cats in cd_items.items():
             for cat_obj in cats:
                 try:
-                    # Get cats
-                    cat = cat_obj["cat"].lower()
-                    subcat = None if cat_obj["subcat"] is None else cat_obj["subcat"].lower()
-
-                    # Create cat and subcat if they dont exist
-                    if cat not in cur_cats:
-                        # create cat
-                        cat_id = tools.post_category(cat)
-                        # Add to dict
-                        cur_cats[cat] = {
-                            "category": cat,
+                    items = [item for item in cat_obj["items"]
+                             if item["barcode"] not in barcodes and item["barcode"] not in new_barcodes]
+                    if len(items) == 0:
+                        continue
+                    cat_id, subcat_id = taxonomy.countdown.lookup(cat_obj["aisle"], count=len(items))
+                    if cat_id is None:
+                        if categories is None:
+                            categories = tools.get_categories()
+                        cat_id, subcat_id = Countdown._aisle_category(cat_obj["aisle"], categories)
+
+                    for item in items:
+                        if item["barcode"] in new_barcodes:
+                            continue
+                        volume = item["size"]["volumeSize"]
+                        new_item = {
+                            "name": item["name"] + (" " + volume if volume is not None else ""),
+                            "brand": item["brand"],
+                            "barcode": item["barcode"],
                             "categoryId": cat_id,
-                            "subcategories": []
+                            "image_url": item["images"]["big"],
                         }
-                    else:
-                        cat_id = cur_cats[cat]["categoryId"]
-
-                    subcat_id = None
-                    if subcat is not None:
-                        # Subcat specified
-                        subcats = cur_cats[cat]["subcategories"]
-                        for sub in subcats:
-                            if sub["subcategory"] == subcat:
-                                subcat_id = sub["subcategoryId"]
-                                break
-
-                        if subcat_id is None:
-                            # Subcat needs to be created
-                            subcat_id = tools.post_subcategory(cat_id, subcat)
-                            cur_cats[cat]["subcategories"].append({
-                                "subcategory": subcat,
-                                "subcategoryId": subcat_id
-                            })
-
-                    items = cat_obj["items"]
-                    for item in items:
-                        if item["barcode"] not in barcodes and item["barcode"] not in new_barcodes:
-                            volume = item["size"]["volumeSize"]
-                            new_item = {
-                                "name": item["name"] + (" " + volume if volume is not None else ""),
-                                "brand": item["brand"],
-                                "barcode": item["barcode"],
-                                "categoryId": cat_id,
-                                "image_url": item["images"]["big"],
-                            }
-                            if subcat_id is not None:
-                                new_item["subcategoryId"] = subcat_id
-                            new_items.append(new_item)
-                            new_barcodes.add(item["barcode"])
+                        if subcat_id is not None:
+                            new_item["subcategoryId"] = subcat_id
+                        new_items.append(new_item)
+                        new_barcodes.add(item["barcode"])
                 except Exception as err:
                     tools.log_error(err)
-                    # raise err
 
         return new_items
 
+    @staticmethod
+    def _aisle_category(aisle, categories):
+        """
+        Gets the category ids for an aisle that isn't in the taxonomy, creating the category and subcategory if they
+        don't exist. Wine aisles are subcategories of wine, other aisles are categories of their own.
+        :param aisle: Aisle name
+        :param categories: Dictionary of categories from pisspricer api by name, updated with any created
+        :return: (categoryId, subcategoryId) 2-tuple, subcategoryId is None for categories of their own
+        """
+        aisle = aisle.lower()
+        cat, subcat = ("wine", aisle) if "wine" in aisle else (aisle, None)
+        return tools.find_or_create_category(categories, cat, subcat)
+
     def _get_cd_items(self, stores):
         """
         Gets all items from Countdown API
 
         :param stores: List of Countdown stores from pisspricer api
-        :return: Dictionary of items {cd_id: [{'cat': str, 'subcat': str, 'items': []}] }
+        :return: Dictionary of items {cd_id: [{'aisle': str, 'items': []}] }
         """
         task = "_get_cd_items"
         item_url = self.cd_base_url + self.cd_items + self.page_lim_str
@@ -375,65 +381,66 @@ class Countdown(generic_store.Store):
         count = 0
         self.print_progress(0, len(stores), task)
         for store in stores:
-            try:
-                # Set store and get first page items
-                self._set_store(store["internalId"])
-                items_res = requests.get(item_url,
-                                         headers=self.cd_headers,
-                                         cookies=self.cookies)
-                if not items_res.ok:
-                    raise CountdownApiException(items_res, task)
-                items_json = items_res.json()
-
-                # Generate url's
-                cats = items_json["dasFacets"]
-                urls = []
-                for cat in cats:
-                    cat_name = cat["name"]
-                    cat_count = cat["productCount"]
-                    url_end = f"&dasFilter=Aisle;;{cat_name.replace(' ', '-').replace('&', '')};false"
-                    if "wine" in cat_name:
-                        cat_info = {
-                            "cat": "Wine",
-                            "subcat": cat_name
-                        }
-                    else:
-                        cat_info = {
-                            "cat": cat_name,
-                            "subcat": None
-                        }
-                    urls += tools.generate_url_pages(item_url + "&page=", cat_count, self.page_lim,
-                                                     url_end=url_end, carry=cat_info)
-                responses = tools.async_get_list(urls, headers=self.cd_headers, cookies=self.cookies)
-
-                # Iterate through responses and make a list of data
-                items = []
-                for res in responses:
-                    # Check if cat is already in list
-                    res_cat = res["carry"]
-                    cat_in_list = False
-                    index = -1
-                    for i, cat in enumerate(items):
-                        if cat["cat"] == res_cat["cat"] and cat["subcat"] == res_cat["subcat"]:
-                            cat_in_list = True
-                            index = i
-                            break
-
-                    if cat_in_list:
-                        items[i]["items"] += res['products']['items']
-                    else:
-                        items.append({"cat": res_cat["cat"],
-                                      "subcat": res_cat["subcat"],
-                                      "items": res['products']['items']})
-
-                # Assign items to dict
-                items_dict[store["internalId"]] = items
-
-            except Exception as err:
-                tools.log_error(err)
-            finally:
-                count += 1
-                self.print_progress(count, len(stores), task)
+            with tracing.span("countdown store", internalId=store["internalId"]):
+                try:
+                    # Set store and get first page items
+                    self._set_store(store["internalId"])
+                    items_res = requests.get(item_url,
+                                             headers=self.cd_headers,
+                                             cookies=self.cookies,
+                                             hooks=custom_reqs.requests_hooks)
+                    if not items_res.ok:
+                        raise CountdownApiException(items_res, task)
+                    items_json = items_res.json()
+
+                    # Get the pages of every aisle concurrently
+                    items = asyncio.run(self._async_get_aisles(item_url, items_json["dasFacets"]))
+                    metrics.items_parsed.inc(sum(len(aisle["items"]) for aisle in items), store="countdown")
+
+                    # Assign items to dict
+                    items_dict[store["internalId"]] = items
+
+                except Exception as err:
+                    tools.log_error(err)
+                finally:
+                    count += 1
+                    self.print_progress(count, len(stores), task)
 
         return items_dict
 
+    async def _async_get_aisles(self, item_url, aisles):
+        """
+        Gets the items of every aisle of the current store
+        :param item_url: Url of the products api
+        :param aisles: List of aisle facets from the products api [{"name": str, "productCount": int}]
+        :return: List of aisles [{'aisle': str, 'items': []}]
+        """
+        async with custom_reqs.client_session() as session:
+            return await asyncio.gather(*[self._async_get_aisle(session, item_url, aisle)
+                                          for aisle in aisles if aisle["productCount"] > 0])
+
+    async def _async_get_aisle(self, session, item_url, aisle):
+        """
+        Gets the items of an aisle, fetching its pages concurrently
+        :param session: Aiohttp session
+        :param item_url: Url of the products api
+        :param aisle: Aisle facet from the products api {"name": str, "productCount": int}
+        :return: Dict {'aisle': str, 'items': []}
+        """
+        task = "_get_cd_items"
+        name = aisle["name"]
+        url_end = f"&dasFilter=Aisle;;{name.replace(' ', '-').replace('&', '')};false"
+
+        async def fetch_page(p):
+            async with session.get(f"{item_url}&page={p}{url_end}", headers=self.cd_headers,
+                                   cookies=self.cookies) as res:
+                if res.status != 200:
+                    raise AiohttpException(custom_reqs.Response(res, None, res.headers, None, None), task, self.name)
+                return (await res.json())['products']['items']
+
+        items = []
+        n_pages = math.ceil(aisle["productCount"] / self.page_lim)
+        async for _, page_items in paginator.paginate(fetch_page, start=1, stop=n_pages + 1):
+            items.extend(page_items)
+        return {"aisle": name, "items": items}
+
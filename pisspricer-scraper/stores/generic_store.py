@@ -1,43 +1,133 @@
-import tools
 import os
+import time
+import checkpoint
+import phases
+import progress
+import tools
+from dead_letter import dead_letters
+from spool import Spool
 from abc import ABC, abstractmethod
 
+UPLOAD_ATTEMPTS = 3
+
 
 class Store(ABC):
 
+    name = ""
+
     @abstractmethod
-    def update_all_items(self):
+    def crawl(self, run):
+        """
+        Crawls the store's website
+        :param run: RunCheckpoint for the run
+        :return: List of json serializable records for upload
+        """
         pass
 
     @abstractmethod
-    def update_locations(self):
+    def upload(self, records, run):
+        """
+        Uploads crawled records to the pisspricer api
+        :param records: List of records from crawl
+        :param run: RunCheckpoint for the run
+        :return: None
+        """
         pass
 
-    @staticmethod
-    def print_progress(iteration, total, title=""):
+    @abstractmethod
+    def crawl_units(self):
         """
-        Print progress bar
-        :param iteration: Iteration number
-        :param total: Total number of iterations there will be
-        :param title: Title to print on iteration zero
+        Splits the store's crawl into units of work for the work queue, see work_queue.py
+        :return: List of json serializable units
+        """
+        pass
+
+    @abstractmethod
+    def crawl_unit(self, unit):
+        """
+        Crawls one unit of work from crawl_units
+        :param unit: Unit from crawl_units
+        :return: List of json serializable records for upload, as returned by crawl
+        """
+        pass
+
+    def update_all_items(self):
+        """
+        Crawls the store and uploads the items and prices
         :return: None
         """
-        length = 50
+        run = checkpoint.for_store(self.name)
+        self.retry_failed()
+        self.upload(self.crawl(run), run)
+        run.finish()
 
-        # Print Title
-        if iteration == 0:
-            dash_n = len('Progress:' + 'Complete') + length - len(title)
-            if dash_n % 2 == 0:
-                dash_l = dash_r = dash_n // 2
-            else:
-                dash_l = dash_r = dash_n // 2
-                dash_l += 1
-            os.system('clear')
-            print(dash_l * "-" + title + dash_r * "-")
+    def retry_failed(self, rounds=1):
+        """
+        Replays this store's failed uploads from earlier runs that are due for a retry
+        :param rounds: Number of passes over the failed uploads, see DeadLetterStore.drain
+        :return: None
+        """
+        replayed, succeeded = dead_letters.drain(store=self.name, rounds=rounds)
+        if replayed > 0:
+            print(f"Replayed {replayed} failed {self.name} uploads, {succeeded} succeeded")
 
-        # Print bar
-        tools.print_progress_bar(iteration, total, prefix='Progress:', suffix='Complete', length=length)
+    def spool_items(self):
+        """
+        Crawls the store and writes the records to the spool, to be uploaded later by upload_spooled
+        :return: Path of the spool file
+        """
+        run = checkpoint.for_store(self.name)
+        path = Spool(self.name).write(self.crawl(run))
+        run.finish()
+        return path
 
+    def upload_spooled(self, attempts=UPLOAD_ATTEMPTS):
+        """
+        Uploads every pending spool file of the store, oldest first.
+        Each file's upload is checkpointed, so a retry or the next call continues from the last confirmed batch.
+        Files that still fail after all attempts stay in the spool.
+        :param attempts: Number of attempts for each file, with exponential backoff between them
+        :return: Number of files uploaded
+        """
+        spool = Spool(self.name)
+        self.retry_failed()
+        uploaded = 0
+        for path in spool.pending():
+            stem = os.path.basename(path).split(".")[0]
+            for attempt in range(attempts):
+                run = checkpoint.RunCheckpoint(f"{self.name}-upload-{stem}", resume_run=True)
+                try:
+                    self.upload(spool.read(path), run)
+                    run.remove()
+                    spool.mark_done(path)
+                    uploaded += 1
+                    break
+                except Exception as err:
+                    tools.log_error(err, spool_file=path, attempt=attempt + 1)
+                    print(f"Upload of {path} failed on attempt {attempt + 1}: {err}")
+                    if attempt + 1 < attempts:
+                        time.sleep(30 * 2 ** attempt)
+        return uploaded
 
+    @abstractmethod
+    def update_locations(self):
+        pass
 
+    def phase(self, name):
+        """
+        Context manager for timing a phase of this store's run
+        :param name: Phase name
+        :return: Context manager
+        """
+        return phases.phase(self.name, name)
 
+    @staticmethod
+    def print_progress(iteration, total, title=""):
+        """
+        Report progress, rendered off the hot path by the progress reporter
+        :param iteration: Iteration number
+        :param total: Total number of iterations there will be
+        :param title: Title of the task, starts a new task on iteration zero
+        :return: None
+        """
+        progress.reporter.update(iteration, total, title)
@@ -2,11 +2,14 @@ from stores.generic_store import Store
 from stores.henrys.model import HenrysModel
 from pisspricer import Pisspricer
 import api
+import location_sync
 
 
 class Henrys(Store):
 
     BRAND_ID = 7
+    name = "Henrys"
+    PAGES_PER_UNIT = 5
 
     def __init__(self):
         super().__init__()
@@ -21,14 +24,31 @@ class Henrys(Store):
         locations = self.model.get_locations()
 
         # Upload new locations
-        pisspricer = Pisspricer(api)
-        pisspricer.upload_new_stores(locations, self.BRAND_ID,
-                                     (self.print_progress, len(locations), 'Get Locations'))
+        location_sync.sync_locations(api, self.name, self.BRAND_ID, locations, self.print_progress)
+
+    def crawl(self, run):
+        with self.phase("get items"):
+            return run.run("get items", self.model.get_items)
+
+    def crawl_units(self):
+        """
+        :return: List of {"pages": [start, stop]} units, PAGES_PER_UNIT pages of the products api each
+        """
+        count = self.model.page_count()
+        return [{"pages": [start, min(start + self.PAGES_PER_UNIT, count)]}
+                for start in range(0, count, self.PAGES_PER_UNIT)]
+
+    def crawl_unit(self, unit):
+        """
+        Gets the items on a range of pages of the products api
+        :param unit: Unit from crawl_units
+        :return: List of items
+        """
+        return self.model.get_items(unit["pages"])
 
-    def update_all_items(self):
-        items = self.model.get_items()
+    def upload(self, items, run):
         pisspricer = Pisspricer(api)
-        pisspricer.update_item_prices(items, self.BRAND_ID, 'Henrys', self.print_progress)
+        pisspricer.update_item_prices(items, self.BRAND_ID, 'Henrys', self.print_progress, checkpoint=run)
         # TODO Run and check if works
 
 if __name__ == '__main__':
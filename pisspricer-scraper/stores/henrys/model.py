@@ -4,16 +4,30 @@ from stores.henrys.store_processor import process_stores_page
 import asyncio
 from pisspricer import Pisspricer
 import api
-from stores.generic_model import Model
-from stores.henrys.item_processor import process_henry_items, process_item_pages
+from stores.henrys.item_processor import process_henry_item, process_item_page
+from custom_exceptions import AiohttpException
 import copy
+import json
+import os
+import metrics
+import paginator
+import sharding
+import taxonomy
+import tools
+import reference_data
 
 
-class HenrysModel(Model):
+class HenrysModel:
+
+    base_url = os.getenv("henrys.url", "https://www.henrys.co.nz")
+    # Every department in the taxonomy
+    category_ids = [key for keys in taxonomy.HENRYS.values() for key in keys]
 
     def __init__(self, printer, brand_id):
         self.print_func = printer
         self.BRAND_ID = brand_id
+        # Categories from pisspricer api by name, got when first needed for a department missing from the taxonomy
+        self._categories = None
 
     @staticmethod
     def get_locations():
@@ -21,14 +35,15 @@ class HenrysModel(Model):
         Gets locations from
         :return:
         """
-        url = "https://www.henrys.co.nz/store-locations"
-        res = requests.get(url)
+        url = HenrysModel.base_url + "/store-locations"
+        res = requests.get(url, hooks=req.requests_hooks)
         stores = process_stores_page(res.content)
         return stores
 
-    def get_items(self):
+    def get_items(self, pages=None):
         """
         Gets all items from the henrys website
+        :param pages: [start, stop) range of products api pages to get, defaults to all of them
         :return: List of store items
         [
             {
@@ -48,94 +63,171 @@ class HenrysModel(Model):
             }
         ]
         """
-        henry_api_items = self._get_henry_items()
-        items_no_barcode = process_henry_items(henry_api_items)
-        print(len(items_no_barcode))
-        items = self.get_items_barcodes(items_no_barcode)
+        # Store ids are looked up as the items arrive
+        cur_locs = reference_data.get_stores(api, self.BRAND_ID)
+        store_ids = {int(loc['internalId']): loc['storeId'] for loc in cur_locs}
+
+        items = asyncio.run(self._async_get_items(pages, store_ids))
+        taxonomy.henrys.report()
         return items
 
-    def get_items_barcodes(self, items):
-        """
-        Gets barcodes and image urls for all items
-        :param items: List of items
-        :return: List of dict items with barcode, and image_url added
-        """
-        request_list = [(item['url'], item) for item in items]
-        iteration = [0]
-        self.print_func(0, len(request_list), 'Get Item barcodes')
-        responses = asyncio.run(
-            req.create_async_tasks(
-                request_list,
-                {
-                    "printer": (
-                        self.print_func,
-                        len(request_list),
-                        'Get item barcodes'
-                    ),
-                    "iteration": iteration
-                },
-                self._async_get))
-
-        items = process_item_pages(responses)
-        new_items = self.add_store_ids(items)
-        return new_items
+    async def _async_get_items(self, pages, store_ids):
+        """
+        Gets the items as a stream. Products api pages are made into items as they arrive, and the items are queued for
+        workers getting their product pages for barcodes and image urls. Each page is parsed and dropped on arrival,
+        and the queue is bounded, so only the pages and items in flight are held rather than every response.
+        :param pages: [start, stop) range of products api pages to get, None for all of them
+        :param store_ids: Dict of henrys store ids to pisspricer store ids
+        :return: List of store items
+        """
+        if pages is None:
+            cache = req.HttpCache("henrys-products").load()
+        else:
+            cache = req.HttpCache(f"henrys-products-{pages[0]}-{pages[1]}").load()
+
+        item_queue = asyncio.Queue(maxsize=req.concurrency)
+        items = []
+
+        async def get_products(session):
+            try:
+                async for products in self._async_get_products(session, pages, cache):
+                    for product in products:
+                        try:
+                            item = process_henry_item(product)
+                            if item['categoryId'] is None:
+                                item['categoryId'], item['subcategoryId'] = self._department_category(product)
+                        except Exception as err:
+                            tools.log_error(err, url=product.get('url'))
+                            continue
+
+                        # Henrys lists every store's products at once, so shards split the products not the stores
+                        if sharding.current.owns(item['internalSku']):
+                            metrics.items_parsed.inc(store="henrys")
+                            await item_queue.put(item)
+            finally:
+                for _ in range(req.concurrency):
+                    await item_queue.put(None)
 
-    def add_store_ids(self, items):
-        """ Returns a new item list based on the henry stores """
-        cur_locations_res = req.get(api.url + "/stores",
-                                    headers=api.headers,
-                                    params={"brandId": self.BRAND_ID})
-        cur_locs = cur_locations_res.json()
-        store_id_mappings = {int(loc['internalId']): loc['storeId'] for loc in cur_locs}
+        async def get_barcodes(session):
+            item = await item_queue.get()
+            while item is not None:
+                try:
+                    text = await self._async_get_item_page(session, item['url'])
+                    items.extend(self._store_items(process_item_page(item, text), store_ids))
+                except Exception as err:
+                    tools.log_error(err, url=item['url'])
+                item = await item_queue.get()
+
+        async with req.client_session() as session:
+            # Workers finish on the sentinels put when the products end, so wait for them before raising any error
+            results = await asyncio.gather(get_products(session),
+                                           *[get_barcodes(session) for _ in range(req.concurrency)],
+                                           return_exceptions=True)
+        # Raise the first failure, logging any others so they aren't lost
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors[1:]:
+            tools.log_error(error)
+        if len(errors) > 0:
+            raise errors[0]
+
+        cache.save()
+        print(cache.summary())
+        return items
+
+    def _department_category(self, product):
+        """
+        Gets the category ids for a product whose department isn't in the taxonomy, creating a category named after
+        the department if it doesn't exist
+        :param product: Dict from henrys api
+        :return: (categoryId, None) 2-tuple
+        """
+        if not product.get('department'):
+            raise ValueError(f"Department {product['subDepartmentKey']} isn't in the taxonomy and has no name")
+        if self._categories is None:
+            self._categories = tools.get_categories()
+        return tools.find_or_create_category(self._categories, product['department'].strip().lower())
+
+    @staticmethod
+    def _store_items(item, store_ids):
+        """
+        :param item: Item with the henrys store ids that have it in 'henryStores'
+        :param store_ids: Dict of henrys store ids to pisspricer store ids
+        :return: List of copies of the item, one for each known store with its 'storeId'
+        """
         new_items = []
-        for item in items:
-            for internal_store_id in item['henryStores']:
+        for internal_store_id in item['henryStores']:
+            if int(internal_store_id) in store_ids:
                 new_item = copy.deepcopy(item)
                 del new_item['henryStores']
-                if int(internal_store_id) in store_id_mappings:
-                    new_item['storeId'] = store_id_mappings[int(internal_store_id)]
-                    new_items.append(new_item)
-
+                new_item['storeId'] = store_ids[int(internal_store_id)]
+                new_items.append(new_item)
         return new_items
 
-    def _get_henry_items(self):
-        """
-        Gets a list of items from henrys website. Excluding barcodes
-        :return: List of items from henrys api
-        """
-        category_ids = [16639,16642,16643,16644,16648,16649,23625,23626,23627,23628,23634,23630,23633,23635,23629,
-                       13651,13650,13652,13652,13651,13650,13653,13654,13655,13656,13579,13658,13659,13660,13661,
-                       13662,13664,13583,13657,13667,13580,13663,13670,13672,13577,24350,13587,24680,24675,24676,
-                       24677,24349,24351,24352,24350,24351,24352,13587,24680,24675,24676,24677,24349,24589,24673,
-                       24674,24679]
-        category_ids_str = [str(cat) for cat in category_ids]
-        url = f"https://www.henrys.co.nz/api/products?categories={','.join(category_ids_str)}"
-
-        # Get first page
-        first_page = requests.get(url + "&page=0").json()
-        total_pages = int(first_page['totalPages'])
-        other_pages_urls = [(url + f"&page={i}", None) for i in range(1, total_pages + 1)]
-
-        # Get rest of pages
-        iteration = [0]
-        self.print_func(0, len(other_pages_urls) - 1, 'Get Items')
-        responses = asyncio.run(
-            req.create_async_tasks(
-                other_pages_urls,
-                {
-                    "printer": (
-                        self.print_func,
-                        total_pages - 1,
-                        'Get Items'
-                    ),
-                    "iteration": iteration
-                },
-                self._async_get))
-
-        # Collate all items in a list
-        items = first_page['products']
-        for _, page in responses:
-            items += page.json()['products']
-        return items
+    def _products_url(self):
+        category_ids_str = [str(cat) for cat in self.category_ids]
+        return f"{self.base_url}/api/products?categories={','.join(category_ids_str)}"
+
+    def page_count(self):
+        """
+        Gets the number of pages of products from the henrys api
+        :return: Number of pages, numbered from 0
+        """
+        first_page = requests.get(self._products_url() + "&page=0", hooks=req.requests_hooks).json()
+        return int(first_page['totalPages']) + 1
+
+    async def _async_get_products(self, session, pages, cache):
+        """
+        Gets the products api pages, as a stream of each page's products in page order
+        :param session: Aiohttp session
+        :param pages: [start, stop) range of pages to get, None for all of them
+        :param cache: HttpCache for products pages
+        :return: Async generator of lists of products from henrys api
+        """
+        url = self._products_url()
+        # Without a range the first page gives the number of pages
+        start, stop = (0, None) if pages is None else pages
+
+        products_pages = paginator.paginate(
+            lambda p: self._async_get_products_page(session, url + f"&page={p}", cache),
+            page_count=lambda first_page: int(first_page['totalPages']) + 1,
+            start=start,
+            stop=stop,
+            is_empty=lambda page: len(page['products']) == 0)
+        async for p, page in products_pages:
+            total = (stop if stop is not None else int(page['totalPages']) + 1) - start
+            self.print_func(p - start + 1, total, 'Get Items')
+            yield page['products']
+
+    @staticmethod
+    async def _async_get_products_page(session, url, cache):
+        """
+        Gets a page of the henrys products api, reusing the last run's page if unchanged
+        :param session: Aiohttp session
+        :param url: Url of the products page
+        :param cache: HttpCache for products pages
+        :return: Dict of the page's products and the total number of pages {"totalPages": int, "products": []}
+        """
+        page, _ = await req.cached_get(session, cache, url, url, _parse_products_page)
+        return page
+
+    @staticmethod
+    async def _async_get_item_page(session, url):
+        """
+        Gets the html of a product page, sharing the fetch with any identical request in flight
+        :param session: Aiohttp session
+        :param url: Url of the product page
+        :return: Html string
+        """
+        res = await req.shared_get(session, url, decode=False)
+        if res.status != 200:
+            raise AiohttpException(res, "get item page", "henrys")
+        return res.read().decode(res.res.get_encoding(), errors="replace")
 
 
+def _parse_products_page(text):
+    """
+    :param text: Json string of a products api page
+    :return: Dict {"totalPages": int, "products": []}
+    """
+    page = json.loads(text)
+    return {"totalPages": page['totalPages'], "products": page['products']}
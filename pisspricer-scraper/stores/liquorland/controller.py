@@ -2,11 +2,15 @@ from pisspricer import Pisspricer
 from stores.generic_store import Store
 from stores.liquorland import model as liquorland_model
 import api
+import location_sync
+import metrics
+import sharding
 
 
 class Liquorland(Store):
 
     brand_id = 6
+    name = "Liquorland"
 
     def __init__(self):
         self.model = liquorland_model.LiquorlandModel(printer=self.print_progress)
@@ -55,23 +59,44 @@ class Liquorland(Store):
                 stores.append(store)
 
         # Post Stores
-        pisspricer_con = Pisspricer(api)
-        pisspricer_con.upload_new_stores(stores,
-                                         self.brand_id,
-                                         printer=(self.print_progress, len(stores), "update locations"))
+        location_sync.sync_locations(api, self.name, self.brand_id, stores, self.print_progress)
 
-    def update_all_items(self):
+    def crawl(self, run):
 
         pisspricer = Pisspricer(api)
 
         # Get stores from pisspricer
-        stores = pisspricer.get_stores(self.brand_id)
+        with self.phase("get stores"):
+            stores = sharding.current.filter_stores(pisspricer.get_stores(self.brand_id))
 
         # Get items from liquorland model
-        items = self.model.get_items(stores)
+        with self.phase("get items"):
+            items = run.run("get items", self.model.get_items, stores)
+        metrics.items_parsed.inc(len(items), store="liquorland")
+        return items
 
-        # Create new products with pisspricer api
-        pisspricer.update_item_prices(items, self.brand_id, "liquorland", self.print_progress)
+    def crawl_units(self):
+        """
+        :return: List of {"store": store, "cat": category name} units, one per store and category
+        """
+        stores = sharding.current.filter_stores(Pisspricer(api).get_stores(self.brand_id))
+        return [{"store": store, "cat": cat["cat"]} for store in stores for cat in self.model.categories]
 
+    def crawl_unit(self, unit):
+        """
+        Gets the items of one category of one store
+        :param unit: Unit from crawl_units
+        :return: List of items
+        """
+        categories = [cat for cat in self.model.categories if cat["cat"] == unit["cat"]]
+        items = self.model.get_items([unit["store"]], categories=categories,
+                                     cache_name=f"liquorland-{unit['store']['internalId']}-{unit['cat']}",
+                                     should_print=False)
+        metrics.items_parsed.inc(len(items), store="liquorland")
+        return items
 
+    def upload(self, items, run):
 
+        # Create new products with pisspricer api
+        pisspricer = Pisspricer(api)
+        pisspricer.update_item_prices(items, self.brand_id, "liquorland", self.print_progress, checkpoint=run)
@@ -1,4 +1,5 @@
 import math
+import os
 
 import aiohttp
 from bs4 import BeautifulSoup
@@ -7,6 +8,9 @@ from custom_exceptions import LiquorlandException
 import custom_requests as req
 import copy
 import tools
+import paginator
+import taxonomy
+import categories as cat
 
 
 class LiquorlandModel:
@@ -16,52 +20,17 @@ class LiquorlandModel:
               "VisitorIsAdult": True}
     page_count = 48
     params = {"ps": page_count}
-    base_url = "https://www.shop.liquorland.co.nz"
+    base_url = os.getenv("liquorland.url", "https://www.shop.liquorland.co.nz")
+    locations_url = os.getenv("liquorland.locations_url",
+                              "https://www.liquorland.co.nz/themes/liquorland/scripts/StoreFinder/branches.json?v6")
+    # Listing pages to crawl by category, see taxonomy.LIQUORLAND for their pisspricer categories
     categories = [
-        {"cat": "spirits",
-         "id": 9,
-         "subcats": [
-             ("bourbon", "/Bourbon.aspx", 14),
-             ("brandy", "/brandy.aspx", 13),
-             ("whisky", "/whisky.aspx", 12),
-             ("vodka", "/vodka.aspx", 11),
-             ("gin", "/gin.aspx", 10),
-             ("rum", "/rum.aspx", 9),
-             ("tequila", "/tequila.aspx", 8),
-             (None, "/otherspirits.aspx", None)
-         ]},
-        {"cat": "liqueurs",
-         "id": 10,
-         "subcats": [
-             (None, "/liqueurs.aspx", None)
-         ]},
-        {"cat": "beer",
-         "id": 5,
-         "subcats": [
-             (None, "/beer.aspx", None),
-             (None, "/craftbeer.aspx", None)
-         ]},
-        {"cat": "wine",
-         "id": 7,
-         "subcats": [
-             ("red", "/redwine.aspx", 6),
-             ("white", "/whitewine.aspx", 5),
-             ("rose", "/rose.aspx", 7),
-             ("sparkling & dessert wine", "/sparklingwine.aspx", 4),
-             ("sparkling & dessert wine", "/champagne.aspx", 4),
-             ("sparkling & dessert wine", "/port.aspx", 4),
-             (None, "/caskwine.aspx", None)
-         ]},
-        {"cat": "cider",
-         "id": 6,
-         "subcats": [
-             (None, "/cider.aspx", None)
-         ]},
-        {"cat": "rtd",
-         "id": 11,
-         "subcats": [
-             (None, "/rtds.aspx", None)
-         ]}
+        {"cat": "spirits", "endpoints": taxonomy.liquorland.keys(cat.spirits)},
+        {"cat": "liqueurs", "endpoints": taxonomy.liquorland.keys(cat.liqueurs)},
+        {"cat": "beer", "endpoints": taxonomy.liquorland.keys(cat.beer)},
+        {"cat": "wine", "endpoints": taxonomy.liquorland.keys(cat.wine)},
+        {"cat": "cider", "endpoints": taxonomy.liquorland.keys(cat.cider)},
+        {"cat": "rtd", "endpoints": taxonomy.liquorland.keys(cat.rtd)}
     ]
 
     def __init__(self, printer):
@@ -74,8 +43,7 @@ class LiquorlandModel:
         :return: List of liquorland store locations
         """
         task = "get_locations"
-        url = "https://www.liquorland.co.nz/themes/liquorland/scripts/StoreFinder/branches.json?v6"
-        res = req.get(url)
+        res = req.get(LiquorlandModel.locations_url)
         if res.status != 200:
             raise LiquorlandException(res, task)
         locations = res.json()
@@ -85,117 +53,119 @@ class LiquorlandModel:
                 new_locations.append(location)
         return new_locations
 
-    def get_items(self, stores, should_print=True):
+    def get_items(self, stores, categories=None, cache_name="liquorland", should_print=True):
+        """
+        Gets the items of every category of each store
+        :param stores: List of liquorland stores from pisspricer api
+        :param categories: Categories to get, defaults to all of them
+        :param cache_name: Name of the HttpCache for the listing pages, which only keeps the pages got by this call
+        :param should_print: Print progress of getting listings
+        :return: List of items
+        """
 
         task = "get items from liquorland"
-        # Iterate through stores and categories and make items for HTTP get
-        first_page_items = []
+        cache = req.HttpCache(cache_name).load()
+
+        # Iterate through stores and categories and make a listing to get for each endpoint
+        listings = []
         for store in stores:
             internal_id = store["internalId"]
-            for cat in self.categories:
-                for _, endpoint, subcatId in cat["subcats"]:
+            for category in (categories if categories is not None else self.categories):
+                for endpoint in category["endpoints"]:
+                    category_id, subcategory_id = taxonomy.liquorland.lookup(endpoint)
 
                     cookies = copy.deepcopy(self.cookie)
                     cookies["selectedStore"] = internal_id
 
-                    item = [
-                        f"{self.base_url}{endpoint}",
-                        {
-                            "categoryId": cat["id"],
-                            "subcategoryId": subcatId,
-                            "storeId": store["storeId"],
-                            "internalId": store["internalId"],
-                            "url": f"{self.base_url}{endpoint}",
-                        },
-                        cookies,
-                        self.params
-                    ]
-
-                    first_page_items.append(item)
-
-        # Batch get first pages
-        iteration = [0]
-        responses = asyncio.run(req.create_async_tasks(first_page_items,
-                                                       {"printer": (self.print_func,
-                                                                    len(first_page_items)-1,
-                                                                    task + " 1",
-                                                                    iteration)},
-                                                       self._async_get_item_page))
+                    item = {
+                        "categoryId": category_id,
+                        "subcategoryId": subcategory_id,
+                        "storeId": store["storeId"],
+                        "internalId": store["internalId"],
+                        "url": f"{self.base_url}{endpoint}",
+                    }
 
-        items = []
-        requests = []
-
-        if should_print:
-            self.print_func(0, len(responses), "process responses liquorland 1")
-
-        for i, (item, res) in enumerate(responses):
-            soup = BeautifulSoup(res.text(), features="html.parser")
-            item_divs = soup.find_all("div", {"class": "productItemDisplay"})
-            for item_div in item_divs:
-
-                # Create a new item
-                new_item = self._create_item(item_div, item)
-                items.append(new_item)
-
-            # work out anymore requests that need to be made for subsequent pages, if any
-            item_count = self._get_page_item_count(soup)
-            n_pages = math.ceil(item_count / self.page_count)
-
-            cookies = copy.deepcopy(self.cookie)
-            cookies["selectedStore"] = item["internalId"]
-            for p in range(1, n_pages):
-                params = copy.deepcopy(self.params)
-                params["p"] = p
-                req_item = [
-                    res.url,
-                    {
-                        "categoryId": item["categoryId"],
-                        "subcategoryId": item["subcategoryId"],
-                        "storeId": item["storeId"],
-                        "internalId": item["internalId"],
-                        "url": res.url,
-                    },
-                    cookies,
-                    params
-                ]
-                requests.append(req_item)
-
-            # Print Progress
-            if should_print:
-                self.print_func(i, len(responses), "process responses liquorland 1")
+                    listings.append([item, cookies, cache])
 
+        # Get every listing, each streaming its pages
         iteration = [0]
-        responses = asyncio.run(req.create_async_tasks(requests,
-                                                       {"printer": (self.print_func,
-                                                                    len(requests) - 1,
-                                                                    task + " 2",
-                                                                    iteration)},
-                                                       self._async_get_item_page))
-        if should_print:
-            self.print_func(0, len(responses), "process responses liquorland 2")
-
-        for i, (item, res) in enumerate(responses):
-            soup = BeautifulSoup(res.text(), features="html.parser")
-            item_divs = soup.find_all("div", {"class": "productItemDisplay"})
-            for item_div in item_divs:
-                new_item = self._create_item(item_div, item)
-                items.append(new_item)
-
-            # Print Progress
-            if should_print:
-                self.print_func(i + 1, len(responses), "process responses liquorland 2")
+        printer = (self.print_func, len(listings) - 1, task, iteration) if should_print else None
+        responses = asyncio.run(req.create_async_tasks(listings, {"printer": printer}, self._async_get_listing))
+        items = [new_item for listing_items in responses for new_item in listing_items]
+
+        cache.save()
+        print(cache.summary())
+        taxonomy.liquorland.report()
+
+        return items
+
+    async def _async_get_listing(self, session, item, cookies, cache, printer=None):
+        """
+        Gets the items of every page of a category listing. The first page gives the number of pages, and the rest are
+        fetched concurrently and made into items as they arrive
+        :param session: Session for requests
+        :param item: Dict of the listing's url, store and category ids
+        :param cookies: Cookies for http requests, with the selected store
+        :param cache: HttpCache for listing pages
+        :param printer: (print_func, total, task, iteration) tuple
+        :return: List of items
+        """
+        async def fetch_page(p):
+            if p == 0:
+                _, first_page = await self._async_get_item_page(session, item["url"], item, cookies, self.params,
+                                                                cache, self._parse_first_page)
+                return first_page
+            params = copy.deepcopy(self.params)
+            params["p"] = p
+            _, item_infos = await self._async_get_item_page(session, item["url"], item, cookies, params, cache,
+                                                            self._parse_item_page)
+            return item_infos, None
 
+        items = []
+        pages = paginator.paginate(fetch_page,
+                                   page_count=lambda first_page: math.ceil(first_page[1] / self.page_count),
+                                   is_empty=lambda page: len(page[0]) == 0)
+        async for _, (item_infos, _) in pages:
+            for item_info in item_infos:
+                items.append(self._create_item(item_info, item))
+
+        if printer is not None:
+            print_func, total, task, iteration = printer
+            print_func(iteration[0], total, task)
+            iteration[0] += 1
         return items
 
-    def _create_item(self, item_div, item):
+    def _parse_item_page(self, text):
+        """
+        Decodes the product info of every item on a listing page
+        :param text: Html string of the page
+        :return: List of item info lists, see _get_item_info
+        """
+        soup = BeautifulSoup(text, features="html.parser")
+        item_divs = soup.find_all("div", {"class": "productItemDisplay"})
+        return [list(self._get_item_info(item_div)) for item_div in item_divs]
+
+    def _parse_first_page(self, text):
+        """
+        Decodes the product info and total product count from the first listing page of a category
+        :param text: Html string of the page
+        :return: (item_infos, item_count) 2-tuple
+        """
+        soup = BeautifulSoup(text, features="html.parser")
+        item_divs = soup.find_all("div", {"class": "productItemDisplay"})
+        item_infos = [list(self._get_item_info(item_div)) for item_div in item_divs]
+        return item_infos, self._get_page_item_count(soup)
+
+    @staticmethod
+    def _create_item(item_info, item):
         """
         Creates an item dict for new item
-        :param item_div: Soup div object
+        :param item_info: Item info list from _get_item_info
         :param item: Item object from response
         :return: item
         """
         # Create new item dict and add to items list
-        name, price, sale_price, image_url, barcode, stock, volume, url, sku = self._get_item_info(item_div)
+        name, price, sale_price, image_url, barcode, stock, volume, url, sku = item_info
 
         new_item = {
             "name": name,
@@ -340,24 +310,23 @@ class LiquorlandModel:
             return None
 
     @staticmethod
-    async def _async_get_item_page(session, url, item, cookies, params, printer=None):
+    async def _async_get_item_page(session, url, item, cookies, params, cache, parse, printer=None):
         """
-        Gets Item page using session
+        Gets Item page using session, reusing the last parsed result if the page hasn't changed
         :param session: Session for request
         :param url: Url for http get request
         :param item: Dict item object to get returned with response
         :param cookies: Cookies for http request
-        :param printer: (print_func, total, task, iteration) tuple
         :param params: Params for http request
-        :return: (item, res) tuple, custom Response object
+        :param cache: HttpCache for listing pages
+        :param parse: Function to parse the page text
+        :param printer: (print_func, total, task, iteration) tuple
+        :return: (item, parsed) tuple
         """
-        async with session.get(url, cookies=cookies, params=params) as res:
-            text = await res.text()
-            new_res = req.Response(res, None, {}, None, text)
-            if printer is not None:
-                print_func, total, task, iteration = printer
-                print_func(iteration[0], total, task)
-                iteration[0] += 1
-            return item, new_res
-
-
+        key = f"{url}|{cookies['selectedStore']}|{params.get('p', 0)}"
+        parsed, _ = await req.cached_get(session, cache, key, url, parse, cookies=cookies, params=params)
+        if printer is not None:
+            print_func, total, task, iteration = printer
+            print_func(iteration[0], total, task)
+            iteration[0] += 1
+        return item, parsed
@@ -0,0 +1,306 @@
+"""
+Local stand-in for the pisspricer api, for load testing the uploaders offline.
+
+    python3 pisspricer-scraper stub-api --port=8000 --latency=lognormal:0.05,0.5 --error-rate=0.01 --rate-limit=200
+
+Then run the scrapers with pisspricer.url=http://localhost:8000. State is kept in memory for the life of the server.
+GET /_stats returns request counts by route and status.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+from aiohttp import web
+
+TOKEN = "stub-token"
+
+
+class Latency:
+    """
+    Latency distribution, parsed from a spec string:
+        none                   - No added latency
+        fixed:SECONDS
+        uniform:LOW,HIGH
+        exponential:MEAN
+        lognormal:MEDIAN,SIGMA - Log-normal with the given median, sigma of the underlying normal
+    """
+
+    def __init__(self, spec="none", rand=None):
+        self.spec = spec
+        self.rand = rand or random.Random()
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(a) for a in args.split(",")] if args else []
+        if kind not in ("none", "fixed", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution '{spec}'")
+
+    def sample(self):
+        """
+        :return: Seconds of latency for a request
+        """
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return self.rand.uniform(self.args[0], self.args[1])
+        if self.kind == "exponential":
+            return self.rand.expovariate(1 / self.args[0])
+        if self.kind == "lognormal":
+            return self.rand.lognormvariate(math.log(self.args[0]), self.args[1])
+        return 0
+
+
+class TokenBucket:
+    """ Allows rate requests per second on average, with bursts of up to burst requests """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        :return: 0 if the request is allowed, otherwise seconds until it would be
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class StubApi:
+    """ In memory implementation of the pisspricer api endpoints used by the scrapers """
+
+    def __init__(self, latency="none", error_rate=0.0, rate_limit=None, seed=None):
+        self.rand = random.Random(seed)
+        self.latency = Latency(latency, self.rand)
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.stats = {}
+
+        self.stores = []
+        self.regions = []
+        self.items = {}
+        self.barcodes = {}
+        self.internal_ids = {}
+        self.images = {}
+        self.derivatives = {}
+        self.prices = {}
+        self.categories = {}
+        self._add_default_categories()
+
+    def _add_default_categories(self):
+        defaults = [
+            ("beer", 5, []),
+            ("cider", 6, []),
+            ("wine", 7, [("sparkling & dessert wine", 4), ("white", 5), ("red", 6), ("rose", 7)]),
+            ("spirits", 9, [("rum", 9), ("gin", 10), ("vodka", 11), ("whisky", 12), ("tequila", 8),
+                            ("brandy", 13), ("bourbon", 14)]),
+            ("liqueurs", 10, []),
+            ("rtd", 11, []),
+        ]
+        for name, cat_id, subcats in defaults:
+            self.categories[name] = {
+                "category": name,
+                "categoryId": cat_id,
+                "subcategories": [{"subcategory": sub, "subcategoryId": sub_id} for sub, sub_id in subcats]
+            }
+
+    def app(self):
+        """
+        :return: aiohttp.web.Application serving the stub api
+        """
+        app = web.Application(middlewares=[self._middleware], client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/users/login", self.login)
+        app.router.add_get("/stores", self.get_stores)
+        app.router.add_post("/stores", self.post_store)
+        app.router.add_get("/regions", self.get_regions)
+        app.router.add_post("/regions", self.post_region)
+        app.router.add_get("/barcodes", self.get_barcodes)
+        app.router.add_get("/internalids", self.get_internal_ids)
+        app.router.add_get("/allitems", self.get_all_items)
+        app.router.add_post("/items", self.post_item)
+        app.router.add_put("/items/{sku}/image", self.put_image)
+        app.router.add_put("/items/{sku}/image/{size}", self.put_image)
+        app.router.add_put("/items/{sku}/stores/{store_id}", self.put_price)
+        app.router.add_get("/categories", self.get_categories)
+        app.router.add_post("/categories", self.post_category)
+        app.router.add_post("/categories/{cat_id}/subcategories", self.post_subcategory)
+        app.router.add_get("/_stats", self.get_stats)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unknown"
+        key = f"{request.method} {route}"
+        response = await self._handle(request, handler)
+        self.stats.setdefault(key, {})
+        self.stats[key][response.status] = self.stats[key].get(response.status, 0) + 1
+        return response
+
+    async def _handle(self, request, handler):
+        if request.path == "/_stats":
+            return await handler(request)
+
+        delay = self.latency.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.bucket is not None:
+            retry_after = self.bucket.take()
+            if retry_after > 0:
+                return web.json_response({"error": "Too many requests"}, status=429,
+                                         headers={"Retry-After": str(math.ceil(retry_after))})
+
+        if self.error_rate > 0 and self.rand.random() < self.error_rate:
+            return web.json_response({"error": "Injected error"}, status=500)
+
+        if request.path != "/users/login" and request.headers.get("X-Authorization") != TOKEN:
+            return web.json_response({"error": "Unauthorized"}, status=401)
+
+        return await handler(request)
+
+    async def login(self, request):
+        return web.json_response({"userId": 1, "authToken": TOKEN})
+
+    async def get_stores(self, request):
+        brand_id = request.query.get("brandId")
+        stores = [s for s in self.stores if brand_id is None or str(s["brandId"]) == brand_id]
+        return web.json_response(stores)
+
+    async def post_store(self, request):
+        store = await request.json()
+        for field in ("name", "brandId", "regionId", "internalId"):
+            if store.get(field) is None:
+                return web.json_response({"error": f"'{field}' is required"}, status=400)
+        store["storeId"] = len(self.stores) + 1
+        self.stores.append(store)
+        return web.json_response({"storeId": store["storeId"]}, status=201)
+
+    async def get_regions(self, request):
+        return web.json_response(self.regions)
+
+    async def post_region(self, request):
+        region = await request.json()
+        if any(r["name"] == region.get("name") for r in self.regions):
+            return web.json_response({"error": "Region already exists"}, status=400)
+        region["regionId"] = len(self.regions) + 1
+        self.regions.append(region)
+        return web.json_response({"regionId": region["regionId"]}, status=201)
+
+    async def get_barcodes(self, request):
+        return web.json_response({barcode: [sku] for barcode, sku in self.barcodes.items()})
+
+    async def get_internal_ids(self, request):
+        brand_id = request.query.get("brandId")
+        stores = {s["storeId"] for s in self.stores if brand_id is None or str(s["brandId"]) == brand_id}
+        ids = {internal_sku: [sku] for (store_id, internal_sku), sku in self.internal_ids.items()
+               if store_id in stores}
+        return web.json_response(ids)
+
+    async def get_all_items(self, request):
+        return web.json_response([{"sku": sku, "name": item.get("name"), "hasImage": 1 if sku in self.images else 0}
+                                  for sku, item in self.items.items()])
+
+    async def post_item(self, request):
+        item = await request.json()
+        if item.get("name") is None or item.get("categoryId") is None:
+            return web.json_response({"error": "'name' and 'categoryId' are required"}, status=400)
+        barcode = item.get("barcode")
+        if barcode is not None and barcode in self.barcodes:
+            return web.json_response({"error": "Barcode already exists", "sku": self.barcodes[barcode]}, status=409)
+        sku = len(self.items) + 1
+        self.items[sku] = item
+        if barcode is not None:
+            self.barcodes[barcode] = sku
+        if item.get("internalSku") is not None and item.get("storeId") is not None:
+            self.internal_ids[(item["storeId"], item["internalSku"])] = sku
+        return web.json_response({"sku": sku}, status=201)
+
+    async def put_image(self, request):
+        sku = int(request.match_info["sku"])
+        if sku not in self.items:
+            return web.json_response({"error": "Item not found"}, status=404)
+        data = await request.read()
+        size = request.match_info.get("size")
+        if size is None:
+            self.images[sku] = len(data)
+        self.derivatives[(sku, size, request.content_type)] = len(data)
+        return web.Response(status=201)
+
+    async def put_price(self, request):
+        sku = int(request.match_info["sku"])
+        store_id = int(request.match_info["store_id"])
+        if sku not in self.items:
+            return web.json_response({"error": "Item not found"}, status=404)
+        if not any(s["storeId"] == store_id for s in self.stores):
+            return web.json_response({"error": "Store not found"}, status=404)
+        payload = await request.json()
+        if payload.get("price") is None:
+            return web.json_response({"error": "'price' is required"}, status=400)
+        status = 200 if (sku, store_id) in self.prices else 201
+        self.prices[(sku, store_id)] = payload
+        internal_sku = payload.get("internalSku")
+        if internal_sku is not None:
+            self.internal_ids[(store_id, str(internal_sku))] = sku
+        return web.Response(status=status)
+
+    async def get_categories(self, request):
+        return web.json_response(self.categories)
+
+    async def post_category(self, request):
+        payload = await request.json()
+        name = payload.get("category")
+        if name is None or name in self.categories:
+            return web.json_response({"error": "Invalid or existing category"}, status=400)
+        cat_id = max([c["categoryId"] for c in self.categories.values()], default=0) + 1
+        self.categories[name] = {"category": name, "categoryId": cat_id, "subcategories": []}
+        return web.json_response({"categoryId": cat_id}, status=201)
+
+    async def post_subcategory(self, request):
+        cat_id = int(request.match_info["cat_id"])
+        payload = await request.json()
+        for cat in self.categories.values():
+            if cat["categoryId"] == cat_id:
+                subcats = [s["subcategoryId"] for c in self.categories.values() for s in c["subcategories"]]
+                subcat_id = max(subcats, default=0) + 1
+                cat["subcategories"].append({"subcategory": payload.get("subcategory"), "subcategoryId": subcat_id})
+                return web.json_response({"subcategoryId": subcat_id}, status=201)
+        return web.json_response({"error": "Category not found"}, status=404)
+
+    async def get_stats(self, request):
+        return web.json_response({
+            "requests": self.stats,
+            "items": len(self.items),
+            "images": len(self.images),
+            "image_derivatives": len(self.derivatives),
+            "prices": len(self.prices),
+            "stores": len(self.stores)
+        })
+
+
+def main(args):
+    """
+    Command line entry point, runs the stub api until interrupted
+    :param args: List of command line args after 'stub-api'
+    :return: None
+    """
+    options = {"port": "8000", "latency": "none", "error-rate": "0", "rate-limit": None, "seed": None}
+    for arg in args:
+        name, _, value = arg.lstrip("-").partition("=")
+        if name not in options:
+            raise ValueError(f"Unknown option '{arg}'")
+        options[name] = value
+
+    stub = StubApi(latency=options["latency"],
+                   error_rate=float(options["error-rate"]),
+                   rate_limit=float(options["rate-limit"]) if options["rate-limit"] else None,
+                   seed=int(options["seed"]) if options["seed"] else None)
+    try:
+        web.run_app(stub.app(), port=int(options["port"]))
+    finally:
+        print(json.dumps(stub.stats, indent=1))
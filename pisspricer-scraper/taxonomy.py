@@ -0,0 +1,136 @@
+import collections
+import categories as cat
+import metrics
+
+# Pisspricer subcategory ids
+BOURBON = 14
+BRANDY = 13
+WHISKY = 12
+VODKA = 11
+GIN = 10
+RUM = 9
+TEQUILA = 8
+ROSE = 7
+RED = 6
+WHITE = 5
+SPARKLING = 4
+
+# Store-native category keys to (categoryId, subcategoryId), one table per store
+HENRYS = {
+    # Department keys of the henrys products api. 13587 was once also listed as cider, but always matched beer first
+    (cat.beer, None): [24350, 13587, 24680, 24675, 24676, 24677, 24349, 24351, 24352, 24589, 24673, 24674, 24679],
+    (cat.wine, None): [13651, 13650, 13652, 13653, 13654, 13655, 13656, 13579, 13658, 13659, 13660, 13661, 13662,
+                       13664, 13583, 13657, 13667, 13580, 13663, 13670, 13672, 13577],
+    (cat.spirits, None): [23625, 23626, 23627, 23628, 23634, 23630, 23633, 23635],
+    (cat.liqueurs, None): [23629],
+    (cat.rtd, None): [16639, 16642, 16643, 16644, 16648, 16649],
+}
+
+LIQUORLAND = {
+    # Category listing page endpoints
+    (cat.spirits, BOURBON): ["/Bourbon.aspx"],
+    (cat.spirits, BRANDY): ["/brandy.aspx"],
+    (cat.spirits, WHISKY): ["/whisky.aspx"],
+    (cat.spirits, VODKA): ["/vodka.aspx"],
+    (cat.spirits, GIN): ["/gin.aspx"],
+    (cat.spirits, RUM): ["/rum.aspx"],
+    (cat.spirits, TEQUILA): ["/tequila.aspx"],
+    (cat.spirits, None): ["/otherspirits.aspx"],
+    (cat.liqueurs, None): ["/liqueurs.aspx"],
+    (cat.beer, None): ["/beer.aspx", "/craftbeer.aspx"],
+    (cat.wine, RED): ["/redwine.aspx"],
+    (cat.wine, WHITE): ["/whitewine.aspx"],
+    (cat.wine, ROSE): ["/rose.aspx"],
+    (cat.wine, SPARKLING): ["/sparklingwine.aspx", "/champagne.aspx", "/port.aspx"],
+    (cat.wine, None): ["/caskwine.aspx"],
+    (cat.cider, None): ["/cider.aspx"],
+    (cat.rtd, None): ["/rtds.aspx"],
+}
+
+COUNTDOWN = {
+    # Aisle names of the beer & wine department
+    (cat.beer, None): ["beer", "craft beer"],
+    (cat.cider, None): ["cider"],
+    (cat.wine, RED): ["red wine"],
+    (cat.wine, WHITE): ["white wine"],
+    (cat.wine, ROSE): ["rose wine", "rose"],
+    (cat.wine, SPARKLING): ["sparkling wine", "champagne & sparkling wine", "dessert & fortified wine"],
+    (cat.wine, None): ["wine", "cask wine"],
+    (cat.spirits, None): ["spirits"],
+    (cat.liqueurs, None): ["liqueurs"],
+    (cat.rtd, None): ["ready to drink", "rtds"],
+}
+
+unmapped_items = metrics.registry.counter("pisspricer_taxonomy_unmapped_total",
+                                          "Items whose store category isn't in the taxonomy, by store")
+
+
+def _normalize(key):
+    return str(key).strip().lower()
+
+
+class Taxonomy:
+    """
+    A store's taxonomy table compiled into one dict from store-native key to (categoryId, subcategoryId).
+    Keys are matched case insensitively. Lookups of unmapped keys are counted, so they can be reported and added
+    to the table instead of silently dropping the items.
+    """
+
+    def __init__(self, store, table):
+        """
+        :param store: Store name
+        :param table: Dict of (categoryId, subcategoryId) to list of store-native keys
+        """
+        self.store = store
+        self.table = table
+        self.mapping = {}
+        for ids, keys in table.items():
+            for key in keys:
+                normalized = _normalize(key)
+                if normalized in self.mapping and self.mapping[normalized] != ids:
+                    raise ValueError(f"{store} taxonomy key '{key}' maps to both {self.mapping[normalized]} and {ids}")
+                self.mapping[normalized] = ids
+        self.unmapped = collections.Counter()
+
+    def lookup(self, key, count=1):
+        """
+        :param key: Store-native category key
+        :param count: Number of items with the key, for counting unmapped items
+        :return: (categoryId, subcategoryId) 2-tuple, (None, None) if the key isn't mapped
+        """
+        ids = self.mapping.get(_normalize(key))
+        if ids is None:
+            self.unmapped[key] += count
+            unmapped_items.inc(count, store=self.store)
+            return None, None
+        return ids
+
+    def missing(self, keys):
+        """
+        :param keys: Store-native category keys
+        :return: List of the keys that aren't mapped, without counting them as unmapped items
+        """
+        return [key for key in keys if _normalize(key) not in self.mapping]
+
+    def keys(self, category_id):
+        """
+        :param category_id: Pisspricer category id
+        :return: List of the store-native keys of the category, in table order
+        """
+        return [key for ids, keys in self.table.items() if ids[0] == category_id for key in keys]
+
+    def report(self):
+        """
+        Prints the unmapped keys looked up since the last report, with their item counts
+        :return: Counter of unmapped keys to item counts
+        """
+        unmapped, self.unmapped = self.unmapped, collections.Counter()
+        if len(unmapped) > 0:
+            keys = ", ".join(f"'{key}' ({count})" for key, count in unmapped.most_common())
+            print(f"{self.store} items in categories missing from the taxonomy: {keys}")
+        return unmapped
+
+
+henrys = Taxonomy("henrys", HENRYS)
+liquorland = Taxonomy("liquorland", LIQUORLAND)
+countdown = Taxonomy("countdown", COUNTDOWN)
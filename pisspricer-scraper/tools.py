@@ -1,39 +1,15 @@
 import os
 import requests
 from custom_exceptions import *
-from datetime import datetime
-import math
+from error_log import error_log
 import api
-from custom_requests import async_get_list, async_post_items
-
-
-# Print iterations progress
-def print_progress_bar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
-    """
-    Call in a loop to create terminal progress bar
-    @params:
-        iteration   - Required  : current iteration (Int)
-        total       - Required  : total iterations (Int)
-        prefix      - Optional  : prefix string (Str)
-        suffix      - Optional  : suffix string (Str)
-        decimals    - Optional  : positive number of decimals in percent complete (Int)
-        length      - Optional  : character length of bar (Int)
-        fill        - Optional  : bar fill character (Str)
-        printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
-    """
-    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-    filledLength = int(length * iteration // total)
-    bar = fill * filledLength + '-' * (length - filledLength)
-    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
-    # Print New Line on Complete
-    if iteration == total:
-        print()
+from custom_requests import async_post_items, requests_hooks
 
 
 def geocode_address(address):
     """ Geocodes an address into lattitude longitude coordinates """
     key = os.getenv("maps_api_key")
-    res = requests.get(f"https://maps.googleapis.com/maps/api/geocode/json?address={address}&key={key}")
+    res = requests.get(f"https://maps.googleapis.com/maps/api/geocode/json?address={address}&key={key}", hooks=requests_hooks)
     if not res.ok:
         raise GoogleApiException(res, f"Geocoding address '{address}'")
     else:
@@ -54,35 +30,15 @@ def geocode_address(address):
             return lat, lng, address, postcode, region
 
 
-def log_error(error):
-    """ To be implemented """
-    now = datetime.now()
-    dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-    file_name = "log.txt"
-    f = open(file_name, "a")
-    f.write(f"{dt_string}: {str(error)}\n")
-    f.close()
-
-
-def generate_url_pages(url1, total, per_page, start_page=1, offset=0, url_end="", carry=None):
+def log_error(error, url=None, **context):
     """
-    Generate urls for multi-page requests
-
-    :param url1: First half of URL (before page no)
-    :param url_end: Second half of URL (after page no)
-    :param total: Total number of items
-    :param per_page: Number of items per page
-    :param start_page: Page number to start from. 1 indexing
-    :param offset: Offset page numbers (-1 for 0 indexing pages)
-    :param carry: Data that can be carried to every url
-    :return: List of generated urls
+    Queues an error to be written to the error log, without blocking on file io
+    :param error: Exception or message
+    :param url: Url being processed when the error occurred
+    :param context: Any other json serializable context
+    :return: None
     """
-    urls = []
-    pages = math.ceil(total / per_page)
-    for p in range(start_page, pages+1):
-        url = f"{url1}{p + offset}{url_end}"
-        urls.append({"url": url, "carry": carry})
-    return urls
+    error_log.log(error, url=url, **context)
 
 
 def check_pisspricer_res(res, task):
@@ -116,6 +72,38 @@ def get_cat_id(categories, cat, subcat):
     return cat_id, subcat_id
 
 
+def get_categories():
+    """
+    Gets the categories from pisspricer api
+    :return: Dictionary of categories by name {name: {"categoryId": int, "subcategories": []}}
+    """
+    res = requests.get(api.url + "/categories", headers=api.headers, hooks=requests_hooks)
+    check_pisspricer_res(res, "get categories")
+    return res.json()
+
+
+def find_or_create_category(categories, cat, subcat=None):
+    """
+    Gets the ids of a category and optional subcategory by name, creating them if they don't exist
+    :param categories: Dictionary of categories from pisspricer api by name, see get_categories, updated with any created
+    :param cat: Category name
+    :param subcat: Subcategory name, or None for the category alone
+    :return: (categoryId, subcategoryId) 2-tuple, subcategoryId is None if subcat is None
+    """
+    if cat not in categories:
+        categories[cat] = {"category": cat, "categoryId": post_category(cat), "subcategories": []}
+    cat_id = categories[cat]["categoryId"]
+    if subcat is None:
+        return cat_id, None
+
+    for sub in categories[cat]["subcategories"]:
+        if sub["subcategory"] == subcat:
+            return cat_id, sub["subcategoryId"]
+    subcat_id = post_subcategory(cat_id, subcat)
+    categories[cat]["subcategories"].append({"subcategory": subcat, "subcategoryId": subcat_id})
+    return cat_id, subcat_id
+
+
 def post_category(cat):
     """
     Posts a new category to pisspricer api
@@ -123,7 +111,7 @@ def post_category(cat):
     :return: Category ID
     """
     payload = {"category": cat}
-    res = requests.post(api.url + "/categories", json=payload, headers=api.headers)
+    res = requests.post(api.url + "/categories", json=payload, headers=api.headers, hooks=requests_hooks)
     if not res.ok:
         raise PisspricerApiException(res, f"Posting category '{cat}'")
     return res.json()["categoryId"]
@@ -139,7 +127,8 @@ def post_subcategory(cat_id, subcat):
     payload = {"subcategory": subcat}
     res = requests.post(api.url + f"/categories/{cat_id}/subcategories",
                         headers=api.headers,
-                        json=payload)
+                        json=payload,
+                        hooks=requests_hooks)
     if not res.ok:
         raise PisspricerApiException(res, f"Posting subcategory '{subcat}', for category with id {cat_id}")
 
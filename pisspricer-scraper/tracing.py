@@ -0,0 +1,233 @@
+import contextvars
+import json
+import os
+import time
+import aiohttp
+from contextlib import contextmanager
+
+TRACE_DIR = os.getenv("pisspricer.trace_dir", os.path.join(os.path.dirname(__file__), "traces"))
+SERVICE_NAME = "pisspricer-scraper"
+
+enabled = False
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """ A timed operation within a run, with an optional parent span """
+
+    def __init__(self, name, parent=None, attributes=None, start_ns=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def add_event(self, name, **attributes):
+        self.events.append((name, time.time_ns(), attributes))
+
+    def end(self, end_ns=None):
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+        tracer.finished.append(self)
+
+    def to_otlp(self):
+        """
+        Converts the span into OTLP/JSON format
+        :return: Dict span object
+        """
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [{"name": name, "timeUnixNano": str(ts), "attributes": _otlp_attributes(attrs)}
+                       for name, ts, attrs in self.events],
+            "status": {"code": 2, "message": self.error} if self.error is not None else {"code": 1}
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attributes(attributes):
+    otlp = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        otlp.append({"key": key, "value": otlp_value})
+    return otlp
+
+
+class Tracer:
+    """ Collects finished spans for a run and writes them to a file """
+
+    def __init__(self):
+        self.finished = []
+
+    def to_otlp(self):
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{
+                    "scope": {"name": SERVICE_NAME},
+                    "spans": [span.to_otlp() for span in self.finished]
+                }]
+            }]
+        }
+
+    def write(self, trace_dir=TRACE_DIR):
+        """
+        Writes all finished spans as OTLP/JSON to '{trace_dir}/trace-{timestamp}.json'
+        :param trace_dir: Directory for trace files
+        :return: Path of the written file
+        """
+        os.makedirs(trace_dir, exist_ok=True)
+        path = os.path.join(trace_dir, f"trace-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_otlp(), f)
+        self.finished = []
+        return path
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Context manager for a span, nested under the current span if there is one
+    :param name: Span name
+    :param attributes: Span attributes
+    :return: Span object
+    """
+    if not enabled:
+        yield None
+        return
+    new_span = Span(name, parent=_current_span.get(), attributes=attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as err:
+        new_span.error = f"{type(err).__name__}: {err}"
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+""" -----------
+HTTP SPANS
+---------------"""
+
+
+async def _on_request_start(session, ctx, params):
+    ctx.span = Span(f"HTTP {params.method}",
+                    parent=_current_span.get(),
+                    attributes={"http.method": params.method, "http.url": str(params.url)})
+
+
+async def _on_dns_resolvehost_start(session, ctx, params):
+    ctx.span.add_event("dns.start", host=params.host)
+
+
+async def _on_dns_resolvehost_end(session, ctx, params):
+    ctx.span.add_event("dns.end", host=params.host)
+
+
+async def _on_dns_cache_hit(session, ctx, params):
+    ctx.span.add_event("dns.cache_hit", host=params.host)
+
+
+async def _on_connection_queued_start(session, ctx, params):
+    ctx.span.add_event("connection.queued")
+
+
+async def _on_connection_create_start(session, ctx, params):
+    ctx.span.add_event("connect.start")
+
+
+async def _on_connection_create_end(session, ctx, params):
+    ctx.span.add_event("connect.end")
+
+
+async def _on_connection_reuseconn(session, ctx, params):
+    ctx.span.add_event("connect.reused")
+
+
+async def _on_request_end(session, ctx, params):
+    # Headers received, so this is time to first byte. The span ends when the body has been read.
+    ctx.span.add_event("response.headers")
+    ctx.span.attributes["http.status_code"] = params.response.status
+    ctx.span.attributes["http.response_content_length"] = 0
+    ctx.response = params.response
+    ctx.response.release = _end_on_release(ctx, ctx.response.release)
+
+
+async def _on_response_chunk_received(session, ctx, params):
+    ctx.span.attributes["http.response_content_length"] += len(params.chunk)
+
+
+async def _on_request_exception(session, ctx, params):
+    ctx.span.error = f"{type(params.exception).__name__}: {params.exception}"
+    ctx.span.end()
+
+
+def _end_on_release(ctx, release):
+    """ Wraps ClientResponse.release to end the span once the body has been transferred """
+    def wrapped(*args, **kwargs):
+        if ctx.span.end_ns is None:
+            ctx.span.add_event("response.end")
+            ctx.span.end()
+        return release(*args, **kwargs)
+    return wrapped
+
+
+def trace_config():
+    """
+    Creates an aiohttp TraceConfig that records a span for every request made with a session,
+    with events for dns, connect, time to first byte and end of transfer
+    :return: aiohttp.TraceConfig
+    """
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(_on_request_start)
+    config.on_dns_resolvehost_start.append(_on_dns_resolvehost_start)
+    config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    config.on_dns_cache_hit.append(_on_dns_cache_hit)
+    config.on_connection_queued_start.append(_on_connection_queued_start)
+    config.on_connection_create_start.append(_on_connection_create_start)
+    config.on_connection_create_end.append(_on_connection_create_end)
+    config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    config.on_request_end.append(_on_request_end)
+    config.on_response_chunk_received.append(_on_response_chunk_received)
+    config.on_request_exception.append(_on_request_exception)
+    return config
+
+
+def record_requests_response(res, *args, **kwargs):
+    """
+    Records a span for a response from the requests library. Used as a requests response hook.
+    :param res: requests.Response object
+    :return: None
+    """
+    if not enabled:
+        return
+    end_ns = time.time_ns()
+    new_span = Span(f"HTTP {res.request.method}",
+                    parent=_current_span.get(),
+                    attributes={"http.method": res.request.method,
+                                "http.url": res.url,
+                                "http.status_code": res.status_code},
+                    start_ns=end_ns - int(res.elapsed.total_seconds() * 1e9))
+    new_span.end(end_ns)
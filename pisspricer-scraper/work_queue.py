@@ -0,0 +1,372 @@
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import progress
+import tools
+from spool import Spool
+
+QUEUE_DIR = os.getenv("pisspricer.queue_dir", os.path.join(os.path.dirname(__file__), "queue"))
+LEASE_SECONDS = 5 * 60
+HEARTBEAT_SECONDS = 60
+POLL_SECONDS = 15
+MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkQueue:
+    """
+    SQLite job queue of crawl units, shared by worker processes on one host, or several hosts sharing the queue dir.
+    A worker leases a job for LEASE_SECONDS and heartbeats to keep it while crawling. Leases that run out, because
+    the worker died or hung, are put back in the queue for another worker, up to MAX_ATTEMPTS.
+    Each attempt of a job writes its records to '{queue_dir}/{run}/{store}/{job}-{attempt}.ndjson', and the job keeps
+    the file of the attempt that completed it, so a worker that lost its lease can't replace or delete the records of
+    the worker that took the job over. When the last job of a store's run finishes, the worker finishing it merges the
+    records into one spool file, to be uploaded by the upload command.
+    """
+
+    def __init__(self, queue_dir=QUEUE_DIR):
+        self.queue_dir = queue_dir
+        self.path = os.path.join(queue_dir, "queue.sqlite")
+        self._local = threading.local()
+
+    def _connect(self):
+        # One connection per thread, so the heartbeat thread doesn't share the worker's
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.queue_dir, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    run TEXT NOT NULL,
+                    store TEXT NOT NULL,
+                    unit TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    records TEXT,
+                    error TEXT
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, attempts)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run TEXT NOT NULL,
+                    store TEXT NOT NULL,
+                    merged INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (run, store)
+                )""")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """ Write transaction, taking the database lock up front so concurrent workers can't lease the same job """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def add(self, run, store, units):
+        """
+        Queues the crawl units of a store's run
+        :param run: Run id
+        :param store: Store name, a key of the store dict
+        :param units: List of json serializable units from Store.crawl_units
+        :return: Number of jobs queued
+        """
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO runs (run, store) VALUES (?, ?)", (run, store))
+            conn.executemany("INSERT INTO jobs (run, store, unit, state) VALUES (?, ?, ?, ?)",
+                             [(run, store, json.dumps(unit), PENDING) for unit in units])
+        return len(units)
+
+    def lease(self, worker):
+        """
+        Leases the next pending job, first putting expired leases back in the queue
+        :param worker: Worker id
+        :return: (job_id, run, store, unit, attempt) 5-tuple, or None if there are no pending jobs
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                         "error = 'Lease expired on ' || worker, worker = NULL, lease_until = NULL "
+                         "WHERE state = ? AND lease_until < ?", (MAX_ATTEMPTS, FAILED, PENDING, LEASED, now))
+            row = conn.execute("SELECT id, run, store, unit, attempts FROM jobs WHERE state = ? "
+                               "ORDER BY attempts, id LIMIT 1", (PENDING,)).fetchone()
+            if row is None:
+                return None
+            job_id, run, store, unit, attempts = row
+            conn.execute("UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 "
+                         "WHERE id = ?", (LEASED, worker, now + LEASE_SECONDS, job_id))
+        return job_id, run, store, json.loads(unit), attempts + 1
+
+    def heartbeat(self, job_id, worker):
+        """
+        Extends a lease
+        :param job_id: Job id
+        :param worker: Worker id holding the lease
+        :return: False if the lease was lost, because it expired and was given to another worker
+        """
+        cursor = self._connect().execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = ?",
+                                         (time.time() + LEASE_SECONDS, job_id, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, records):
+        """
+        Marks a leased job done
+        :param job_id: Job id
+        :param worker: Worker id holding the lease
+        :param records: Name of the records file written by this attempt, see write_records
+        :return: False if the lease was lost, in which case this attempt's records should be discarded
+        """
+        cursor = self._connect().execute("UPDATE jobs SET state = ?, lease_until = NULL, records = ? WHERE id = ? "
+                                         "AND worker = ? AND state = ?", (DONE, records, job_id, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        """
+        Puts a leased job back in the queue, or marks it failed if it has used up its attempts
+        :param job_id: Job id
+        :param worker: Worker id holding the lease
+        :param error: Error message
+        :return: None
+        """
+        self._connect().execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, "
+                                "worker = NULL, lease_until = NULL WHERE id = ? AND worker = ? AND state = ?",
+                                (MAX_ATTEMPTS, FAILED, PENDING, str(error), job_id, worker, LEASED))
+
+    def claim_merge(self, run, store):
+        """
+        Claims merging a store's run, once none of its jobs are pending or leased. Only one worker gets the claim.
+        :param run: Run id
+        :param store: Store name
+        :return: True if the caller should merge the run's records
+        """
+        with self._transaction() as conn:
+            unfinished = conn.execute("SELECT COUNT(*) FROM jobs WHERE run = ? AND store = ? AND state IN (?, ?)",
+                                      (run, store, PENDING, LEASED)).fetchone()[0]
+            if unfinished > 0:
+                return False
+            cursor = conn.execute("UPDATE runs SET merged = 1 WHERE run = ? AND store = ? AND merged = 0",
+                                  (run, store))
+            return cursor.rowcount == 1
+
+    def unmerged(self):
+        """
+        :return: List of (run, store) not merged yet
+        """
+        return self._connect().execute("SELECT run, store FROM runs WHERE merged = 0").fetchall()
+
+    def unfinished(self):
+        """
+        :return: Number of pending or leased jobs
+        """
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)",
+                                       (PENDING, LEASED)).fetchone()[0]
+
+    def status(self):
+        """
+        :return: Dict of {(run, store): {state: count}}
+        """
+        rows = self._connect().execute("SELECT run, store, state, COUNT(*) FROM jobs GROUP BY run, store, state "
+                                       "ORDER BY run, store").fetchall()
+        status = {}
+        for run, store, state, count in rows:
+            status.setdefault((run, store), {})[state] = count
+        return status
+
+    def failed(self, run, store):
+        """
+        :return: List of (unit, error) of a store run's failed jobs
+        """
+        rows = self._connect().execute("SELECT unit, error FROM jobs WHERE run = ? AND store = ? AND state = ?",
+                                       (run, store, FAILED)).fetchall()
+        return [(json.loads(unit), error) for unit, error in rows]
+
+    def _records_dir(self, run, store):
+        return os.path.join(self.queue_dir, run, store)
+
+    def write_records(self, job_id, attempt, run, store, records):
+        """
+        Writes the records of an attempt of a job
+        :param job_id: Job id
+        :param attempt: Attempt number, from lease
+        :param run: Run id
+        :param store: Store name
+        :param records: Iterable of json serializable records
+        :return: Name of the records file, in the store run's records directory
+        """
+        name = f"{job_id}-{attempt}.ndjson"
+        path = os.path.join(self._records_dir(run, store), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")))
+                f.write("\n")
+        os.replace(path + ".tmp", path)
+        return name
+
+    def discard_records(self, run, store, name):
+        """
+        Deletes the records file of an attempt that lost its lease
+        :param run: Run id
+        :param store: Store name
+        :param name: Name of the records file, from write_records
+        :return: None
+        """
+        try:
+            os.remove(os.path.join(self._records_dir(run, store), name))
+        except FileNotFoundError:
+            pass
+
+    def merge(self, run, store):
+        """
+        Writes the records of every done job of a store's run to one spool file, and deletes the job files
+        :param run: Run id
+        :param store: Store name
+        :return: Path of the spool file
+        """
+        records_dir = self._records_dir(run, store)
+        done = self._connect().execute("SELECT records FROM jobs WHERE run = ? AND store = ? AND state = ? "
+                                       "ORDER BY id", (run, store, DONE)).fetchall()
+        paths = [os.path.join(records_dir, records) for records, in done]
+        path = Spool(store).write(itertools.chain.from_iterable(Spool.read(path) for path in paths))
+        for unit, error in self.failed(run, store):
+            tools.log_error(f"Crawl unit failed: {error}", store=store, run=run, unit=unit)
+        shutil.rmtree(records_dir, ignore_errors=True)
+        return path
+
+
+class Heartbeat:
+    """ Context manager extending a job's lease from a background thread while the job runs """
+
+    def __init__(self, queue, job_id, worker):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            if not self.queue.heartbeat(self.job_id, self.worker):
+                print(f"Worker {self.worker} lost the lease on job {self.job_id}")
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def enqueue(stores, store_names, queue_dir=QUEUE_DIR):
+    """
+    Queues a new run of the crawl units of each store
+    :param stores: Dict of store names to store classes
+    :param store_names: List of store names to queue
+    :param queue_dir: Queue directory
+    :return: Run id
+    """
+    queue = WorkQueue(queue_dir)
+    run = time.strftime("%Y%m%d-%H%M%S")
+    for store_name in store_names:
+        count = queue.add(run, store_name, stores[store_name]().crawl_units())
+        print(f"Queued {count} {store_name} crawl units for run {run}")
+    return run
+
+
+def work(stores, queue_dir=QUEUE_DIR, worker=None):
+    """
+    Worker loop, leasing and crawling jobs until none are pending or leased.
+    While other workers hold the only unfinished jobs, it keeps polling, to pick them up if their leases expire.
+    :param stores: Dict of store names to store classes
+    :param queue_dir: Queue directory
+    :param worker: Worker id, defaults to host and process id
+    :return: Number of jobs done
+    """
+    if worker is None:
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+    if progress.reporter.mode == progress.TTY:
+        # Progress bars of concurrent workers would draw over each other
+        progress.reporter.set_mode(progress.QUIET)
+    queue = WorkQueue(queue_dir)
+    instances = {}
+    done = 0
+    while True:
+        job = queue.lease(worker)
+        if job is None:
+            if queue.unfinished() == 0:
+                # Runs whose last job failed by its lease expiring haven't been merged by the worker crawling it
+                for run, store_name in queue.unmerged():
+                    if queue.claim_merge(run, store_name):
+                        queue.merge(run, store_name)
+                print(f"Worker {worker} finished after {done} jobs")
+                return done
+            time.sleep(POLL_SECONDS)
+            continue
+        job_id, run, store_name, unit, attempt = job
+        if store_name not in instances:
+            instances[store_name] = stores[store_name]()
+        with Heartbeat(queue, job_id, worker):
+            try:
+                records = queue.write_records(job_id, attempt, run, store_name,
+                                              instances[store_name].crawl_unit(unit))
+            except Exception as err:
+                tools.log_error(err, store=store_name, run=run, job=job_id, unit=unit)
+                queue.fail(job_id, worker, err)
+            else:
+                if queue.complete(job_id, worker, records):
+                    done += 1
+                    print(f"Worker {worker} crawled {store_name} job {job_id}")
+                else:
+                    queue.discard_records(run, store_name, records)
+        if queue.claim_merge(run, store_name):
+            queue.merge(run, store_name)
+
+
+def run_workers(stores, workers=None, queue_dir=QUEUE_DIR):
+    """
+    Starts worker processes and waits for them to finish
+    :param stores: Dict of store names to store classes
+    :param workers: Number of processes, defaults to the number of cores
+    :param queue_dir: Queue directory
+    :return: None
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    processes = [multiprocessing.Process(target=work, args=(stores, queue_dir), name=f"worker-{i}")
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def print_status(queue_dir=QUEUE_DIR):
+    """
+    Prints the job counts of each store run in the queue
+    :return: None
+    """
+    for (run, store), counts in WorkQueue(queue_dir).status().items():
+        print(f"{run} {store}: " + ", ".join(f"{counts.get(state, 0)} {state}"
+                                             for state in (PENDING, LEASED, DONE, FAILED)))